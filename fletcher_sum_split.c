@@ -1,8 +1,10 @@
 #include <Python.h>
-#include <cStringIO.h>
 
+#include <errno.h>
+#include <pthread.h>
 #include <string.h>
 #include <unistd.h>
+#include <sys/mman.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <limits.h>
@@ -42,145 +44,333 @@ So, we choose a prime number of about the same size as M, and our
 pseudo random value is the Fletcher sum of some preceding bytes modulo
 that prime.
 
+Gear Hash
+=========
+
+The module also provides a cheaper engine, selected with engine="gear".
+Its rolling hash is shifted left one bit per byte with a value from a
+table of random numbers added in, so each byte costs a shift, an add and
+a lookup.  After 64 bytes a byte has been shifted out of the hash
+entirely.  A segment ends at a byte where the top bits of the hash are
+all zero, provided that the segment has reached the minimum size.  The
+number of bits tested is one more than log2 of the minimum segment size,
+so the mean segment size is about 3 times the minimum.
+
+The hash isn't computed for the first bytes of a segment that can't end
+it, except for the 64 bytes needed to prime it, which saves most of the
+scanning work for the minimum size part of each segment.
+
+The gear table is generated from a fixed seed, and must never change,
+since that would move segment boundaries.
+
+Segment size limits are chosen at runtime.  The minimum segment size
+must be a power of two, and the Fletcher sum window is half of it.  The
+mean segment size isn't an independent parameter: for a prime near the
+minimum it comes out at about 4 times the minimum, by observation.
+
+A maximum segment size can also be set, to bound the memory needed for
+a segment when the input goes a long way without an end of segment
+pattern.  A segment that reaches the maximum size is cut there.  These
+forced cuts don't influence where the content defined cuts fall, so the
+segmentation resynchronises at the next content defined cut.
+
 *********************************************************************/
 
-/* The size of the input pattern that triggers the end of a segment */
-#define MINSEGSIZE_BITS 20 /* 1M min seg size, 4M typical seg size */
-#define MINSEGSIZE (1<<MINSEGSIZE_BITS)
-
-/* The size of the rolling window for Fletcher Checksum computation */
-#define SUM_WINDOW_BITS (MINSEGSIZE_BITS-1)
-#define SUM_WINDOW (1<<SUM_WINDOW_BITS)
-
-/* The mean segment size, by observation. */ 
-#define MEAN_SEGMENT_SIZE (4 * MINSEGSIZE)
-
-/* A prime number near to MINSEGSIZE. */
-#if MINSEGSIZE_BITS == 8
-# define PRIME 257
-#elif MINSEGSIZE_BITS == 9
-# define PRIME 509
-#elif MINSEGSIZE_BITS == 10
-# define PRIME 1031
-#elif MINSEGSIZE_BITS == 11
-# define PRIME 2053
-#elif MINSEGSIZE_BITS == 12
-# define PRIME 4093
-#elif MINSEGSIZE_BITS == 13
-# define PRIME 8191
-#elif MINSEGSIZE_BITS == 14
-# define PRIME 16381
-#elif MINSEGSIZE_BITS == 15
-# define PRIME 32771
-#elif MINSEGSIZE_BITS == 16
-# define PRIME 65537
-#elif MINSEGSIZE_BITS == 17
-# define PRIME 131071
-#elif MINSEGSIZE_BITS == 18
-# define PRIME 262147
-#elif MINSEGSIZE_BITS == 19
-# define PRIME 524287
-#elif MINSEGSIZE_BITS == 20
-# define PRIME 1048573
-#elif MINSEGSIZE_BITS == 21
-# define PRIME 2097143
-#elif MINSEGSIZE_BITS == 22
-# define PRIME 4194301
-#elif MINSEGSIZE_BITS == 23
-# define PRIME 8388593
-#elif MINSEGSIZE_BITS == 24
-# define PRIME 16777213
-#elif MINSEGSIZE_BITS == 25
-# define PRIME 33554467
-#else
-# error "unsupported value for MINSEGSIZE_BITS"
-#endif
+/* Default segment size limits */
+#define DEFAULT_MINSEGSIZE_BITS 20 /* 1M min seg size, 4M typical seg size */
+#define DEFAULT_MAXSEGSIZE 0      /* no maximum */
 
-/* How many bits must an integer type have so that it can hold the sum
-** all the chars in a fletchsum window without overflow ? */
-#define CHARSUM_BITS (SUM_WINDOW_BITS+CHAR_BIT)
-
-/* How many bits must an integer type have so that it can hold the fletcher
-** checksum over a fletchsum window without overflow ? */
-#define FLETCHSUM_BITS (CHARSUM_BITS + SUM_WINDOW_BITS - 1)
-
-/* How many bits must an integer type have so that it can hold the fletcher
-** checksum over a fletchsum window modulo the prime without overflow ? */
-#define FLETCHSUM_MODPRIME_BITS (MINSEGSIZE_BITS < FLETCHSUM_BITS ? MINSEGSIZE_BITS : FLETCHSUM_BITS)
-
-////////////////////////////////////////////////////////////////
-
-// Int types big enough to store some things:
-
-// Convert max value to number of bits.  Don't shift by more
-// than 8 at a time, because shifting by more than the width
-// of a type can raise compiler warnings.
-#define BITS1(c ) ( (c) ? 1 : 0 )
-#define BITS2(c ) ( (c)>>1 ? 1 + BITS1( (c)>>1) : BITS1(c) )
-#define BITS4(c ) ( (c)>>2 ? 2 + BITS2( (c)>>2) : BITS2(c) ) 
-#define BITS8(c ) ( (c)>>4 ? 4 + BITS4( (c)>>4) : BITS4(c) ) 
-#define BITS16(c) ( (c)>>8 ? 8 + BITS8( (c)>>8) : BITS8(c) ) 
-#define BITS24(c) ( (c)>>8 ? 8 + BITS16((c)>>8) : BITS8(c) ) 
-#define BITS32(c) ( (c)>>8 ? 8 + BITS24((c)>>8) : BITS8(c) ) 
-#define BITS40(c) ( (c)>>8 ? 8 + BITS32((c)>>8) : BITS8(c) ) 
-#define BITS48(c) ( (c)>>8 ? 8 + BITS40((c)>>8) : BITS8(c) ) 
-#define BITS56(c) ( (c)>>8 ? 8 + BITS48((c)>>8) : BITS8(c) ) 
-#define BITS64(c) ( (c)>>8 ? 8 + BITS56((c)>>8) : BITS8(c) ) 
-#define BITS70(c) ( (c)>>8 ? 8 + BITS64((c)>>8) : BITS8(c) ) 
-
-// The number of bits in some integer types
-#define USHRT_BITS  BITS70(USHRT_MAX)
-#define UINT_BITS   BITS70(UINT_MAX)
-#define ULONG_BITS  BITS70(ULONG_MAX)
-#define ULLONG_BITS BITS70(ULLONG_MAX)
-
-/* An integer type just big enough to hold a charsum */
-#if UINT_BITS > CHARSUM_BITS
-typedef unsigned int charsum_t;
-#elif ULONG_BITS > CHARSUM_BITS
-typedef unsigned long charsum_t;
-#elif ULLONG_BITS > CHARSUM_BITS
-typedef unsigned long long charsum_t;
-#else
-# error "no unsigned int type can hold a charsum"
-#endif
+/* Supported range of MINSEGSIZE_BITS */
+#define MIN_MINSEGSIZE_BITS 8
+#define MAX_MINSEGSIZE_BITS 25
 
-/* An integer type just big enough to hold a fletchsum */
-#if UINT_BITS > FLETCHSUM_BITS
-typedef unsigned int fletchsum_t;
-#elif ULONG_BITS > FLETCHSUM_BITS
-typedef unsigned long fletchsum_t;
-#elif ULLONG_BITS > FLETCHSUM_BITS
-typedef unsigned long long fletchsum_t;
-#else
-# error "no unsigned int type can hold a fletchsum"
-#endif
+/* Chunking engines */
+#define ENGINE_FLETCHER 0
+#define ENGINE_GEAR 1
 
-/* An integer type just big enough to hold a fletchsum modulo the prime */
-#if UINT_BITS > FLETCHSUM_MODPRIME_BITS
-typedef unsigned int fletchsum_mp_t;
-#elif ULONG_BITS > FLETCHSUM_MODPRIME_BITS
-typedef unsigned long fletchsum_mp_t;
-#elif ULLONG_BITS > FLETCHSUM_MODPRIME_BITS
-typedef unsigned long long fletchsum_mp_t;
-#else
-# error "no unsigned int type can hold a fletchsum mod prime"
-#endif
+/* The number of bytes that contribute to the gear hash */
+#define GEAR_WINDOW 64
+
+/* Segments read from a stream are accumulated in arenas big enough for
+** this many maximum size segments, or for this many times 8 minimum size
+** segments if there's no maximum. */
+#define ARENA_SEGMENTS 4
+
+/* Returned from next_segment() when there's no room in the arena */
+#define NEED_ARENA_SPACE (-1)
+
+/* The number of input blocks that the read-ahead thread can fill before
+** the scanner catches up.  Two of them are in use by the scanner. */
+#define READAHEAD_BLOCKS 8
+
+/* For each supported MINSEGSIZE_BITS, a prime number near to MINSEGSIZE. */
+static const unsigned long primes[] = {
+    257, 509, 1031, 2053, 4093, 8191, 16381, 32771, 65537, 131071,
+    262147, 524287, 1048573, 2097143, 4194301, 8388593, 16777213, 33554467
+};
+
+/* The largest value we need to reduce modulo the prime is under
+** 2 * SUM_WINDOW * 256, so 64 bit arithmetic is always enough. */
+typedef unsigned PY_LONG_LONG sum_t;
+
+/* A stream offset */
+typedef unsigned PY_LONG_LONG offset_t;
+
+/* The gear hash */
+typedef unsigned PY_LONG_LONG gear_t;
+
+static gear_t gear_table[256];
+
+static void
+init_gear_table(void)
+/* Fill the gear table using splitmix64 from a fixed seed */
+{
+    gear_t x = 0x696e64756d70636fULL, z;
+    int i;
+
+    for ( i=0 ; i<256 ; i++ ) {
+        z = (x += 0x9e3779b97f4a7c15ULL);
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+        gear_table[i] = z ^ (z >> 31);
+    }
+}
+
+/////////////////////////////////////////////////////////////////
+
+/* Read-ahead
+** ==========
+**
+** A background thread reads the input in blocks into a ring of buffers,
+** so that reading overlaps with scanning.  Block n of the input goes in
+** slot n % READAHEAD_BLOCKS.  The scanner releases blocks in order once
+** it has finished with them.
+**
+** The thread and the scanner share the ring, and whichever finishes with
+** it last frees it.  If the scanner is destroyed while the thread is
+** blocked in read(), the thread frees the ring when read() returns.
+*/
+
+typedef struct {
+    int fd;                      // The file descriptor from which to read
+    size_t block_size;           // Size of each block
+    unsigned char *store;        // Storage for READAHEAD_BLOCKS blocks
+    size_t lens[READAHEAD_BLOCKS]; // Bytes read into each slot
+    offset_t filled;             // Number of blocks read so far
+    offset_t released;           // Number of blocks the scanner is done with
+    int eof;                     // Has the thread seen EOF
+    int err;                     // errno from a failed read, or 0
+    int stop;                    // Set when the scanner has gone away
+    int refcnt;                  // Number of users: the thread and the scanner
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+} readahead;
+
+static void
+ra_unref(readahead *ra)
+/* Drop a reference, called with the lock held.  Frees the ring if that
+** was the last reference.
+*/
+{
+    if (--ra->refcnt == 0) {
+        pthread_mutex_unlock(&ra->lock);
+        pthread_mutex_destroy(&ra->lock);
+        pthread_cond_destroy(&ra->cond);
+        close(ra->fd);
+        free(ra->store);
+        free(ra);
+    } else {
+        pthread_mutex_unlock(&ra->lock);
+    }
+}
+
+static ssize_t
+read_fully(int fd, unsigned char *buf, size_t len)
+/* Read until buf is full or EOF, returns the number of bytes read or -1
+** on error.
+*/
+{
+    size_t got = 0;
+    ssize_t res;
+
+    while (got < len) {
+        res = read(fd, buf + got, len - got);
+        if (res < 0) {
+            if (errno == EINTR)
+                continue;
+            return -1;
+        }
+        if (res == 0)
+            break;
+        got += res;
+    }
+    return got;
+}
+
+static void *
+ra_thread_main(void *arg)
+{
+    readahead *ra = arg;
+    unsigned char *slot;
+    ssize_t got;
+    int e;
+
+    pthread_mutex_lock(&ra->lock);
+    while (!ra->stop && !ra->eof && !ra->err) {
+        if (ra->filled - ra->released >= READAHEAD_BLOCKS) {
+            pthread_cond_wait(&ra->cond, &ra->lock);
+            continue;
+        }
+        // The scanner never touches a slot between filled and released
+        // + READAHEAD_BLOCKS, so we can read into it without the lock.
+        slot = ra->store + (ra->filled % READAHEAD_BLOCKS) * ra->block_size;
+        pthread_mutex_unlock(&ra->lock);
+        got = read_fully(ra->fd, slot, ra->block_size);
+        e = errno;
+        pthread_mutex_lock(&ra->lock);
+        if (got < 0) {
+            ra->err = e ? e : EIO;
+        } else {
+            ra->lens[ra->filled % READAHEAD_BLOCKS] = got;
+            ra->filled++;
+            if ((size_t)got < ra->block_size)
+                ra->eof = 1;
+        }
+        pthread_cond_broadcast(&ra->cond);
+    }
+    ra_unref(ra);
+    return NULL;
+}
+
+static readahead *
+ra_start(int fd, size_t block_size)
+/* Start a read-ahead thread, taking ownership of fd.  Returns NULL with
+** errno set on failure.
+*/
+{
+    readahead *ra;
+    pthread_t thread;
+    pthread_attr_t attr;
+    int e;
+
+    ra = calloc(1, sizeof(*ra));
+    if (!ra)
+        return NULL;
+    ra->store = malloc(READAHEAD_BLOCKS * block_size);
+    if (!ra->store) {
+        free(ra);
+        errno = ENOMEM;
+        return NULL;
+    }
+    ra->fd = fd;
+    ra->block_size = block_size;
+    ra->refcnt = 2;
+    pthread_mutex_init(&ra->lock, NULL);
+    pthread_cond_init(&ra->cond, NULL);
+
+    pthread_attr_init(&attr);
+    pthread_attr_setdetachstate(&attr, PTHREAD_CREATE_DETACHED);
+    e = pthread_create(&thread, &attr, ra_thread_main, ra);
+    pthread_attr_destroy(&attr);
+    if (e) {
+        pthread_mutex_destroy(&ra->lock);
+        pthread_cond_destroy(&ra->cond);
+        free(ra->store);
+        free(ra);
+        errno = e;
+        return NULL;
+    }
+    return ra;
+}
+
+static int
+ra_get_block(readahead *ra, offset_t n, unsigned char **data, size_t *len)
+/* Wait for block n to be read, and release all blocks before n-1.  Returns
+** 0 on success or an errno value on failure.
+*/
+{
+    int err = 0;
+
+    pthread_mutex_lock(&ra->lock);
+    if (n > 1 && ra->released < n - 1) {
+        ra->released = n - 1;
+        pthread_cond_broadcast(&ra->cond);
+    }
+    while (ra->filled <= n && !ra->err)
+        pthread_cond_wait(&ra->cond, &ra->lock);
+    if (ra->filled > n) {
+        *data = ra->store + (n % READAHEAD_BLOCKS) * ra->block_size;
+        *len = ra->lens[n % READAHEAD_BLOCKS];
+    } else {
+        err = ra->err;
+    }
+    pthread_mutex_unlock(&ra->lock);
+    return err;
+}
+
+static void
+ra_stop(readahead *ra)
+{
+    pthread_mutex_lock(&ra->lock);
+    ra->stop = 1;
+    pthread_cond_broadcast(&ra->cond);
+    ra_unref(ra);
+}
 
 /////////////////////////////////////////////////////////////////
 
+/* Output
+** ======
+**
+** Segments are returned as read-only buffer objects rather than strings,
+** to avoid copying them.
+**
+** If the input is a buffer object, such as an mmap of the input file, the
+** segments are buffers over that object, so no copy is made at all.
+**
+** Otherwise the input is read from a file descriptor, and each segment is
+** copied once, from the read-ahead ring into an arena.  Arenas are
+** bytearrays in a pool, and each segment buffer holds a reference to its
+** arena.  An arena can be reused once the pool holds the only reference to
+** it, which means that every segment in it has been consumed.
+*/
+
 typedef struct {
-    FILE *input;               // The file handle from which to read
-    size_t bytes_into_seg;     // How far into the current segment we are
-    size_t last_hit_at;        // Most recent byte at which fletchsum mod prime was 0
-    unsigned char *blk;        // The current input block of SUM_WINDOW bytes
-    unsigned char *prev_blk;   // The previous input block of SUM_WINDOW bytes
-    unsigned char *blockstore; // Storage for blk and prev_blk
-    PyObject *outbuf;          // Where we accumulate the segment
-    int eof;                   // Have we seen EOF on the input filehandle
-    charsum_t char_sum;        // Current character sum
-    fletchsum_mp_t fletch_sum; // Current fletcher sum modulo prime
-    fletchsum_mp_t precomputed_remove_oldbyte[256];
+    readahead *input;          // The read-ahead ring from which to read, or NULL
+    PyObject *source;          // The buffer object holding the input, or NULL
+    unsigned char *source_data; // The contents of source
+    size_t source_len;         // The length of source
+    PyObject *arenas;          // The pool of arenas
+    PyObject *arena;           // The arena being filled, borrowed from arenas
+    unsigned char *arena_data; // The contents of arena
+    size_t arena_size;         // The size of arena
+    size_t arena_used;         // The number of bytes in arena in earlier segments
+    size_t default_arena_size; // The size of a new arena
+    int engine;                // ENGINE_FLETCHER or ENGINE_GEAR
+    int minseg_bits;           // log2 of the minimum segment size
+    size_t minseg_size;        // Minimum segment size (content defined cuts)
+    size_t maxseg_size;        // Maximum segment size, 0 for no maximum
+    size_t sum_window;         // Size of the Fletcher sum window and input blocks
+    sum_t prime;               // The prime modulus
+    sum_t prime_recip;         // floor(2**32 / prime), for fast modulo
+    gear_t gear_hash;          // Current gear hash
+    gear_t gear_mask;          // The bits of the gear hash that must be zero
+    unsigned char *blk;        // The current input block of sum_window bytes
+    unsigned char *prev_blk;   // The previous input block of sum_window bytes
+    offset_t blk_num;          // The block number of blk
+    size_t blk_len;            // Number of bytes in blk
+    size_t blk_pos;            // Number of bytes in blk that we've dealt with
+    offset_t blk_start;        // Stream offset of blk[0]
+    offset_t seg_start;        // Stream offset of the start of the current segment
+    offset_t hit_limit;        // A zero sum beyond this stream offset ends a segment
+    int cut_in_blk;            // Has there been a content defined cut in blk
+    size_t seg_len;            // Number of bytes in the current segment so far
+    int started;               // Have we read the first block
+    int eof;                   // Have we seen EOF on the input
+    int done;                  // Have we returned the final segment
+    sum_t char_sum;            // Current character sum
+    sum_t fletch_sum;          // Current fletcher sum modulo prime
+    sum_t precomputed_remove_oldbyte[256];
         /* When rolling the fletcher sum window forward one byte, we need to
         ** add something to fletchsum-mod-prime to remove the effect of the
         ** char that's no-longer in the window.  A lookup table speeds this up
@@ -194,9 +384,9 @@ fsss_destroy(fss_state *fsss)
 {
     if (fsss) {
         if (fsss->input)
-            fclose(fsss->input);
-        free(fsss->blockstore);
-        Py_XDECREF(fsss->outbuf);
+            ra_stop(fsss->input);
+        Py_XDECREF(fsss->source);
+        Py_XDECREF(fsss->arenas);
         free(fsss);
     }
 }
@@ -207,108 +397,398 @@ fsss_pyobj_destroy(PyObject *p)
     fsss_destroy(PyCapsule_GetPointer(p, cobj_name));
 }
 
+static inline sum_t
+mod_prime(fss_state *fsss, sum_t x)
+/* x modulo the prime, using a multiplication in place of a division.  The
+** estimated quotient can be low by at most 2 for the values of x we use.
+*/
+{
+    sum_t r = x - ((x * fsss->prime_recip) >> 32) * fsss->prime;
+
+    while (r >= fsss->prime)
+        r -= fsss->prime;
+    return r;
+}
+
 static void
 sums_from_scratch(fss_state *fsss, unsigned char *buf)
-/* Compute the character sum and fletcher sum of a buffer of length SUM_WINDOW.
+/* Compute the character sum and fletcher sum of a buffer of length sum_window.
 */
 {
-    charsum_t char_sum =0;
-    fletchsum_t fletch_sum =0;
-    int i;
+    sum_t char_sum =0;
+    sum_t fletch_sum =0;
+    size_t i;
 
-    for ( i=0 ; i<SUM_WINDOW ; i++ ) {
+    for ( i=0 ; i<fsss->sum_window ; i++ ) {
         char_sum += buf[i];
         fletch_sum += char_sum;
     }
 
     fsss->char_sum = char_sum;
-    fsss->fletch_sum = fletch_sum % PRIME;
+    fsss->fletch_sum = fletch_sum % fsss->prime;
 }
 
-static PyObject *
-fletcher_sum_split_new(PyObject *self, PyObject *args)
+static int
+init_engine(fss_state *fsss, const char *engine, int minseg_bits)
+/* Set up the segmenting parameters.  Returns 0 on success, -1 with a
+** Python exception set on error.
+*/
 {
-    fss_state *fsss;
-    int gotbytes, fd, i;
-
-    if (!PyArg_ParseTuple(args, "i", &fd))
-        return NULL;
+    int i;
 
-    fsss = malloc(sizeof(*fsss));
-    if (!fsss)
-        return PyErr_NoMemory();
-    fsss->blockstore = malloc(2 * SUM_WINDOW);
-    fsss->outbuf = PycStringIO->NewOutput(2 * MEAN_SEGMENT_SIZE);
-    if (!fsss->blockstore || !fsss->outbuf) {
-        fsss_destroy(fsss);
-        return PyErr_NoMemory();
+    if (minseg_bits < MIN_MINSEGSIZE_BITS || minseg_bits > MAX_MINSEGSIZE_BITS) {
+        PyErr_Format(PyExc_ValueError, "min_seg_bits must be between %d and %d",
+                MIN_MINSEGSIZE_BITS, MAX_MINSEGSIZE_BITS);
+        return -1;
+    }
+    if (strcmp(engine, "fletcher") == 0) {
+        fsss->engine = ENGINE_FLETCHER;
+    } else if (strcmp(engine, "gear") == 0) {
+        fsss->engine = ENGINE_GEAR;
+    } else {
+        PyErr_Format(PyExc_ValueError, "unknown chunking engine %s", engine);
+        return -1;
     }
-    fsss->blk = fsss->blockstore;
-    fsss->prev_blk = fsss->blockstore + SUM_WINDOW;
 
+    fsss->minseg_bits = minseg_bits;
+    fsss->minseg_size = (size_t)1 << minseg_bits;
+    fsss->sum_window = fsss->minseg_size >> 1;
+    fsss->prime = primes[minseg_bits - MIN_MINSEGSIZE_BITS];
+    fsss->prime_recip = ((sum_t)1 << 32) / fsss->prime;
     for ( i=0 ; i<256 ; i++ ) {
         fsss->precomputed_remove_oldbyte[i] = \
-                PRIME - (((charsum_t)SUM_WINDOW * (charsum_t)i) % PRIME);
+                fsss->prime - (((sum_t)fsss->sum_window * (sum_t)i) % fsss->prime);
     }
+    fsss->gear_mask = ~(gear_t)0 << (64 - (minseg_bits + 1));
+    return 0;
+}
 
-    fd = dup(fd);
-    if (fd < 0) {
-        PyErr_SetFromErrno(PyExc_IOError);
-        fsss_destroy(fsss);
+static PyObject *
+fletcher_sum_split_new(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"source", "min_seg_bits", "max_seg_size", "engine", NULL};
+    fss_state *fsss;
+    PyObject *source;
+    const void *source_data;
+    Py_ssize_t source_len;
+    int fd, minseg_bits = DEFAULT_MINSEGSIZE_BITS;
+    Py_ssize_t maxseg_size = DEFAULT_MAXSEGSIZE;
+    const char *engine = "fletcher";
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|ins", kwlist, &source, &minseg_bits, &maxseg_size, &engine))
+        return NULL;
+    if (minseg_bits >= MIN_MINSEGSIZE_BITS && minseg_bits <= MAX_MINSEGSIZE_BITS &&
+            maxseg_size != 0 && maxseg_size < ((Py_ssize_t)1 << minseg_bits)) {
+        PyErr_SetString(PyExc_ValueError, "max_seg_size must be 0 or at least the minimum segment size");
         return NULL;
     }
 
-    fsss->input = fdopen(fd, "r");
-    if (! fsss->input ) {
-        PyErr_SetFromErrno(PyExc_IOError);
+    fsss = calloc(1, sizeof(*fsss));
+    if (!fsss)
+        return PyErr_NoMemory();
+    if (init_engine(fsss, engine, minseg_bits) < 0) {
         fsss_destroy(fsss);
-        close(fd);
         return NULL;
     }
+    fsss->maxseg_size = maxseg_size;
 
-    fsss->bytes_into_seg = 0;
-    fsss->last_hit_at = 0;
-    fsss->eof = 0;
+    if (PyInt_Check(source) || PyLong_Check(source)) {
+        fd = PyInt_AsLong(source);
+        if (fd == -1 && PyErr_Occurred()) {
+            fsss_destroy(fsss);
+            return NULL;
+        }
+        fsss->arenas = PyList_New(0);
+        if (!fsss->arenas) {
+            fsss_destroy(fsss);
+            return NULL;
+        }
+        fsss->default_arena_size = ARENA_SEGMENTS * (maxseg_size ? maxseg_size : 8 * fsss->minseg_size);
 
-    gotbytes = fread(fsss->prev_blk, 1, SUM_WINDOW, fsss->input);
-    fsss->bytes_into_seg = gotbytes;
-    if (PycStringIO->cwrite(fsss->outbuf, (const char *)fsss->prev_blk, gotbytes) != gotbytes) {
-        fsss_destroy(fsss);
-        return NULL;
+        fd = dup(fd);
+        if (fd < 0) {
+            PyErr_SetFromErrno(PyExc_IOError);
+            fsss_destroy(fsss);
+            return NULL;
+        }
+
+        fsss->input = ra_start(fd, fsss->sum_window);
+        if (!fsss->input) {
+            PyErr_SetFromErrno(PyExc_IOError);
+            fsss_destroy(fsss);
+            close(fd);
+            return NULL;
+        }
+    } else {
+        if (PyObject_AsReadBuffer(source, &source_data, &source_len) < 0) {
+            fsss_destroy(fsss);
+            return NULL;
+        }
+        Py_INCREF(source);
+        fsss->source = source;
+        fsss->source_data = (unsigned char *)source_data;
+        fsss->source_len = source_len;
+#ifdef MADV_SEQUENTIAL
+        // Only has an effect if source is an mmap, harmless otherwise.
+        madvise((void *)((size_t)source_data & ~(size_t)(getpagesize() - 1)),
+                source_len + ((size_t)source_data & (getpagesize() - 1)), MADV_SEQUENTIAL);
+#endif
     }
 
-    if (gotbytes == SUM_WINDOW) {
-        sums_from_scratch(fsss, fsss->prev_blk);
-        if (fsss->fletch_sum == 0) {
-            fsss->last_hit_at = SUM_WINDOW;
+    return PyCapsule_New(fsss, cobj_name, fsss_pyobj_destroy);
+}
+
+static int
+next_block(fss_state *fsss)
+/* Move on to the next input block.  Returns 0 on success or an errno
+** value on failure.
+*/
+{
+    offset_t blk_num = fsss->started ? fsss->blk_num + 1 : 0;
+    unsigned char *data = NULL;
+    size_t len = 0;
+    int err;
+
+    if (fsss->input) {
+        err = ra_get_block(fsss->input, blk_num, &data, &len);
+        if (err)
+            return err;
+    } else {
+        // We only ask for the block after a full block, so this is within
+        // the source or just at its end.
+        data = fsss->source_data + blk_num * fsss->sum_window;
+        len = fsss->source_len - blk_num * fsss->sum_window;
+        if (len > fsss->sum_window)
+            len = fsss->sum_window;
+    }
+
+    if (!fsss->started) {
+        // The first sum_window bytes of input aren't scanned byte by byte,
+        // we just compute the sums at the end of them.
+        fsss->started = 1;
+        fsss->blk_start = 0;
+        fsss->hit_limit = fsss->minseg_size;
+        if (len == fsss->sum_window && fsss->engine == ENGINE_FLETCHER) {
+            sums_from_scratch(fsss, data);
+            if (fsss->fletch_sum == 0) {
+                fsss->hit_limit += fsss->sum_window;
+            }
         }
     } else {
+        fsss->blk_start += fsss->blk_len;
+    }
+    fsss->prev_blk = fsss->blk;
+    fsss->blk = data;
+    fsss->blk_num = blk_num;
+    fsss->blk_len = len;
+    fsss->blk_pos = 0;
+    fsss->cut_in_blk = 0;
+    if (len < fsss->sum_window)
         fsss->eof = 1;
+    return 0;
+}
+
+static size_t
+fletcher_scan(fss_state *fsss, size_t scan_end)
+/* Roll the Fletcher sums forward through the current block from blk_pos
+** to at most scan_end.  If the end of the segment is found, sets seg_start
+** to the start of the next segment and returns the block index just after
+** the segment end, otherwise returns scan_end.
+*/
+{
+    size_t i;
+    sum_t char_sum = fsss->char_sum, fletch_sum = fsss->fletch_sum;
+    offset_t pos;
+    unsigned char *blk = fsss->blk, *prev_blk = fsss->prev_blk;
+
+    for ( i=fsss->blk_pos ; i<scan_end ; i++ ) {
+        char_sum += blk[i] - prev_blk[i];
+        fletch_sum = mod_prime(fsss, fletch_sum + char_sum + fsss->precomputed_remove_oldbyte[prev_blk[i]]);
+
+        if (fletch_sum == 0) {
+            pos = fsss->blk_start + i;
+            if (pos > fsss->hit_limit) {
+                // End of segment pattern found.
+                fsss->hit_limit = pos + fsss->minseg_size + 1;
+                fsss->cut_in_blk = 1;
+                fsss->seg_start = pos + 1;
+                scan_end = i + 1;
+                break;
+            }
+            // Segments start one byte later in the coordinates of the
+            // original implementation when a segment ends part way
+            // through a block, which offsets later minimum segment
+            // size checks by one byte.  We replicate that so as to
+            // place segment boundaries exactly where it did.
+            fsss->hit_limit = pos + fsss->minseg_size + fsss->cut_in_blk;
+        }
     }
+    fsss->char_sum = char_sum;
+    fsss->fletch_sum = fletch_sum;
+    return scan_end;
+}
 
-    return PyCapsule_New(fsss, cobj_name, fsss_pyobj_destroy);
+static size_t
+gear_scan(fss_state *fsss, size_t scan_end)
+/* Like fletcher_scan(), for the gear engine.  Skips to GEAR_WINDOW bytes
+** before the first byte that could end the segment, and primes the hash
+** from there.
+*/
+{
+    size_t i = fsss->blk_pos;
+    gear_t h = fsss->gear_hash;
+    offset_t resume_at = fsss->seg_start + fsss->minseg_size - GEAR_WINDOW;
+    unsigned char *blk = fsss->blk;
+
+    if (fsss->blk_start + i < resume_at) {
+        if (resume_at >= fsss->blk_start + scan_end)
+            return scan_end;
+        i = resume_at - fsss->blk_start;
+        h = 0;
+    }
+    for ( ; i<scan_end ; i++ ) {
+        h = (h << 1) + gear_table[blk[i]];
+        if (!(h & fsss->gear_mask) && fsss->blk_start + i + 1 - fsss->seg_start >= fsss->minseg_size) {
+            fsss->seg_start = fsss->blk_start + i + 1;
+            scan_end = i + 1;
+            break;
+        }
+    }
+    fsss->gear_hash = h;
+    return scan_end;
 }
 
-static PyObject *
-convert_cstringio_to_string(PyObject *cstringio)
+static size_t
+scan_block(fss_state *fsss)
+/* Scan the current block from blk_pos until the end of the current segment
+** is found or the block is exhausted.  Returns the number of bytes of the
+** block that belong to the current segment.  Sets seg_start to the start
+** of the next segment if a segment ends.
+**
+** For the Fletcher engine, only complete blocks after the first are
+** scanned for content defined cuts, since we need sum_window bytes of
+** input to roll the window forward.  A partial block at the end of the
+** input is only subject to maximum size cuts.
+*/
 {
-    PyObject *res;
+    size_t scan_end, end;
+    offset_t forced_cut_at;
 
-    res = PycStringIO->cgetvalue(cstringio);
-    Py_DECREF(cstringio);
-    return res;
+    // The stream offset of the last byte that can go in this segment.
+    forced_cut_at = fsss->maxseg_size ? fsss->seg_start + fsss->maxseg_size - 1 : (offset_t)-1;
+
+    scan_end = fsss->blk_len;
+    if (forced_cut_at < fsss->blk_start + scan_end)
+        scan_end = forced_cut_at - fsss->blk_start + 1;
+
+    if (fsss->engine == ENGINE_GEAR)
+        end = gear_scan(fsss, scan_end);
+    else if (fsss->blk_len == fsss->sum_window && fsss->blk_num > 0)
+        end = fletcher_scan(fsss, scan_end);
+    else
+        end = scan_end;
+
+    if (fsss->blk_start + end - 1 == forced_cut_at && end > fsss->blk_pos) {
+        fsss->seg_start = forced_cut_at + 1;
+    }
+    return end - fsss->blk_pos;
+}
+
+static int
+next_segment(fss_state *fsss)
+/* Accumulate the next segment, continuing any partial segment.  Doesn't
+** touch any Python objects, so that it can run without the GIL.  Returns
+** 0 on success, NEED_ARENA_SPACE if the current arena is too small for the
+** segment, or an errno value on failure.
+*/
+{
+    offset_t seg_start;
+    size_t seg_bytes, most_bytes;
+    int err;
+
+    for (;;) {
+        if (fsss->blk_pos == fsss->blk_len) {
+            if (fsss->eof) {
+                // Whatever's left is the final segment, even if it's empty.
+                fsss->done = 1;
+                return 0;
+            }
+            err = next_block(fsss);
+            if (err)
+                return err;
+            continue;
+        }
+
+        if (fsss->input) {
+            // Make sure that whatever scan_block() puts in the segment
+            // will fit in the arena.
+            most_bytes = fsss->blk_len - fsss->blk_pos;
+            if (fsss->maxseg_size && most_bytes > fsss->maxseg_size - fsss->seg_len)
+                most_bytes = fsss->maxseg_size - fsss->seg_len;
+            if (fsss->arena_used + fsss->seg_len + most_bytes > fsss->arena_size)
+                return NEED_ARENA_SPACE;
+        }
+
+        seg_start = fsss->seg_start;
+        seg_bytes = scan_block(fsss);
+        if (fsss->input) {
+            memcpy(fsss->arena_data + fsss->arena_used + fsss->seg_len, fsss->blk + fsss->blk_pos, seg_bytes);
+        }
+        fsss->seg_len += seg_bytes;
+        fsss->blk_pos += seg_bytes;
+
+        if (fsss->seg_start != seg_start) {
+            // Found the end of the segment somewhere in this block
+            return 0;
+        }
+    }
+}
+
+static int
+switch_arena(fss_state *fsss, size_t need)
+/* Move the current partial segment to an arena with at least need bytes
+** free after it, reusing an arena from the pool if possible.  Returns 0 on
+** success, -1 with a Python exception set on error.
+*/
+{
+    Py_ssize_t i;
+    size_t want = fsss->seg_len + need;
+    PyObject *arena = NULL, *a;
+
+    for ( i=0 ; i<PyList_GET_SIZE(fsss->arenas) ; i++ ) {
+        a = PyList_GET_ITEM(fsss->arenas, i);
+        if (a != fsss->arena && Py_REFCNT(a) == 1 && (size_t)PyByteArray_GET_SIZE(a) >= want) {
+            arena = a;
+            break;
+        }
+    }
+    if (!arena) {
+        arena = PyByteArray_FromStringAndSize(NULL, want > fsss->default_arena_size ? want : fsss->default_arena_size);
+        if (!arena)
+            return -1;
+        i = PyList_Append(fsss->arenas, arena);
+        Py_DECREF(arena);
+        if (i < 0)
+            return -1;
+    }
+
+    if (fsss->seg_len)
+        memcpy(PyByteArray_AS_STRING(arena), fsss->arena_data + fsss->arena_used, fsss->seg_len);
+    fsss->arena = arena;
+    fsss->arena_data = (unsigned char *)PyByteArray_AS_STRING(arena);
+    fsss->arena_size = PyByteArray_GET_SIZE(arena);
+    fsss->arena_used = 0;
+    return 0;
 }
 
 static PyObject *
 fletcher_sum_split_readsegment(PyObject *self, PyObject *args)
 {
     fss_state *fsss;
-    PyObject *pobj, *complete_seg_outbuf, *newoutbuf;
-    unsigned char *tmp;
-    charsum_t char_sum;
-    unsigned int gotbytes, newseg_bytes =0;
-    fletchsum_mp_t fletch_sum;
-    int i, blockstart_bytes_into_seg;
+    PyObject *pobj, *seg;
+    offset_t seg_start;
+    size_t need;
+    int err;
 
     if (!PyArg_ParseTuple(args, "O", &pobj))
         return NULL;
@@ -316,119 +796,165 @@ fletcher_sum_split_readsegment(PyObject *self, PyObject *args)
     if (!fsss)
         return NULL;
 
-    if (fsss->eof) {
-        if (fsss->outbuf) {
-            pobj = convert_cstringio_to_string(fsss->outbuf);
-            fsss->outbuf = NULL;
-            return pobj;
-        } else {
-            Py_RETURN_NONE;
-        }
-    }
+    if (fsss->done)
+        Py_RETURN_NONE;
 
-    char_sum = fsss->char_sum;
-    fletch_sum = fsss->fletch_sum;
+    seg_start = fsss->seg_start;
     for (;;) {
+        if (fsss->input) {
+            // Room for a maximum size segment, or at least for a block.
+            need = fsss->maxseg_size ? fsss->maxseg_size : fsss->sum_window;
+            if (fsss->seg_len) {
+                // Not enough room to finish the segment, double it.
+                need = fsss->seg_len > need ? fsss->seg_len : need;
+            }
+            if (!fsss->arena || fsss->arena_size - fsss->arena_used - fsss->seg_len < need) {
+                if (switch_arena(fsss, need) < 0)
+                    return NULL;
+            }
+        }
+
         Py_BEGIN_ALLOW_THREADS
-        gotbytes = fread(fsss->blk, 1, SUM_WINDOW, fsss->input);
+        err = next_segment(fsss);
         Py_END_ALLOW_THREADS
-        if (gotbytes < SUM_WINDOW) {
-            fsss->eof = 1;
-            if (PycStringIO->cwrite(fsss->outbuf, (const char *)fsss->blk, gotbytes) != gotbytes)
-                return NULL;
-            pobj = fsss->outbuf;
-            fsss->outbuf = NULL;
-            return convert_cstringio_to_string(pobj);
-        }
+        if (err != NEED_ARENA_SPACE)
+            break;
+    }
+    if (err) {
+        errno = err;
+        return PyErr_SetFromErrno(err == ENOMEM ? PyExc_MemoryError : PyExc_IOError);
+    }
 
-        complete_seg_outbuf = NULL;
-        blockstart_bytes_into_seg = fsss->bytes_into_seg;
-        for ( i=0 ; i<SUM_WINDOW ; i++ ) {
-            char_sum += fsss->blk[i] - fsss->prev_blk[i];
-            fletch_sum += char_sum + fsss->precomputed_remove_oldbyte[fsss->prev_blk[i]];
-            fletch_sum %= PRIME;
+    if (fsss->input) {
+        seg = PyBuffer_FromObject(fsss->arena, fsss->arena_used, fsss->seg_len);
+        fsss->arena_used += fsss->seg_len;
+    } else {
+        seg = PyBuffer_FromObject(fsss->source, seg_start, fsss->seg_len);
+    }
+    fsss->seg_len = 0;
+    return seg;
+}
 
-            if (fletch_sum == 0) {
-                if (blockstart_bytes_into_seg + i > fsss->last_hit_at + MINSEGSIZE) {
-                    // End of segment pattern found.
-                    // Split this block between the current segment and a new segment.
-                    if (complete_seg_outbuf) {
-                        PyErr_SetString(PyExc_AssertionError, "multiple segment end patterns in a block, should be impossible");
-                        return NULL;
-                    }
-                    if (PycStringIO->cwrite(fsss->outbuf, (const char *)fsss->blk, i+1) != i+1)
-                        return NULL;
-                    newoutbuf = PycStringIO->NewOutput(2 * MEAN_SEGMENT_SIZE);
-                    if (!newoutbuf)
-                        return NULL;
-                    newseg_bytes = SUM_WINDOW - (i+1);
-                    if (newseg_bytes > 0) {
-                        if (PycStringIO->cwrite(newoutbuf, (const char *)(fsss->blk+i+1), newseg_bytes) != newseg_bytes)
-                            return NULL;
-                    }
-                    complete_seg_outbuf = fsss->outbuf;
-                    fsss->outbuf = newoutbuf;
-                    blockstart_bytes_into_seg = 0 - i;
-                }
-                fsss->last_hit_at = blockstart_bytes_into_seg + i;
-            }
-        }
-        tmp = fsss->blk;
-        fsss->blk = fsss->prev_blk;
-        fsss->prev_blk = tmp;
-        fsss->bytes_into_seg = blockstart_bytes_into_seg + SUM_WINDOW;
-
-        if (complete_seg_outbuf) {
-            // Found the end of segment pattern somewhere in this block
-            fsss->char_sum = char_sum;
-            fsss->fletch_sum = fletch_sum;
-            fsss->bytes_into_seg = newseg_bytes;
-            return convert_cstringio_to_string(complete_seg_outbuf);
-        } else {
-            // No end of segment, this entire block goes in the current segment
-            if (PycStringIO->cwrite(fsss->outbuf, (const char *)fsss->prev_blk, SUM_WINDOW) != SUM_WINDOW)
-                return NULL;
-        }
+/* Parallel scanning
+** =================
+**
+** The sum at each byte depends only on the sum_window bytes up to it, so
+** separate stretches of a seekable input can be scanned for zero sums
+** independently, and in parallel.  Where the segments end depends on
+** the zeros in sequence, but zeros are rare so that part is cheap.
+**
+** The same goes for the gear engine, with GEAR_WINDOW bytes of context and
+** the bytes at which the tested bits of the hash are zero.
+*/
+
+static int
+append_pos(Py_ssize_t **list, Py_ssize_t *len, Py_ssize_t *size, Py_ssize_t pos)
+/* Append to a growable array of offsets, returning -1 if out of memory */
+{
+    Py_ssize_t *newlist;
+
+    if (*len == *size) {
+        newlist = realloc(*list, 2 * *size * sizeof(**list));
+        if (!newlist)
+            return -1;
+        *list = newlist;
+        *size *= 2;
     }
+    (*list)[(*len)++] = pos;
+    return 0;
 }
 
-/*
 static PyObject *
-fletcher_sum_split_diagstuff(PyObject *self, PyObject *args)
+fletcher_sum_split_find_zeros(PyObject *self, PyObject *args, PyObject *kwds)
 {
-    unsigned char *splurge;
-    int i;
+    static char *kwlist[] = {"source", "min_seg_bits", "start", "end", "engine", NULL};
     fss_state fsss;
+    const char *engine = "fletcher";
+    gear_t h = 0;
+    PyObject *source, *res, *pos_obj;
+    const void *source_data;
+    const unsigned char *data;
+    Py_ssize_t source_len, start, end, i, nzeros = 0, zeros_size = 64, *zeros;
+    sum_t char_sum, fletch_sum;
+    int minseg_bits;
+    Py_ssize_t window;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Oinn|s", kwlist, &source, &minseg_bits, &start, &end, &engine))
+        return NULL;
+    if (init_engine(&fsss, engine, minseg_bits) < 0)
+        return NULL;
+    if (PyObject_AsReadBuffer(source, &source_data, &source_len) < 0)
+        return NULL;
+    data = source_data;
 
-    fprintf(stderr, "MINSEGSIZE_BITS=%d, MINSEGSIZE=%d\n", MINSEGSIZE_BITS, MINSEGSIZE);
-    fprintf(stderr, "SUM_WINDOW_BITS=%d, SUM_WINDOW=%d, PRIME=%d\n", SUM_WINDOW_BITS, SUM_WINDOW, PRIME);
-    fprintf(stderr, "CHARSUM_BITS=%d, FLETCHSUM_BITS=%d, FLETCHSUM_MODPRIME_BITS=%d\n", CHARSUM_BITS, FLETCHSUM_BITS, FLETCHSUM_MODPRIME_BITS);
-    fprintf(stderr, "sizeof(charsum_t)=%lu, sizeof(fletchsum_t)=%lu, sizeof(fletchsum_mp_t)=%lu\n", sizeof(charsum_t), sizeof(fletchsum_t), sizeof(fletchsum_mp_t));
-
-    splurge = malloc(SUM_WINDOW);
-    for ( i=0 ; i<SUM_WINDOW ; i++ ) {
-        splurge[i] = i % 256;
+    window = fsss.engine == ENGINE_GEAR ? GEAR_WINDOW : (Py_ssize_t)fsss.sum_window;
+    if (start + 1 < window || end > source_len) {
+        PyErr_SetString(PyExc_ValueError, "range must start at least a full window in and end within the source");
+        return NULL;
     }
 
-    for ( i=0 ; i<3000 ; i++ ) {
-        sums_from_scratch(&fsss, splurge);
-        splurge[i] += fsss.char_sum % 128;
+    zeros = malloc(zeros_size * sizeof(*zeros));
+    if (!zeros)
+        return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS
+    if (fsss.engine == ENGINE_GEAR) {
+        for ( i=start+1-window ; i<end ; i++ ) {
+            h = (h << 1) + gear_table[data[i]];
+            if (i >= start && !(h & fsss.gear_mask)) {
+                if (append_pos(&zeros, &nzeros, &zeros_size, i) < 0) {
+                    nzeros = -1;
+                    break;
+                }
+            }
+        }
+    } else if (start < end) {
+        // The sums over the window ending at start.
+        sums_from_scratch(&fsss, (unsigned char *)data + start + 1 - fsss.sum_window);
+        char_sum = fsss.char_sum;
+        fletch_sum = fsss.fletch_sum;
+        for ( i=start ; i<end ; i++ ) {
+            if (i > start) {
+                char_sum += data[i] - data[i-fsss.sum_window];
+                fletch_sum = mod_prime(&fsss, fletch_sum + char_sum + fsss.precomputed_remove_oldbyte[data[i-fsss.sum_window]]);
+            }
+            if (fletch_sum == 0) {
+                if (append_pos(&zeros, &nzeros, &zeros_size, i) < 0) {
+                    nzeros = -1;
+                    break;
+                }
+            }
+        }
+    }
+    Py_END_ALLOW_THREADS
+    if (nzeros < 0) {
+        free(zeros);
+        return PyErr_NoMemory();
     }
 
-    Py_RETURN_NONE;
+    res = PyList_New(nzeros);
+    for ( i=0 ; res && i<nzeros ; i++ ) {
+        pos_obj = PyInt_FromSsize_t(zeros[i]);
+        if (!pos_obj) {
+            Py_CLEAR(res);
+            break;
+        }
+        PyList_SET_ITEM(res, i, pos_obj);
+    }
+    free(zeros);
+    return res;
 }
-*/
 
 static PyMethodDef fletcher_sum_split_methods[] = {
-    {"new",  fletcher_sum_split_new, METH_VARARGS, "create a new segment reader"},
-    {"readsegment",  fletcher_sum_split_readsegment, METH_VARARGS, "read the next segment"},
-    /* {"diagstuff",  fletcher_sum_split_diagstuff, METH_VARARGS, "output diagnostics"}, */
+    {"new",  (PyCFunction)fletcher_sum_split_new, METH_VARARGS | METH_KEYWORDS, "create a new segment reader: new(fd_or_buffer, min_seg_bits=20, max_seg_size=0, engine='fletcher')"},
+    {"readsegment",  fletcher_sum_split_readsegment, METH_VARARGS, "read the next segment, as a read-only buffer"},
+    {"find_zeros",  (PyCFunction)fletcher_sum_split_find_zeros, METH_VARARGS | METH_KEYWORDS, "list the offsets in a range of a buffer at which the sum is zero: find_zeros(buffer, min_seg_bits, start, end, engine='fletcher')"},
     {NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
 void
 initfletcher_sum_split(void)
 {
-    PycString_IMPORT;
+    init_gear_table();
     Py_InitModule("indumpco.fletcher_sum_split", fletcher_sum_split_methods);
 }
@@ -1,14 +1,38 @@
 
-import os, hashlib, sys, zlib, lzma, re
+import os, hashlib, sys, zlib, re, stat, mmap, threading, tempfile, shutil, time
+from collections import OrderedDict
 import fletcher_sum_split
 import file_format
-from pll_pipe import parallel_pipe
+from pll_pipe import parallel_pipe, parallel_unordered, process_pipe, ProcessPool
 from qa_caching_q import QACacheQueue, NOT_IN_CACHE
+from block_catalog import BlockCatalog
+from parallel_split import split_mapping_in_parallel
+from chunkers import get_chunker, DEFAULT_ENGINE
+from sections import SectionMapper, scan_segment
+from dump_file import DumpFile, DEFAULT_CACHE_BYTES
+from compression import AdaptivePolicy
+from delta import DeltaEncoder, sketch, link_block_chain, DEFAULT_MAX_DELTA_DEPTH
+from recipes import RecipeWriter
+from digest_set import load_digest_set
+from storage import Prefetcher, upload_block_tree
+from readahead import ReadAhead
+from stats import NULL_STATS
 
 class Error(Exception):
     pass
 
-def split_filehandle_into_segments(src_file):
+DEFAULT_MIN_SEG_BITS = 20
+DEFAULT_MAX_SEG_SIZE = 16 << 20
+
+# The default budget for segments held by extract_dump() for reuse
+DEFAULT_EXTRACT_CACHE_BYTES = 256 << 20
+
+# The most segment data that create_dump() and extract_dump() have in
+# their worker pipelines at once
+PIPE_BYTES = 128 << 20
+
+def split_filehandle_into_segments(src_file, min_seg_bits=DEFAULT_MIN_SEG_BITS, max_seg_size=DEFAULT_MAX_SEG_SIZE, scan_threads=1,
+                                   engine=DEFAULT_ENGINE):
     """ Read an open file to EOF, split it repeatably into segments
 
         A generator function to read src_file to EOF, and return the data
@@ -27,60 +51,330 @@ def split_filehandle_into_segments(src_file):
         since it allows compressed segments from a previous day's dump to
         be reused for the parts of the dump that have not changed.
 
-        The minimum segment length is 1M, and the mean segment length is
-        about 4M.
+        By default the minimum segment length is 1M, the mean segment
+        length is about 4M and the maximum is 16M.  The minimum is
+        2**min_seg_bits, and the mean scales with it.  A max_seg_size of
+        0 means no maximum.
+
+        The engine names the content defined chunking method, see
+        chunkers.ENGINES.  The "gear" engine is several times faster than
+        the default "fletcher" engine, but places boundaries differently.
+
+        The segments are read-only buffer objects.  If src_file is a
+        regular file it's memory mapped and the segments are views of the
+        mapping, otherwise they share pooled memory that is reused once
+        they have been discarded.
+
+        A regular file is scanned for segment boundaries by scan_threads
+        threads in parallel, with the same result as a sequential scan.
     """
-    fss = fletcher_sum_split.new(src_file.fileno())
+    chunker = get_chunker(engine, min_seg_bits, max_seg_size)
+    src = _mmap_regular_file(src_file)
+    if src is None:
+        src = src_file.fileno()
+    elif scan_threads > 1:
+        for seg in split_mapping_in_parallel(src, chunker, scan_threads):
+            yield seg
+        return
+    fss = chunker.reader(src)
     while True:
         seg = fletcher_sum_split.readsegment(fss)
         if seg is None:
             return
         yield seg
 
-def repack_blocks(blockdir, repack_sums):
-    idxlines = []
-    compound_data = ''
-    for s in repack_sums:
-        seg_data = file_format.decompress_zfile_to_string(os.path.join(blockdir, s))
-        idxlines.append(file_format.pack_idxline(len(seg_data), s))
-        compound_data += seg_data
-
-    compound_sum = hashlib.md5(compound_data).hexdigest()
-    compressed_data = lzma.compress(compound_data)
-    del compound_data
-        
-    compound_file = os.path.join(blockdir, compound_sum)
-    f = open(compound_file, 'w')
-    f.write('x%s\n%d\n%s' % (compound_sum, len(idxlines), ''.join(idxlines)))
-    f.write(compressed_data)
-    f.close()
+def _mmap_regular_file(src_file):
+    # Map the rest of src_file into memory, if it's a non-empty regular file.
+    fd = src_file.fileno()
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    pos = os.lseek(fd, 0, os.SEEK_CUR)
+    if pos >= st.st_size:
+        return None
+    mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    if pos:
+        return buffer(mapping, pos)
+    return mapping
+
+def repack_blocks(blockdir, repack_sums, catalog_file=None, split_streams=False):
+    """ Repack some z blocks in blockdir as one x group block, or as a y
+        group block with split_streams
+
+        An x group is one lzma stream, which compresses a little better.
+        In a y group each segment can be decompressed on its own, but
+        readers older than the y group format can't read it.
+    """
+    bd = file_format.BlockDir(blockdir)
+    tmp = file_format.tmp_filename(bd.writable_filename(hashlib.md5(''.join(repack_sums)).hexdigest()))
+    seg_pieces = (file_format.iter_zfile_pieces(bd.filename(s)) for s in repack_sums)
+    compound_sum, _, _ = file_format.write_group_file(tmp, repack_sums, seg_pieces, split_streams)
+    compound_file = bd.writable_filename(compound_sum)
+    os.rename(tmp, compound_file)
 
     for s in repack_sums:
-        f =  os.path.join(blockdir, s)
+        f = bd.filename(s)
         os.link(compound_file, f+'.tmp')
         os.rename(f+'.tmp', f)
 
-def _blockdir(dump_rootdir):
-    return os.path.join(dump_rootdir, 'blocks')
+    if catalog_file is not None:
+        catalog = BlockCatalog(catalog_file)
+        catalog.add(compound_sum, compound_file)
+        catalog.commit()
+        catalog.close()
+
+def migrate_to_store(dumpdir, store_dir):
+    """ Move the blocks of a dump into a shared block store
+
+        Each block is hardlinked into the store unless the store already
+        has a block for its digest, then the dump is pointed at the store,
+        and only then is its own block directory removed.  A dump already
+        using a store is left alone.
+    """
+    if os.path.exists(os.path.join(dumpdir, 'store')):
+        return
+    store = file_format.BlockDir(store_dir)
+    if not isinstance(store, file_format.FanoutBlockDir):
+        raise Error("not a shared block store", store_dir)
+    blkdir = os.path.join(dumpdir, 'blocks')
+    for seg_sum, path in file_format.BlockDir(blkdir).listing():
+        dest_path = store.writable_filename(seg_sum)
+        if not os.path.exists(dest_path):
+            os.link(path, dest_path)
+    file_format.write_store(dumpdir, store_dir)
+    shutil.rmtree(blkdir)
 
-def extract_dump(dumpdir, extra_block_dirs=[], thread_count=4):
+def extract_dump(dumpdir, extra_block_dirs=[], thread_count=4, catalog_file=None,
+                 cache_bytes=DEFAULT_EXTRACT_CACHE_BYTES, spill_dir=None, storage=None,
+                 readahead=0, reorder_reads=False, controller=None, stats=None):
     """ Generator function for restoring a compressed dump
 
         Concatenate the values yielded by this generator to get the
         decompressed dump.
+
+        Segments that come up again soon, including those unpacked from x
+        groups ahead of need, are held for reuse up to cache_bytes.  Over
+        that, the segments needed furthest ahead are dropped and
+        decompressed again later, or written to a temporary file in
+        spill_dir if it's given.
+
+        If storage is given, a storage.StorageBase, blocks that aren't in
+        any local block directory are fetched from it, a few index
+        positions ahead of need, see storage.Prefetcher.
+
+        If readahead is non-zero, the block files of the next readahead
+        index positions are hinted to the kernel as soon to be needed, in
+        inode order if reorder_reads is true, see readahead.ReadAhead.
+
+        If controller is given, a pll_pipe.ConcurrencyController, it
+        decides how many worker threads are active rather than
+        thread_count.
+
+        If stats is given, a stats.Stats, the time spent finding and
+        unpacking blocks and the extract's cache and pipeline figures are
+        recorded in it.
+    """
+    idxlines = open(os.path.join(dumpdir, 'index'))
+    return _extract_idxlines(dumpdir, idxlines, extra_block_dirs, thread_count, catalog_file, cache_bytes, spill_dir,
+                             storage, readahead, reorder_reads, controller, stats)
+
+def extract_dump_to_file(dumpdir, out_path, extra_block_dirs=[], thread_count=4, catalog_file=None):
+    """ Restore a compressed dump to a file, decompressing segments out of order
+
+        The file is truncated to the length of the dump up front, and each
+        worker thread writes the segments it decompresses straight to
+        their offsets in the file, through a file descriptor of its own.
+        There's no reordering of segments, so a slow block only holds up
+        the thread decompressing it.  Each x group block is decompressed
+        once, by whichever thread gets to it first, but the segments of
+        a y group are shared out between threads.
+    """
+    # The offsets in the dump at which each distinct segment appears
+    seg_offsets = OrderedDict()
+    total_len = 0
+    for idxline in open(os.path.join(dumpdir, 'index')):
+        seg_len, seg_sum = file_format.unpack_idxline(idxline)
+        seg_offsets.setdefault(idxline, []).append(total_len)
+        total_len += seg_len
+
+    fd = os.open(out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    try:
+        os.ftruncate(fd, total_len)
+    finally:
+        os.close(fd)
+
+    catalog = None
+    if catalog_file is not None and os.path.exists(catalog_file):
+        catalog = BlockCatalog(catalog_file)
+    blk_search_path = file_format.BlockSearchPath([file_format.dump_blockdir(dumpdir)] + extra_block_dirs, catalog)
+    claimed = set()
+    lock = threading.Lock()
+    worker_fds = []
+    local = threading.local()
+
+    def _write_seg(idxline, seg):
+        if not hasattr(local, 'fd'):
+            local.fd = os.open(out_path, os.O_WRONLY)
+            with lock:
+                worker_fds.append(local.fd)
+        for offset in seg_offsets[idxline]:
+            os.lseek(local.fd, offset, os.SEEK_SET)
+            written = 0
+            while written < len(seg):
+                written += os.write(local.fd, buffer(seg, written))
+
+    def _extract_idxline(idxline):
+        with lock:
+            if idxline in claimed:
+                return
+            claimed.add(idxline)
+        seg_len, seg_sum = file_format.unpack_idxline(idxline)
+        blk_filename = blk_search_path.find_block(seg_sum)
+        if blk_filename is None:
+            raise Error("block not found", (dumpdir, seg_sum))
+        blk_file_reader = file_format.BlockFileRead(seg_sum, blk_filename)
+        if blk_file_reader.is_y_group:
+            # The group's other segments are left to other threads.
+            _write_seg(idxline, blk_file_reader.y_unpack_seg(idxline))
+        elif blk_file_reader.is_x_group:
+            with lock:
+                mine = set([i for i in blk_file_reader.extra_idxlines if i in seg_offsets and i not in claimed])
+                claimed.update(mine)
+            mine.add(idxline)
+            got = 0
+            for got_idxline, got_seg in blk_file_reader.x_unpack_segs(mine):
+                _write_seg(got_idxline, got_seg)
+                got += 1
+            if got != len(mine):
+                raise RuntimeError("didn't get expected idxlines", (blk_filename, repr(mine)))
+        else:
+            _write_seg(idxline, blk_file_reader.z_unpack_seg())
+
+    try:
+        parallel_unordered(seg_offsets, _extract_idxline, thread_count)
+    finally:
+        for fd in worker_fds:
+            os.close(fd)
+
+def extract_range(dumpdir, offset, length=None, extra_block_dirs=[], thread_count=4, catalog_file=None):
+    """ Generator function for restoring part of a compressed dump
+
+        Like extract_dump(), but yields only the length bytes starting at
+        offset in the decompressed dump, or everything from offset on if
+        length is None.  Only the segments that overlap the range are read
+        and decompressed.
+    """
+    end = None if length is None else offset + length
+    idxlines = []
+    skip = 0
+    seg_start = 0
+    for idxline in open(os.path.join(dumpdir, 'index')):
+        if end is not None and seg_start >= end:
+            break
+        seg_len, seg_sum = file_format.unpack_idxline(idxline)
+        if seg_start + seg_len > offset:
+            if not idxlines:
+                skip = offset - seg_start
+            idxlines.append(idxline)
+        seg_start += seg_len
+    # The bytes wanted from the last segment.
+    remaining = None if end is None else end - offset
+
+    for seg in _extract_idxlines(dumpdir, idxlines, extra_block_dirs, thread_count, catalog_file):
+        if skip:
+            seg = seg[skip:]
+            skip = 0
+        if remaining is not None:
+            seg = seg[:remaining]
+            remaining -= len(seg)
+        yield seg
+
+def extract_table(dumpdir, table, extra_block_dirs=[], thread_count=4, catalog_file=None):
+    """ Generator function for restoring the sections of a dump for one table
+
+        The dump must have been created with a section map.  Yields the
+        table's CREATE TABLE statement and COPY data, as recorded in the
+        map.
     """
-    blk_search_path = file_format.BlockSearchPath([_blockdir(dumpdir)] + extra_block_dirs)
-    idxline_qa_iter = QACacheQueue(src_iterable = open(os.path.join(dumpdir, 'index')))
+    sections = file_format.read_sections(dumpdir)
+    if sections is None:
+        raise Error("dump has no section map", dumpdir)
+    wanted = [(start, end) for start, end, kind, name in sections if name == table]
+    if not wanted:
+        raise Error("table not found in section map", (dumpdir, table))
+    for start, end in wanted:
+        for seg in extract_range(dumpdir, start, end - start, extra_block_dirs, thread_count, catalog_file):
+            yield seg
+
+def open_dump(dumpdir, extra_block_dirs=[], catalog_file=None, cache_bytes=DEFAULT_CACHE_BYTES):
+    """ Open a compressed dump as a read-only, seekable file object
+
+        Segments are decompressed as they are read, and up to cache_bytes
+        of decompressed segments are kept for rereading.
+    """
+    catalog = None
+    if catalog_file is not None and os.path.exists(catalog_file):
+        catalog = BlockCatalog(catalog_file)
+    return DumpFile(dumpdir, extra_block_dirs, catalog, cache_bytes)
+
+def _idxline_seg_len(idxline):
+    return file_format.unpack_idxline(idxline)[0]
+
+def _pos_idxline_seg_len(pos_idxline):
+    return _idxline_seg_len(pos_idxline[1])
+
+def _extract_idxlines(dumpdir, idxlines, extra_block_dirs, thread_count, catalog_file,
+                      cache_bytes=DEFAULT_EXTRACT_CACHE_BYTES, spill_dir=None, storage=None,
+                      readahead=0, reorder_reads=False, controller=None, stats=None):
+    if stats is None:
+        stats = NULL_STATS
+    catalog = None
+    if catalog_file is not None and os.path.exists(catalog_file):
+        catalog = BlockCatalog(catalog_file)
+    blk_search_path = file_format.BlockSearchPath([file_format.dump_blockdir(dumpdir)] + extra_block_dirs, catalog)
+    prefetcher, read_ahead = None, None
+    if storage is not None or readahead:
+        idxlines = list(idxlines)
+        seg_sums = [file_format.unpack_idxline(idxline)[1] for idxline in idxlines]
+    if storage is not None:
+        fetch_dir = tempfile.mkdtemp(dir=spill_dir)
+        prefetcher = Prefetcher(storage, seg_sums, blk_search_path, fetch_dir, thread_count=thread_count)
+    if readahead:
+        read_ahead = ReadAhead(blk_search_path, seg_sums, readahead, reorder_reads)
+    spill_file = None
+    if spill_dir is not None:
+        spill_file = tempfile.TemporaryFile(dir=spill_dir)
+    # Looking further ahead than the cache can hold gains little.
+    idxline_qa_iter = QACacheQueue(src_iterable = idxlines, max_bytes=cache_bytes,
+                                   lookahead_bytes=4 * cache_bytes, question_size=_idxline_seg_len,
+                                   spill_file=spill_file)
 
-    def _idxline_processor(outq, idxline):
+    def _idxline_processor(outq, pos_idxline):
+        pos, idxline = pos_idxline
+        if read_ahead is not None:
+            read_ahead.advance(pos)
         seg = idxline_qa_iter.consume_cached_answer(idxline)
         if seg is NOT_IN_CACHE:
             seg_len, seg_sum = file_format.unpack_idxline(idxline)
-            blk_filename = blk_search_path.find_block(seg_sum)
-            blk_file_reader = file_format.BlockFileRead(seg_sum, blk_filename)
-            if idxline_qa_iter.i_should_compute(idxline, blk_file_reader.extra_idxlines):
+            with stats.timer('lookup'):
+                blk_filename = blk_search_path.find_block(seg_sum)
+                if blk_filename is None and prefetcher is not None:
+                    blk_filename = prefetcher.find_block(seg_sum)
+                if read_ahead is not None:
+                    blk_file_reader = read_ahead.open_block(seg_sum, blk_filename)
+                else:
+                    blk_file_reader = file_format.BlockFileRead(seg_sum, blk_filename)
+            # The segments of a y group are decompressed separately, as
+            # they come up, so that workers can share out a group.
+            byproduct_idxlines = blk_file_reader.extra_idxlines
+            if blk_file_reader.is_y_group:
+                byproduct_idxlines = set()
+            if idxline_qa_iter.i_should_compute(idxline, byproduct_idxlines):
                 extra_idxline_seg = []
-                if blk_file_reader.is_x_group:
+                unpack_start = time.time() if stats.enabled else None
+                if blk_file_reader.is_y_group:
+                    seg = blk_file_reader.y_unpack_seg(idxline)
+                elif blk_file_reader.is_x_group:
                     want_idxline_set = set([idxline]) | blk_file_reader.extra_idxlines
                     for got_idxline, got_seg in blk_file_reader.x_unpack_segs(want_idxline_set):
                         if got_idxline == idxline:
@@ -91,49 +385,252 @@ def extract_dump(dumpdir, extra_block_dirs=[], thread_count=4):
                         raise RuntimeError("didn't get expected idxline", (idxline, repr(want_idxline_set)))
                 else:
                     seg = blk_file_reader.z_unpack_seg()
+                if unpack_start is not None:
+                    stats.add_time('unpack', time.time() - unpack_start,
+                                   len(seg) + sum(len(s) for _, s in extra_idxline_seg))
                 idxline_qa_iter.i_have_computed(idxline, seg, extra_idxline_seg)
             else:
                 idxline_qa_iter.put_answer_when_ready(idxline, outq)
                 return
         outq.put(seg)
 
-    return parallel_pipe(idxline_qa_iter, _idxline_processor, thread_count)
+    # Jobs carry their index positions, which workers may reach out of order.
+    segs = parallel_pipe(enumerate(idxline_qa_iter), _idxline_processor, thread_count, max_bytes=PIPE_BYTES,
+                         job_size=_pos_idxline_seg_len, controller=controller, stats=stats if stats.enabled else None)
+    if prefetcher is None and read_ahead is None and not stats.enabled:
+        return segs
+    return _finish_extract(segs, prefetcher, read_ahead, idxline_qa_iter, stats)
+
+def _finish_extract(segs, prefetcher, read_ahead, idxline_qa_iter, stats):
+    try:
+        for seg in segs:
+            stats.count('output_bytes', len(seg))
+            yield seg
+    finally:
+        if read_ahead is not None:
+            read_ahead.close()
+        if prefetcher is not None:
+            prefetcher.close()
+            shutil.rmtree(prefetcher.fetch_dir)
+        for counter in ('hits', 'misses', 'evictions', 'spills', 'recomputes'):
+            stats.count('cache_' + counter, getattr(idxline_qa_iter, counter))
+
+def _analysed_seg_len(job):
+    return len(job[0])
+
+def _chunking_compatible(a, b):
+    # Dumps chunked with different content defined cut rules will have
+    # no segments in common.
+    return a['engine'] == b['engine'] and a['min_seg_bits'] == b['min_seg_bits']
+
+def create_dump(src_fh, outdir, dumpdirs_for_reuse=[], thread_count=8, remote_seg_list_file=None, catalog_file=None,
+                min_seg_bits=DEFAULT_MIN_SEG_BITS, max_seg_size=DEFAULT_MAX_SEG_SIZE, engine=DEFAULT_ENGINE,
+                section_map=False, compression_policy=None, delta_blocks=False, max_delta_depth=DEFAULT_MAX_DELTA_DEPTH,
+                sub_seg_bits=None, store=None, storage=None, controller=None, stats=None, process_count=None):
+    """ Compress the data read from src_fh into a new dump in outdir
+
+        The chunking engine and parameters are recorded in the dump, and
+        previous dumps that were chunked incompatibly are not searched
+        for blocks to reuse.
+
+        If catalog_file is given, a block_catalog.BlockCatalog in that file
+        is used to find blocks for reuse.  Any reuse dump that the catalog
+        doesn't yet cover is added to it first, and the blocks of the new
+        dump are added to it once the dump is complete.
+
+        If section_map is true, the input is taken to be a plain format
+        pg_dump and a map of its table sections is recorded in the dump,
+        for extract_table().
 
-def create_dump(src_fh, outdir, dumpdirs_for_reuse=[], thread_count=8, remote_seg_list_file=None):
+        New blocks are written as compression_policy decides, see
+        compression.AdaptivePolicy, which is the default.
+
+        If delta_blocks is true, a sketch of each segment is recorded in
+        the dump, and a new segment that's similar to one with a sketch in
+        a reuse dump is written as a delta against it where that pays, see
+        delta.DeltaEncoder.  Restoring a segment never means resolving a
+        chain of more than max_delta_depth deltas.
+
+        If sub_seg_bits is given, a new segment that can't be written as a
+        delta is split again into chunks of about 4 * 2**sub_seg_bits
+        bytes, and written as a recipe of chunk blocks, reusing any chunks
+        already in a reuse dump, see recipes.RecipeWriter.
+
+        If store is given, it names a shared block store created by
+        file_format.create_fanout_blockdir().  The new dump has no block directory of its
+        own, its new blocks are written to the store, and only blocks
+        already in the store are reused, so no hardlinks are made.
+
+        If storage is given, a storage.StorageBase, each block of the new
+        dump is put to it as soon as the worker has written it, along with
+        any blocks it refers to, unless the storage already holds it.
+
+        If controller is given, a pll_pipe.ConcurrencyController, it
+        decides how many worker threads are active rather than
+        thread_count.
+
+        If stats is given, a stats.Stats, the time spent in each stage of
+        the work and counts of new and reused segments are recorded in it.
+
+        If process_count is given, the digests, sketches and section scans
+        of segments are worked out by a pll_pipe.ProcessPool of that many
+        processes ahead of the worker threads, and new blocks that aren't
+        deltas or recipes are written by the pool, so that the Python
+        level work per segment isn't all serialised on the GIL.
+    """
+    if stats is None:
+        stats = NULL_STATS
+    # Fork the pool before any threads are started.
+    pool = ProcessPool(process_count) if process_count else None
+    try:
+        _create_dump(src_fh, outdir, dumpdirs_for_reuse, thread_count, remote_seg_list_file, catalog_file,
+                     min_seg_bits, max_seg_size, engine, section_map, compression_policy, delta_blocks,
+                     max_delta_depth, sub_seg_bits, store, storage, controller, stats, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+
+def _analyse_segment(segment, want_sketch, want_sections):
+    # The digest of a segment, and its sketch and section scan if wanted,
+    # with the time taken by each, run by create_dump() workers or in a
+    # ProcessPool.
+    timings = []
+    start = time.time()
+    segsum = hashlib.md5(segment).hexdigest()
+    timings.append(('md5', time.time() - start, len(segment)))
+    seg_sketch, sections = None, None
+    if want_sketch:
+        start = time.time()
+        seg_sketch = sketch(segment)
+        timings.append(('sketch', time.time() - start, len(segment)))
+    if want_sections:
+        start = time.time()
+        sections = scan_segment(segment)
+        timings.append(('section_scan', time.time() - start, len(segment)))
+    return segsum, seg_sketch, sections, timings
+
+def _create_dump(src_fh, outdir, dumpdirs_for_reuse, thread_count, remote_seg_list_file, catalog_file,
+                 min_seg_bits, max_seg_size, engine, section_map, compression_policy, delta_blocks,
+                 max_delta_depth, sub_seg_bits, store, storage, controller, stats, pool):
+    chunking = {'engine': engine, 'min_seg_bits': min_seg_bits, 'max_seg_size': max_seg_size}
+    get_chunker(engine, min_seg_bits, max_seg_size)
     os.mkdir(outdir)
-    blkdir = _blockdir(outdir)
-    os.mkdir(blkdir)
+    file_format.write_chunking(outdir, chunking)
+    if store is not None:
+        file_format.write_store(outdir, store)
+    blkdir = file_format.dump_blockdir(outdir)
+    if store is None:
+        os.mkdir(blkdir)
+    block_dir = file_format.BlockDir(blkdir)
     idx_file = os.path.join(outdir, 'index')
     idx_fh = open(idx_file, 'w')
-    blk_reuse_dirs = [_blockdir(d) for d in dumpdirs_for_reuse]
+    if store is not None:
+        blk_reuse_dirs = [blkdir]
+    else:
+        blk_reuse_dirs = [file_format.dump_blockdir(d) for d in dumpdirs_for_reuse
+                          if _chunking_compatible(chunking, file_format.read_chunking(d))]
+
+    catalog = None
+    if catalog_file is not None:
+        catalog = BlockCatalog(catalog_file)
+        for d in blk_reuse_dirs:
+            if os.path.isdir(d) and not catalog.covers(d):
+                catalog.add_blockdir(file_format.BlockDir(d))
+        catalog.commit()
+    reuse_search_path = file_format.BlockSearchPath(blk_reuse_dirs, catalog, trust_catalog_misses=True)
 
     remote_segs = set()
     if remote_seg_list_file is not None:
-        for line in open(remote_seg_list_file):
-            remote_segs.add(line.strip())
-
-    def _seg_processor(q, segment):
-        segsum = hashlib.md5(segment).hexdigest()
-        dest_path = os.path.join(blkdir, segsum)
-        if segsum not in remote_segs and not os.path.exists(dest_path):
-            reuse_path = _block_for_reuse(blk_reuse_dirs, segsum)
-            if reuse_path is None:
-                file_format.compress_string_to_zfile(segment, dest_path)
+        remote_segs = load_digest_set(remote_seg_list_file)
+
+    mapper = SectionMapper() if section_map else None
+    delta_encoder = None
+    if delta_blocks:
+        reuse_dumpdirs = [d for d in dumpdirs_for_reuse if _chunking_compatible(chunking, file_format.read_chunking(d))]
+        delta_encoder = DeltaEncoder(reuse_dumpdirs, reuse_search_path, block_dir, catalog, max_delta_depth)
+    if compression_policy is None:
+        compression_policy = AdaptivePolicy()
+    recipe_writer = None
+    if sub_seg_bits is not None:
+        recipe_writer = RecipeWriter(engine, sub_seg_bits, reuse_search_path, block_dir, compression_policy, catalog)
+    uploaded = set()
+    upload_lock = threading.Lock()
+
+    want_sketch, want_sections = delta_encoder is not None, mapper is not None
+
+    def _seg_processor(q, job):
+        if pool is None:
+            segment = job
+            analysis = _analyse_segment(segment, want_sketch, want_sections)
+        else:
+            segment, analysis = job
+        segsum, seg_sketch, sections, timings = analysis
+        for stage, seconds, nbytes in timings:
+            stats.add_time(stage, seconds, nbytes)
+        seg_len = len(segment)
+        dest_path = block_dir.filename(segsum)
+        if segsum in remote_segs:
+            stats.count('remote_segments')
+        elif os.path.exists(dest_path):
+            stats.count('repeated_segments')
+        else:
+            with stats.timer('reuse_lookup'):
+                reuse_path = reuse_search_path.find_block(segsum)
+            if reuse_path is not None:
+                # A reused d or c block brings the blocks it refers to with it.
+                with stats.timer('link'):
+                    link_block_chain(reuse_path, segsum, block_dir, catalog)
+                stats.count('reused_segments')
             else:
-                os.link(reuse_path, dest_path)
-        q.put((segsum, len(segment)))
-        
-    src_iterator = split_filehandle_into_segments(src_fh)
-    pipe = parallel_pipe(src_iterator, _seg_processor, thread_count)
-    for segsum, seglen in pipe:
-        idx_fh.write(file_format.pack_idxline(seglen, segsum))
-
-def _block_for_reuse(blk_reuse_dirs, segsum):
-    for blkdir in blk_reuse_dirs:
-        reuse_path = os.path.join(blkdir, segsum)
-        if os.path.exists(reuse_path):
-            return reuse_path
-    return None
+                dest_path = block_dir.writable_filename(segsum)
+                tmp_path = file_format.tmp_filename(dest_path)
+                with stats.timer('compress', seg_len):
+                    if delta_encoder is None or not delta_encoder.write_delta(segment, seg_sketch, tmp_path):
+                        if recipe_writer is not None:
+                            recipe_writer.write_recipe(segment, tmp_path)
+                        else:
+                            compression_policy.compress_to_file(segment, tmp_path, pool)
+                    os.rename(tmp_path, dest_path)
+                stats.count('new_segments')
+            if catalog is not None:
+                catalog.add(segsum, dest_path)
+        if storage is not None and segsum not in remote_segs:
+            with stats.timer('upload'):
+                upload_block_tree(storage, dest_path, segsum, uploaded, upload_lock)
+        q.put((segsum, seg_len, sections, seg_sketch))
+
+    src_iterator = stats.timed_iter('split', split_filehandle_into_segments(src_fh, min_seg_bits, max_seg_size,
+                                                                            thread_count, engine))
+    pipe_stats = stats if stats.enabled else None
+    if pool is None:
+        pipe = parallel_pipe(src_iterator, _seg_processor, thread_count, max_bytes=PIPE_BYTES,
+                             controller=controller, stats=pipe_stats)
+    else:
+        # Segments are analysed by the pool before the worker threads take
+        # them, with the pipeline's memory split between the two stages.
+        analysed = process_pipe(src_iterator, _analyse_segment, pool, (want_sketch, want_sections),
+                                max_bytes=PIPE_BYTES // 2, stats=pipe_stats)
+        pipe = parallel_pipe(analysed, _seg_processor, thread_count, max_bytes=PIPE_BYTES // 2,
+                             job_size=_analysed_seg_len, controller=controller, stats=pipe_stats)
+    sketches = OrderedDict()
+    for segsum, seglen, sections, seg_sketch in pipe:
+        with stats.timer('index_write', seglen):
+            idx_fh.write(file_format.pack_idxline(seglen, segsum))
+        if mapper is not None:
+            mapper.add_segment(seglen, sections)
+        if seg_sketch is not None:
+            sketches[segsum] = seg_sketch
+    if mapper is not None:
+        file_format.write_sections(outdir, mapper.finish())
+    if delta_encoder is not None:
+        file_format.write_sketches(outdir, sketches.iteritems())
+    if storage is not None:
+        storage.flush()
+
+    if catalog is not None:
+        catalog.mark_covered(blkdir)
+        catalog.commit()
+        catalog.close()
 
     
 if __name__ == '__main__':
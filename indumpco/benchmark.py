@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import platform
+import resource
+import file_format
+import indumpco
+from repack import repack_blocks
+from workload import PgDumpWorkload
+
+# The stages timed on each day, in order
+STAGES = ('create', 'repack', 'extract')
+
+def _peak_rss_bytes():
+    # ru_maxrss is in KB on Linux and in bytes on OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+def segment_size_stats(seg_lens):
+    """ A summary of the distribution of segment sizes """
+    ordered = sorted(seg_lens)
+    return {
+        'count': len(ordered),
+        'mean': sum(ordered) / float(len(ordered)) if ordered else 0,
+        'min': ordered[0] if ordered else 0,
+        'p10': _percentile(ordered, 0.1),
+        'p50': _percentile(ordered, 0.5),
+        'p90': _percentile(ordered, 0.9),
+        'max': ordered[-1] if ordered else 0,
+    }
+
+class BenchmarkRun(object):
+    """
+    Runs a sequence of days through create_dump(), repack and
+    extract_dump(), with a PgDumpWorkload for the input, and measures each
+    stage.
+
+    Each day's dump reuses blocks from all of the days before it.  The
+    extract is checked against the input, and the input is deleted once
+    the day is done, so that only the dumps take up space in workdir.
+    Stored bytes are those in block files that no earlier day has, after
+    the repack, and peak RSS figures are for the process so far, so a
+    stage's figure only counts if it's higher than the stage before.
+    The results are a dict that can be saved as JSON and compared with
+    another run by compare_results().
+    """
+    def __init__(self, workdir, workload, days=5, thread_count=8, repack=True, create_kwargs={}):
+        self.workdir = workdir
+        self.workload = workload
+        self.days = days
+        self.thread_count = thread_count
+        self.repack = repack
+        self.create_kwargs = create_kwargs
+        # The (dev, ino) of every block file stored so far
+        self.stored_blocks = set()
+
+    def _reused_segments(self, dumpdir):
+        # The number of index entries whose blocks were stored by earlier days
+        bd = file_format.BlockDir(file_format.dump_blockdir(dumpdir))
+        reused = 0
+        for idxline in open(os.path.join(dumpdir, 'index')):
+            st = os.lstat(bd.filename(file_format.unpack_idxline(idxline)[1]))
+            if (st.st_dev, st.st_ino) in self.stored_blocks:
+                reused += 1
+        return reused
+
+    def _store_new_blocks(self, dumpdir):
+        # The bytes in block files that no earlier day has
+        bd = file_format.BlockDir(file_format.dump_blockdir(dumpdir))
+        new_bytes = 0
+        for seg_sum, path in bd.listing():
+            st = os.lstat(path)
+            key = (st.st_dev, st.st_ino)
+            if key not in self.stored_blocks:
+                self.stored_blocks.add(key)
+                new_bytes += st.st_size
+        return new_bytes
+
+    def run_day(self, day, prev_dumpdirs):
+        if day:
+            self.workload.advance()
+        input_file = os.path.join(self.workdir, 'input')
+        f = open(input_file, 'w')
+        input_len, input_md5 = self.workload.write(f)
+        f.close()
+        dumpdir = os.path.join(self.workdir, 'day%03d' % day)
+        result = {'day': day, 'input_bytes': input_len}
+        seconds = {}
+
+        start = time.time()
+        f = open(input_file)
+        indumpco.create_dump(f, dumpdir, prev_dumpdirs, self.thread_count, **self.create_kwargs)
+        f.close()
+        seconds['create'] = time.time() - start
+        result['create_peak_rss'] = _peak_rss_bytes()
+
+        seg_lens = [file_format.unpack_idxline(idxline)[0] for idxline in open(os.path.join(dumpdir, 'index'))]
+        result['segments'] = segment_size_stats(seg_lens)
+        result['reused_segments'] = self._reused_segments(dumpdir)
+
+        if self.repack:
+            start = time.time()
+            changes = list(repack_blocks(os.path.join(dumpdir, 'index'), file_format.dump_blockdir(dumpdir),
+                                         thread_count=self.thread_count))
+            seconds['repack'] = time.time() - start
+            result['repack_peak_rss'] = _peak_rss_bytes()
+            result['repacked_groups'] = len([size_change for _, size_change in changes if size_change < 0.9])
+        result['stored_bytes'] = self._store_new_blocks(dumpdir)
+        result['dedup_ratio'] = input_len / float(max(result['stored_bytes'], 1))
+
+        start = time.time()
+        md5 = hashlib.md5()
+        for seg in indumpco.extract_dump(dumpdir, thread_count=self.thread_count):
+            md5.update(seg)
+        seconds['extract'] = time.time() - start
+        result['extract_peak_rss'] = _peak_rss_bytes()
+        if md5.hexdigest() != input_md5:
+            raise RuntimeError("extracted dump doesn't match the input", dumpdir)
+        os.unlink(input_file)
+
+        result['seconds'] = seconds
+        result['mb_per_sec'] = dict((stage, input_len / float(1 << 20) / max(secs, 1e-6))
+                                    for stage, secs in seconds.iteritems())
+        return dumpdir, result
+
+    def run(self):
+        dumpdirs = []
+        day_results = []
+        for day in range(self.days):
+            dumpdir, result = self.run_day(day, list(dumpdirs))
+            dumpdirs.append(dumpdir)
+            day_results.append(result)
+        input_total = sum(r['input_bytes'] for r in day_results)
+        stored_total = sum(r['stored_bytes'] for r in day_results)
+        return {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'thread_count': self.thread_count,
+            'days': day_results,
+            'input_bytes': input_total,
+            'stored_bytes': stored_total,
+            'dedup_ratio': input_total / float(max(stored_total, 1)),
+            'mb_per_sec': dict((stage, _mean([r['mb_per_sec'][stage] for r in day_results
+                                              if stage in r['mb_per_sec']])) for stage in STAGES),
+            'peak_rss': _peak_rss_bytes(),
+        }
+
+def _mean(values):
+    if not values:
+        return None
+    return sum(values) / float(len(values))
+
+def run_benchmark(workdir, days=5, thread_count=8, repack=True, create_kwargs={}, **workload_kwargs):
+    """ Run a benchmark in a new directory workdir, which is removed after
+
+        workload_kwargs are passed to workload.PgDumpWorkload.
+    """
+    os.mkdir(workdir)
+    try:
+        workload = PgDumpWorkload(**workload_kwargs)
+        results = BenchmarkRun(workdir, workload, days, thread_count, repack, create_kwargs).run()
+        results['workload'] = workload_kwargs
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+def compare_results(baseline, results, tolerance=0.1):
+    """ A list of the ways in which results are worse than baseline by
+        more than tolerance, each a (measure, baseline value, new value)
+    """
+    worse = []
+    for stage in STAGES:
+        old, new = baseline['mb_per_sec'].get(stage), results['mb_per_sec'].get(stage)
+        if old and new is not None and new < old * (1 - tolerance):
+            worse.append(('%s MB/s' % stage, old, new))
+    if results['dedup_ratio'] < baseline['dedup_ratio'] * (1 - tolerance):
+        worse.append(('dedup ratio', baseline['dedup_ratio'], results['dedup_ratio']))
+    if results['peak_rss'] > baseline['peak_rss'] * (1 + tolerance):
+        worse.append(('peak RSS', baseline['peak_rss'], results['peak_rss']))
+    return worse
+
+def save_results(results, filename):
+    f = open(filename, 'w')
+    json.dump(results, f, indent=2, sort_keys=True)
+    f.write('\n')
+    f.close()
+
+def load_results(filename):
+    return json.load(open(filename))
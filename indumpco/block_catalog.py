@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import threading
+
+class BlockCatalog(object):
+    """
+    A persistent map from segment digest to the path of a block file
+    holding that segment, stored in an sqlite database shared by a set of
+    dumps.
+
+    Looking a digest up in the catalog is a single indexed probe, which
+    replaces a stat() of the candidate file in every block directory on a
+    search path.  The catalog also records which block directories it
+    covers completely, so that a miss can be trusted for those directories
+    and they need not be scanned.
+
+    Entries can go stale, for example when an old dump is deleted.
+    Callers must check that a path returned by lookup() still exists, and
+    fall back to a directory scan if it does not.
+
+    Changes are made in a single transaction that is committed by
+    commit(), so a dump that fails part way through doesn't leave its
+    block directory marked as covered.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, timeout=600, check_same_thread=False)
+        self.conn.text_factory = str
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS blocks (digest TEXT PRIMARY KEY, path TEXT NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS blockdirs (dirname TEXT PRIMARY KEY)')
+            self.conn.commit()
+            self.covered_dirs = set((row[0] for row in self.conn.execute('SELECT dirname FROM blockdirs')))
+
+    def lookup(self, seg_sum):
+        with self.lock:
+            row = self.conn.execute('SELECT path FROM blocks WHERE digest = ?', (seg_sum,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add(self, seg_sum, path, replace=True):
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        with self.lock:
+            self.conn.execute(verb + ' INTO blocks (digest, path) VALUES (?, ?)', (seg_sum, os.path.abspath(path)))
+
+    def covers(self, dirname):
+        return os.path.abspath(dirname) in self.covered_dirs
+
+    def mark_covered(self, dirname):
+        dirname = os.path.abspath(dirname)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO blockdirs (dirname) VALUES (?)', (dirname,))
+            self.covered_dirs.add(dirname)
+
+    def add_blockdir(self, block_dir):
+        """ Catalog every block in a file_format.BlockDir, and mark it as covered
+
+            Existing entries are left alone, so that importing an old dump
+            doesn't repoint digests away from newer copies of their blocks.
+        """
+        with self.lock:
+            for seg_sum, path in block_dir.listing():
+                self.add(seg_sum, path, replace=False)
+            self.mark_covered(block_dir.dirname)
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import fletcher_sum_split
+
+class Error(Exception):
+    pass
+
+class ChunkerBase(object):
+    """
+    A content defined chunking engine, with its parameters.
+
+    Subclasses name an engine implemented by fletcher_sum_split, and know
+    how to turn the candidate cut points that fletcher_sum_split.find_zeros
+    reports for stretches of the input into segment boundaries, so that
+    seekable inputs can be scanned in parallel.
+    """
+    name = None
+
+    def __init__(self, min_seg_bits, max_seg_size):
+        self.min_seg_bits = min_seg_bits
+        self.min_seg_size = 1 << min_seg_bits
+        self.max_seg_size = max_seg_size
+
+    def reader(self, source):
+        """ Start reading segments from a file descriptor or buffer """
+        return fletcher_sum_split.new(source, self.min_seg_bits, self.max_seg_size, self.name)
+
+    def split(self, buf):
+        """ Generate the segments of a buffer, as buffers over it """
+        fss = self.reader(buf)
+        while True:
+            seg = fletcher_sum_split.readsegment(fss)
+            if seg is None:
+                return
+            yield seg
+
+    def find_candidates(self, mapping, start, end):
+        return fletcher_sum_split.find_zeros(mapping, self.min_seg_bits, start, end, self.name)
+
+    def scan_range(self, length):
+        """ The range of offsets that must be searched for candidates """
+        raise NotImplementedError
+
+    def cuts(self, candidate_lists, length):
+        """ Generate the offsets at which segments end
+
+            Takes a sequence of lists of the candidate offsets found in
+            successive stretches of the scan range.  The final segment,
+            which runs to the end of the input, is not included.
+        """
+        raise NotImplementedError
+
+    def _forced_cuts(self, seg_start, end):
+        # Maximum size cuts in a segment starting at seg_start, up to end.
+        while self.max_seg_size and seg_start + self.max_seg_size <= end:
+            seg_start += self.max_seg_size
+            yield seg_start
+
+class FletcherChunker(ChunkerBase):
+    """ The original engine, based on a Fletcher checksum """
+    name = 'fletcher'
+
+    def scan_range(self, length):
+        # Only whole windows are scanned, starting with the end of the first.
+        window = self.min_seg_size >> 1
+        return window - 1, (length // window) * window
+
+    def cuts(self, candidate_lists, length):
+        window = self.min_seg_size >> 1
+        hit_limit = self.min_seg_size
+        cut_block = None
+        seg_start = 0
+        for zeros in candidate_lists:
+            for pos in zeros:
+                if pos == window - 1:
+                    # The sum at the end of the first window, which isn't
+                    # scanned byte by byte.
+                    hit_limit += window
+                elif pos > hit_limit:
+                    for seg_start in self._forced_cuts(seg_start, pos):
+                        yield seg_start
+                    seg_start = pos + 1
+                    yield seg_start
+                    hit_limit = pos + self.min_seg_size + 1
+                    cut_block = pos // window
+                else:
+                    # See the comments on the one byte offset in fletcher_sum_split.c
+                    hit_limit = pos + self.min_seg_size + (1 if pos // window == cut_block else 0)
+        for seg_start in self._forced_cuts(seg_start, length):
+            yield seg_start
+
+class GearChunker(ChunkerBase):
+    """ A faster engine, based on a gear hash """
+    name = 'gear'
+
+    def scan_range(self, length):
+        # No segment can end before the minimum size.
+        return min(self.min_seg_size - 1, length), length
+
+    def cuts(self, candidate_lists, length):
+        seg_start = 0
+        for candidates in candidate_lists:
+            for pos in candidates:
+                for seg_start in self._forced_cuts(seg_start, pos):
+                    yield seg_start
+                if pos + 1 - seg_start >= self.min_seg_size:
+                    seg_start = pos + 1
+                    yield seg_start
+        for seg_start in self._forced_cuts(seg_start, length):
+            yield seg_start
+
+ENGINES = dict(((c.name, c) for c in (FletcherChunker, GearChunker)))
+
+DEFAULT_ENGINE = 'fletcher'
+
+def get_chunker(engine, min_seg_bits, max_seg_size):
+    try:
+        chunker_class = ENGINES[engine]
+    except KeyError:
+        raise Error("unknown chunking engine", engine)
+    return chunker_class(min_seg_bits, max_seg_size)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+import time
+import threading
+from collections import defaultdict
+import file_format
+
+# The level that means a segment is stored raw, in an r block
+RAW = 0
+
+# The zlib levels that AdaptivePolicy chooses between, fastest first
+ADAPTIVE_LEVELS = (1, 3, 6, 9)
+
+def write_block(segment, dest_file, level):
+    """ Write segment to dest_file as a z block at a zlib level, or as an r
+        block if level is RAW
+    """
+    if level == RAW:
+        file_format.store_string_to_rfile(segment, dest_file)
+    else:
+        file_format.compress_string_to_zfile(segment, dest_file, level)
+
+class PolicyBase(object):
+    """
+    Decides how each new segment is compressed, and writes its block file.
+
+    Subclasses choose a zlib level for each segment, or RAW to store it
+    uncompressed.  The chosen attribute counts the segments written at
+    each level.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.chosen = defaultdict(int)
+
+    def choose(self, segment):
+        raise NotImplementedError
+
+    def compress_to_file(self, segment, dest_file, pool=None):
+        """ Write segment to dest_file at the level chosen for it
+
+            If pool is given, a pll_pipe.ProcessPool, the level is chosen
+            here but the block is written by one of the pool's processes.
+        """
+        level = self.choose(segment)
+        if pool is not None:
+            pool.apply(write_block, segment, dest_file, level)
+        else:
+            write_block(segment, dest_file, level)
+        with self.lock:
+            self.chosen[level] += 1
+        self._done(len(segment))
+
+    def _done(self, seg_len):
+        pass
+
+class FixedPolicy(PolicyBase):
+    """ Compress every segment at the same zlib level, or store them all raw """
+    def __init__(self, level=9):
+        PolicyBase.__init__(self)
+        self.level = level
+
+    def choose(self, segment):
+        return self.level
+
+class AdaptivePolicy(PolicyBase):
+    """
+    Compress each segment with the fastest zlib level that gets it within
+    ratio_slack of the size that level 9 would, judging by a sample.
+
+    sample_count stretches of sample_size bytes spread through the segment
+    are compressed at each level, or just the first stretch if
+    sample_count is 1 or less.  If even level 1 doesn't shrink the sample
+    below incompressible_ratio of its size, the segment is stored raw.
+
+    If target_rate is given, the levels on offer are cut back while new
+    segments are being written at fewer than target_rate input bytes per
+    second overall, and restored once the rate picks up again.
+    """
+    def __init__(self, ratio_slack=1.05, incompressible_ratio=0.95, target_rate=None,
+                 sample_size=32 << 10, sample_count=3):
+        PolicyBase.__init__(self)
+        self.ratio_slack = ratio_slack
+        self.incompressible_ratio = incompressible_ratio
+        self.target_rate = target_rate
+        self.sample_size = sample_size
+        self.sample_count = sample_count
+        self.max_level_index = len(ADAPTIVE_LEVELS) - 1
+        self.start_time = None
+        self.bytes_done = 0
+
+    def _sample(self, segment):
+        if len(segment) <= self.sample_size * max(self.sample_count, 1):
+            return str(segment)
+        if self.sample_count <= 1:
+            return str(segment[:self.sample_size])
+        step = (len(segment) - self.sample_size) // (self.sample_count - 1)
+        return ''.join((segment[i*step:i*step+self.sample_size] for i in range(self.sample_count)))
+
+    def choose(self, segment):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+            levels = ADAPTIVE_LEVELS[:self.max_level_index+1]
+        sample = self._sample(segment)
+        if not sample:
+            return levels[0]
+        sizes = {}
+        sizes[levels[0]] = len(zlib.compress(sample, levels[0]))
+        if sizes[levels[0]] > len(sample) * self.incompressible_ratio:
+            return RAW
+        best = len(zlib.compress(sample, ADAPTIVE_LEVELS[-1]))
+        sizes[ADAPTIVE_LEVELS[-1]] = best
+        for level in levels:
+            if level not in sizes:
+                sizes[level] = len(zlib.compress(sample, level))
+            if sizes[level] <= best * self.ratio_slack:
+                return level
+        return levels[-1]
+
+    def _done(self, seg_len):
+        if self.target_rate is None:
+            return
+        with self.lock:
+            self.bytes_done += seg_len
+            rate = self.bytes_done / max(time.time() - self.start_time, 1e-3)
+            if rate < self.target_rate and self.max_level_index > 0:
+                self.max_level_index -= 1
+            elif rate > 1.2 * self.target_rate and self.max_level_index < len(ADAPTIVE_LEVELS) - 1:
+                self.max_level_index += 1
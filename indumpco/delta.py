@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import errno
+import heapq
+import threading
+from collections import defaultdict
+import file_format
+
+# The number of line hashes kept in a segment's similarity sketch
+SKETCH_SIZE = 16
+
+# The longest chain of d blocks that a restore may have to resolve
+DEFAULT_MAX_DELTA_DEPTH = 4
+
+def sketch(segment):
+    """ A similarity sketch of a segment: the smallest crc32s of its lines
+
+        Segments that share most of their lines share most of their
+        sketch, wherever in the segment the lines that differ are.
+    """
+    hashes = set([zlib.crc32(line) & 0xffffffff for line in str(segment).splitlines(True)])
+    return heapq.nsmallest(SKETCH_SIZE, hashes)
+
+def make_delta_ops(ref, target):
+    """ Delta ops that rebuild target from ref, see file_format.pack_delta_ops
+
+        Lines of target that appear in ref are copied from it, with runs of
+        lines that follow on in ref merged into a single copy.  Everything
+        else is inserted.  Returns the ops and the number of bytes inserted.
+    """
+    ref_line_offsets = {}
+    offset = 0
+    for line in ref.splitlines(True):
+        ref_line_offsets.setdefault(line, offset)
+        offset += len(line)
+
+    ops = []
+    inserted = []
+    inserted_len = 0
+    copy_start, copy_len = None, 0
+    for line in target.splitlines(True):
+        if copy_start is not None and ref.startswith(line, copy_start + copy_len):
+            copy_len += len(line)
+            continue
+        if copy_start is not None:
+            ops.append((copy_start, copy_len))
+            copy_start = None
+        ref_offset = ref_line_offsets.get(line)
+        if ref_offset is None:
+            inserted.append(line)
+            inserted_len += len(line)
+            continue
+        if inserted:
+            ops.append(''.join(inserted))
+            inserted = []
+        copy_start, copy_len = ref_offset, len(line)
+    if copy_start is not None:
+        ops.append((copy_start, copy_len))
+    if inserted:
+        ops.append(''.join(inserted))
+    return ops, inserted_len
+
+class DeltaEncoder(object):
+    """
+    Writes new segments as d blocks, deltas against similar segments of
+    the dumps being reused, where that pays.
+
+    Candidate references are found by matching sketches against those
+    recorded in the reuse dumps.  A delta is only written if no more than
+    max_insert_fraction of the segment has to be inserted rather than
+    copied, and the chain of d blocks behind it would be no longer than
+    max_depth.  The reference block is hardlinked into the new dump's
+    block_dir, so that the dump is complete in itself.
+    """
+    def __init__(self, reuse_dumpdirs, search_path, block_dir, catalog=None, max_depth=DEFAULT_MAX_DELTA_DEPTH,
+                 max_insert_fraction=0.5, min_shared=SKETCH_SIZE // 4):
+        self.search_path = search_path
+        self.block_dir = block_dir
+        self.catalog = catalog
+        self.max_depth = max_depth
+        self.max_insert_fraction = max_insert_fraction
+        self.min_shared = min_shared
+        # The reuse segments with each line hash in their sketch
+        self.hash_segs = defaultdict(set)
+        for dumpdir in reuse_dumpdirs:
+            for seg_sum, seg_sketch in file_format.read_sketches(dumpdir) or []:
+                for h in seg_sketch:
+                    self.hash_segs[h].add(seg_sum)
+        self.seg_lens = {}
+        for dumpdir in reuse_dumpdirs:
+            if os.path.exists(os.path.join(dumpdir, 'sketches')):
+                for idxline in open(os.path.join(dumpdir, 'index')):
+                    seg_len, seg_sum = file_format.unpack_idxline(idxline)
+                    self.seg_lens[seg_sum] = seg_len
+        self.lock = threading.Lock()
+        self.written = 0
+
+    def _candidates(self, seg_sketch):
+        shared = defaultdict(int)
+        for h in seg_sketch:
+            for seg_sum in self.hash_segs.get(h, ()):
+                shared[seg_sum] += 1
+        ranked = sorted(shared.iteritems(), key=lambda kv: -kv[1])
+        return [seg_sum for seg_sum, n in ranked if n >= self.min_shared]
+
+    def write_delta(self, segment, seg_sketch, dest_file):
+        """ Write segment to dest_file as a d block if possible
+
+            Returns True if a d block was written.
+        """
+        for ref_sum in self._candidates(seg_sketch)[:2]:
+            ref_path = self.search_path.find_block(ref_sum)
+            if ref_path is None or ref_sum not in self.seg_lens:
+                continue
+            depth = file_format.delta_depth(ref_path) + 1
+            if depth > self.max_depth:
+                continue
+            ref_idxline = file_format.pack_idxline(self.seg_lens[ref_sum], ref_sum)
+            ref = file_format.unpack_block_seg(ref_path, ref_idxline)
+            ops, inserted_len = make_delta_ops(ref, str(segment))
+            if inserted_len > len(segment) * self.max_insert_fraction:
+                continue
+            link_block_chain(ref_path, ref_sum, self.block_dir, self.catalog)
+            file_format.write_dfile(ref_idxline, depth, file_format.pack_delta_ops(ops), dest_file)
+            with self.lock:
+                self.written += 1
+            return True
+        return False
+
+def link_block_chain(src_path, seg_sum, block_dir, catalog=None):
+    """ Hardlink a block into a file_format.BlockDir, with any blocks that
+        it refers to directly or indirectly, unless they're there already
+    """
+    todo = [(src_path, seg_sum)]
+    while todo:
+        src_path, seg_sum = todo.pop()
+        dest_path = block_dir.writable_filename(seg_sum)
+        try:
+            os.link(src_path, dest_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # Whatever linked it in links in its references too.
+            continue
+        if catalog is not None:
+            catalog.add(seg_sum, dest_path)
+        for ref_sum in file_format.block_refs(src_path):
+            todo.append((file_format.sibling_block_filename(src_path, ref_sum), ref_sum))
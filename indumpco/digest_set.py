@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import heapq
+import struct
+import binascii
+import tempfile
+from file_format import FormatError
+
+MAGIC = 'IDCDSET1'
+DIGEST_LEN = 16
+
+# The magic string and digest count, then a fan-out table giving the index
+# of the first digest starting with each byte value, and the count again.
+_HEADER = struct.Struct('<8sQ')
+_FANOUT = struct.Struct('<257Q')
+HEADER_LEN = _HEADER.size + _FANOUT.size
+
+# The number of text digests sorted in memory at a time by merge_digest_lists()
+DEFAULT_RUN_SIZE = 1 << 20
+
+class DigestSet(object):
+    """
+    A read-only set of md5 digests, memory mapped from a file of sorted raw
+    16 byte digests, so that opening one costs nothing however many digests
+    it holds.  Membership of a hex digest is tested by a binary search of
+    the digests sharing its first byte.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if len(self.mapping) < HEADER_LEN:
+            raise FormatError("digest set file too short", filename)
+        magic, self.count = _HEADER.unpack_from(self.mapping, 0)
+        if magic != MAGIC:
+            raise FormatError("not a digest set file", filename)
+        self.fanout = _FANOUT.unpack_from(self.mapping, _HEADER.size)
+        if len(self.mapping) != HEADER_LEN + self.count * DIGEST_LEN or self.fanout[256] != self.count:
+            raise FormatError("digest set file length doesn't match its header", filename)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, hex_digest):
+        try:
+            digest = binascii.unhexlify(hex_digest)
+        except TypeError:
+            return False
+        if len(digest) != DIGEST_LEN:
+            return False
+        first = ord(digest[0])
+        lo, hi = self.fanout[first], self.fanout[first+1]
+        m = self.mapping
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER_LEN + mid * DIGEST_LEN
+            probe = m[offset:offset+DIGEST_LEN]
+            if probe < digest:
+                lo = mid + 1
+            elif probe > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def __iter__(self):
+        """ Generate the raw digests, in order """
+        for offset in xrange(HEADER_LEN, len(self.mapping), DIGEST_LEN):
+            yield self.mapping[offset:offset+DIGEST_LEN]
+
+    def close(self):
+        self.mapping.close()
+
+def is_digest_set_file(filename):
+    f = open(filename, 'rb')
+    magic = f.read(len(MAGIC))
+    f.close()
+    return magic == MAGIC
+
+def load_digest_set(filename):
+    """ Load a list of digests, either a digest set file or a text file
+        with a hex digest on each line
+    """
+    if is_digest_set_file(filename):
+        return DigestSet(filename)
+    digests = set()
+    for line in open(filename):
+        digests.add(line.strip())
+    return digests
+
+def write_digest_set(filename, raw_digests):
+    """ Write a digest set file from an iterable of sorted, distinct raw digests """
+    counts = [0] * 256
+    f = open(filename, 'wb')
+    f.write('\0' * HEADER_LEN)
+    for digest in raw_digests:
+        counts[ord(digest[0])] += 1
+        f.write(digest)
+    fanout = [0]
+    for count in counts:
+        fanout.append(fanout[-1] + count)
+    f.seek(0)
+    f.write(_HEADER.pack(MAGIC, fanout[-1]))
+    f.write(_FANOUT.pack(*fanout))
+    f.close()
+
+def _text_runs(filename, run_size, tmpdir):
+    # Sort the digests of a text list in batches of run_size, each written
+    # to a temporary file, and return an iterator over each batch.
+    runs = []
+    batch = []
+    for line in open(filename):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            digest = binascii.unhexlify(line)
+        except TypeError:
+            digest = ''
+        if len(digest) != DIGEST_LEN:
+            raise FormatError("malformed digest in list", (filename, line))
+        batch.append(digest)
+        if len(batch) >= run_size:
+            runs.append(_write_run(batch, tmpdir))
+            batch = []
+    if batch:
+        runs.append(_write_run(batch, tmpdir))
+    return runs
+
+def _write_run(batch, tmpdir):
+    batch.sort()
+    run = tempfile.TemporaryFile(dir=tmpdir)
+    run.write(''.join(batch))
+    run.seek(0)
+    return _read_run(run)
+
+def _read_run(run):
+    while True:
+        digest = run.read(DIGEST_LEN)
+        if not digest:
+            run.close()
+            return
+        yield digest
+
+def _distinct(sorted_digests):
+    last = None
+    for digest in sorted_digests:
+        if digest != last:
+            yield digest
+            last = digest
+
+def merge_digest_lists(out_filename, sources, run_size=DEFAULT_RUN_SIZE):
+    """ Write a digest set file holding every digest in sources
+
+        Each source can be a digest set file, or a text file of hex digests
+        which is sorted run_size digests at a time, so that memory use is
+        bounded however long the list.  out_filename may be one of the
+        sources, the new file is written alongside and renamed into place.
+    """
+    tmpdir = os.path.dirname(os.path.abspath(out_filename))
+    runs = []
+    digest_sets = []
+    for src in sources:
+        if is_digest_set_file(src):
+            ds = DigestSet(src)
+            digest_sets.append(ds)
+            runs.append(iter(ds))
+        else:
+            runs.extend(_text_runs(src, run_size, tmpdir))
+    tmp = out_filename + '.tmp'
+    write_digest_set(tmp, _distinct(heapq.merge(*runs)))
+    for ds in digest_sets:
+        ds.close()
+    os.rename(tmp, out_filename)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+import os
+import io
+import bisect
+import threading
+from collections import OrderedDict
+import file_format
+
+# The default budget for the decompressed segment cache
+DEFAULT_CACHE_BYTES = 64 << 20
+
+class SegmentCache(object):
+    """
+    A least recently used cache of decompressed segments, keyed by idxline,
+    which holds no more than budget bytes of segment data.  The segment
+    most recently added is always kept, even if it's over budget by itself.
+    """
+    def __init__(self, budget=DEFAULT_CACHE_BYTES):
+        self.budget = budget
+        self.size = 0
+        self.segs = OrderedDict()
+
+    def get(self, idxline):
+        seg = self.segs.pop(idxline, None)
+        if seg is not None:
+            self.segs[idxline] = seg
+        return seg
+
+    def put(self, idxline, seg):
+        old = self.segs.pop(idxline, None)
+        if old is not None:
+            self.size -= len(old)
+        self.segs[idxline] = seg
+        self.size += len(seg)
+        while self.size > self.budget and len(self.segs) > 1:
+            _, evicted = self.segs.popitem(last=False)
+            self.size -= len(evicted)
+
+class DumpFile(io.RawIOBase):
+    """
+    A read-only, seekable file object over the decompressed contents of a
+    dump, which decompresses only the segments that are read.
+
+    Reading a segment that's part of an x group block decompresses the
+    whole group once, and caches every segment of the group that the dump
+    uses.  A segment of a y group block is decompressed on its own.
+    """
+    def __init__(self, dumpdir, extra_block_dirs=[], catalog=None, cache_bytes=DEFAULT_CACHE_BYTES):
+        io.RawIOBase.__init__(self)
+        self.dumpdir = dumpdir
+        self.blk_search_path = file_format.BlockSearchPath([file_format.dump_blockdir(dumpdir)] + extra_block_dirs, catalog)
+        self.cache = SegmentCache(cache_bytes)
+        self.lock = threading.Lock()
+        self.idxlines = []
+        # seg_starts[i] is the offset of the start of segment i in the dump
+        self.seg_starts = []
+        self.length = 0
+        for idxline in open(os.path.join(dumpdir, 'index')):
+            seg_len, seg_sum = file_format.unpack_idxline(idxline)
+            self.idxlines.append(idxline)
+            self.seg_starts.append(self.length)
+            self.length += seg_len
+        self.idxline_set = set(self.idxlines)
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._checkClosed()
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.length + offset
+        else:
+            raise ValueError("invalid whence", whence)
+        if pos < 0:
+            raise IOError("negative seek position", pos)
+        self.pos = pos
+        return pos
+
+    def read(self, n=-1):
+        self._checkClosed()
+        if n is None or n < 0:
+            n = self.length - self.pos
+        chunks = []
+        while n > 0 and self.pos < self.length:
+            i = bisect.bisect_right(self.seg_starts, self.pos) - 1
+            seg = self._segment(self.idxlines[i])
+            skip = self.pos - self.seg_starts[i]
+            chunk = seg[skip:skip+n]
+            chunks.append(chunk)
+            self.pos += len(chunk)
+            n -= len(chunk)
+        return ''.join(chunks)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def _segment(self, idxline):
+        with self.lock:
+            seg = self.cache.get(idxline)
+            if seg is not None:
+                return seg
+            seg_len, seg_sum = file_format.unpack_idxline(idxline)
+            blk_filename = self.blk_search_path.find_block(seg_sum)
+            if blk_filename is None:
+                raise file_format.FormatError("block not found", (self.dumpdir, seg_sum))
+            blk_file_reader = file_format.BlockFileRead(seg_sum, blk_filename)
+            if blk_file_reader.is_y_group:
+                seg = blk_file_reader.y_unpack_seg(idxline)
+            elif blk_file_reader.is_x_group:
+                want_idxline_set = (set([idxline]) | blk_file_reader.extra_idxlines) & self.idxline_set
+                for got_idxline, got_seg in blk_file_reader.x_unpack_segs(want_idxline_set):
+                    if got_idxline == idxline:
+                        seg = got_seg
+                    else:
+                        self.cache.put(got_idxline, got_seg)
+                if seg is None:
+                    raise file_format.FormatError("x group block lacks expected segment", (blk_filename, idxline))
+            else:
+                seg = blk_file_reader.z_unpack_seg()
+            # Put the segment being read last, so that it's kept.
+            self.cache.put(idxline, seg)
+            return seg
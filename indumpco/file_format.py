@@ -4,10 +4,84 @@ import zlib
 import lzma
 import re
 import os
+import shutil
+import hashlib
+import tempfile
+import threading
 
 class FormatError(Exception):
     pass
 
+# The chunking used by dumps that predate the chunking file
+LEGACY_CHUNKING = {'engine': 'fletcher', 'min_seg_bits': 20, 'max_seg_size': 0}
+
+def write_chunking(dumpdir, chunking):
+    f = open(os.path.join(dumpdir, 'chunking'), 'w')
+    for key in sorted(chunking):
+        f.write("%s %s\n" % (key, chunking[key]))
+    f.close()
+
+def read_chunking(dumpdir):
+    """ Read back the chunking parameters that a dump was created with """
+    path = os.path.join(dumpdir, 'chunking')
+    if not os.path.exists(path):
+        return dict(LEGACY_CHUNKING)
+    chunking = {}
+    for line in open(path):
+        hit = re.match(r'^(\w+) (\S+)\s*$', line)
+        if not hit:
+            raise FormatError("malformed chunking line", (path, line))
+        key, value = hit.group(1), hit.group(2)
+        if value.isdigit():
+            value = int(value)
+        chunking[key] = value
+    return chunking
+
+def write_sections(dumpdir, sections):
+    f = open(os.path.join(dumpdir, 'sections'), 'w')
+    for start, end, kind, name in sections:
+        f.write("%d %d %s %s\n" % (start, end, kind, name))
+    f.close()
+
+def read_sections(dumpdir):
+    """ Read back a dump's section map, or None if it doesn't have one
+
+        Returns a list of (start, end, kind, name) tuples, in dump order.
+    """
+    path = os.path.join(dumpdir, 'sections')
+    if not os.path.exists(path):
+        return None
+    sections = []
+    for line in open(path):
+        hit = re.match(r'^([0-9]+) ([0-9]+) (\w+) (.+)$', line)
+        if not hit:
+            raise FormatError("malformed sections line", (path, line))
+        sections.append((int(hit.group(1)), int(hit.group(2)), hit.group(3), hit.group(4)))
+    return sections
+
+def write_sketches(dumpdir, sketches):
+    f = open(os.path.join(dumpdir, 'sketches'), 'w')
+    for seg_sum, sketch in sketches:
+        f.write("%s %s\n" % (seg_sum, ' '.join(["%08x" % h for h in sketch])))
+    f.close()
+
+def read_sketches(dumpdir):
+    """ Read back the similarity sketches of a dump's segments, or None
+
+        Returns a list of (seg_sum, sketch) pairs, where a sketch is a
+        list of integers.
+    """
+    path = os.path.join(dumpdir, 'sketches')
+    if not os.path.exists(path):
+        return None
+    sketches = []
+    for line in open(path):
+        words = line.split()
+        if not words or not re.match(r'^\w+$', words[0]):
+            raise FormatError("malformed sketches line", (path, line))
+        sketches.append((words[0], [int(w, 16) for w in words[1:]]))
+    return sketches
+
 def pack_idxline(seg_len, seg_sum):
     return "%d %s\n" % (int(seg_len), seg_sum)
 
@@ -19,6 +93,231 @@ def unpack_idxline(idxline):
     seg_sum = hit.group(2)
     return seg_len, seg_sum
 
+def pack_y_idxline(seg_len, seg_sum, chunk_len, chunk_crc):
+    return "%d %s %d %08x\n" % (int(seg_len), seg_sum, int(chunk_len), chunk_crc)
+
+def unpack_y_idxline(y_idxline):
+    """ Split a y group header line into the segment's idxline, and the
+        length and crc32 of its lzma stream
+    """
+    hit = re.match(r'^([0-9]+) (\w+) ([0-9]+) ([0-9a-f]{8})\s*$', y_idxline)
+    if not hit:
+        raise FormatError("malformed y group index line", y_idxline)
+    idxline = pack_idxline(hit.group(1), hit.group(2))
+    return idxline, int(hit.group(3)), int(hit.group(4), 16)
+
+def _crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+# The most data held at once by each step of write_group_file()
+GROUP_PIECE_SIZE = 1 << 20
+
+def iter_zfile_pieces(src_file, piece_size=GROUP_PIECE_SIZE):
+    """ Generate the segment in a z block file in pieces of no more than
+        piece_size bytes, reading and decompressing as it goes
+    """
+    f = open(src_file)
+    try:
+        formatbyte = f.read(1)
+        if formatbyte != 'z':
+            raise FormatError("blockfile is not a zlib file", (src_file, formatbyte))
+        d = zlib.decompressobj()
+        while True:
+            data = f.read(piece_size)
+            if not data:
+                break
+            while data:
+                piece = d.decompress(data, piece_size)
+                if piece:
+                    yield piece
+                data = d.unconsumed_tail
+        piece = d.flush()
+        if piece:
+            yield piece
+    finally:
+        f.close()
+
+def write_group_file(dest_file, seg_sums, seg_pieces, split_streams=False):
+    """ Write an x or y group block file, streaming the segments through
+        the lzma compressor
+
+        seg_pieces gives an iterable of the pieces of each segment in turn,
+        so that no more than a piece of any segment need be held at once.
+        The compressed data is spooled to a temporary file alongside
+        dest_file until the header before it is known.  Returns the
+        overall digest, the index lines of the segments and the length of
+        the file written.
+
+        A y group is an x group in which each segment is a separate lzma
+        stream, so that any one of them can be decompressed without the
+        others.  The header line for each segment gives the length and
+        crc32 of its stream after the segment's length and digest.
+    """
+    overall_md5 = hashlib.md5()
+    idxlines = []
+    header_lines = []
+    spool = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(dest_file)))
+    try:
+        compressor = lzma.LZMACompressor()
+        for seg_sum, pieces in zip(seg_sums, seg_pieces):
+            if split_streams:
+                compressor = lzma.LZMACompressor()
+            seg_len, chunk_len, chunk_crc = 0, 0, 0
+            for piece in pieces:
+                overall_md5.update(piece)
+                seg_len += len(piece)
+                chunk_len, chunk_crc = _spool_chunk(spool, compressor.compress(piece), chunk_len, chunk_crc)
+            idxlines.append(pack_idxline(seg_len, seg_sum))
+            if split_streams:
+                chunk_len, chunk_crc = _spool_chunk(spool, compressor.flush(), chunk_len, chunk_crc)
+                header_lines.append(pack_y_idxline(seg_len, seg_sum, chunk_len, chunk_crc & 0xffffffff))
+        if split_streams:
+            formatbyte = 'y'
+        else:
+            spool.write(compressor.flush())
+            formatbyte = 'x'
+            header_lines = idxlines
+        overall_sum = overall_md5.hexdigest()
+        f = open(dest_file, 'w')
+        try:
+            f.write('%s%s\n%d\n%s' % (formatbyte, overall_sum, len(idxlines), ''.join(header_lines)))
+            spool.seek(0)
+            shutil.copyfileobj(spool, f, GROUP_PIECE_SIZE)
+            return overall_sum, idxlines, f.tell()
+        finally:
+            f.close()
+    finally:
+        spool.close()
+
+def _spool_chunk(spool, chunk, chunk_len, chunk_crc):
+    # Append some of a group's lzma data to spool, returning the length
+    # and running crc32 of the current stream
+    spool.write(chunk)
+    return chunk_len + len(chunk), zlib.crc32(chunk, chunk_crc)
+
+def pack_delta_ops(ops):
+    """ Encode a list of delta operations for a d block
+
+        Each operation is either a (ref_offset, length) pair, meaning a
+        copy of that stretch of the reference segment, or a string to be
+        inserted as it is.
+    """
+    out = []
+    for op in ops:
+        if isinstance(op, tuple):
+            out.append("c%d %d\n" % op)
+        else:
+            out.append("i%d\n" % len(op))
+            out.append(op)
+    return ''.join(out)
+
+def apply_delta_ops(ref, ops_data):
+    """ Rebuild a segment from its reference segment and encoded delta ops """
+    out = []
+    pos = 0
+    while pos < len(ops_data):
+        nl = ops_data.find('\n', pos)
+        if nl < 0:
+            raise FormatError("truncated delta op", ops_data[pos:pos+20])
+        op, args = ops_data[pos], ops_data[pos+1:nl]
+        pos = nl + 1
+        if op == 'c':
+            ref_offset, length = [int(a) for a in args.split()]
+            if ref_offset + length > len(ref):
+                raise FormatError("delta copy beyond end of reference", (ref_offset, length, len(ref)))
+            out.append(ref[ref_offset:ref_offset+length])
+        elif op == 'i':
+            length = int(args)
+            out.append(ops_data[pos:pos+length])
+            pos += length
+        else:
+            raise FormatError("invalid delta op", op)
+    return ''.join(out)
+
+def write_dfile(ref_idxline, depth, ops_data, dest_file, level=6):
+    """ Write a d block, holding a segment as a delta against ref_idxline's
+
+        depth is the number of d blocks that must be resolved to restore
+        the segment, including this one.
+    """
+    f = open(dest_file, 'w')
+    f.write('d%s%d\n' % (ref_idxline, depth))
+    f.write(zlib.compress(ops_data, level))
+    f.close()
+
+def write_cfile(chunk_idxlines, dest_file):
+    """ Write a c block, holding a segment as a recipe of smaller segments
+
+        Each of the chunks is a block of its own in the same block
+        directory.
+    """
+    f = open(dest_file, 'w')
+    f.write('c%d\n%s' % (len(chunk_idxlines), ''.join(chunk_idxlines)))
+    f.close()
+
+def block_refs(filename):
+    """ The digests of the other blocks that a block file refers to """
+    reader = BlockFileRead(os.path.basename(filename), filename)
+    if reader.format_byte == 'd':
+        return [unpack_idxline(reader.d_ref_idxline)[1]]
+    elif reader.format_byte == 'c':
+        return [unpack_idxline(i)[1] for i in reader.c_chunk_idxlines]
+    return []
+
+# The deepest fanout store that sibling_block_filename() looks for
+MAX_FANOUT_LEVELS = 4
+
+# The fanout store, or None, that each directory holding block files is in
+_fanout_stores = {}
+
+def _fanout_store_of(dirname, name):
+    # The path from a fanout store to one of its block files is made up
+    # of slices of the block's name.
+    if dirname not in _fanout_stores:
+        store = None
+        top, prefix = dirname, ''
+        for _ in range(MAX_FANOUT_LEVELS + 1):
+            if name.startswith(prefix) and os.path.exists(os.path.join(top, 'fanout')):
+                store = FanoutBlockDir(top)
+                break
+            top, part = os.path.split(top)
+            if not part:
+                break
+            prefix = part + prefix
+        _fanout_stores[dirname] = store
+    return _fanout_stores[dirname]
+
+def sibling_block_filename(filename, seg_sum):
+    """ The path at which the block for seg_sum would be found in the same
+        block directory as the block file filename
+    """
+    dirname = os.path.dirname(filename)
+    store = _fanout_store_of(dirname, os.path.basename(filename))
+    if store is not None:
+        return store.filename(seg_sum)
+    if len(os.path.basename(dirname)) == 1:
+        return Nest1BlockDir(os.path.dirname(dirname)).filename(seg_sum)
+    return os.path.join(dirname, seg_sum)
+
+def delta_depth(filename):
+    """ The length of the chain of d blocks starting at a block file """
+    reader = BlockFileRead(os.path.basename(filename), filename)
+    if reader.format_byte != 'd':
+        return 0
+    return reader.d_depth
+
+def unpack_block_seg(filename, idxline):
+    """ Unpack the segment for idxline from a block file of any kind """
+    seg_len, seg_sum = unpack_idxline(idxline)
+    reader = BlockFileRead(seg_sum, filename)
+    if reader.is_y_group:
+        return reader.y_unpack_seg(idxline)
+    elif reader.is_x_group:
+        for got_idxline, seg in reader.x_unpack_segs(set([idxline])):
+            return seg
+        raise FormatError("x group block lacks expected segment", (filename, idxline))
+    return reader.z_unpack_seg()
+
 class BlockFileRead(object):
     def __init__(self, seg_sum, filename):
         self.main_seg_sum = seg_sum
@@ -26,16 +325,39 @@ class BlockFileRead(object):
         self.fh = open(filename)
         self.format_byte = self.fh.read(1)
         self.extra_idxlines = set()
-        if self.format_byte == 'z':
+        self.is_y_group = False
+        if self.format_byte in ('z', 'r'):
             self.is_x_group = False
-        elif self.format_byte == 'x':
+        elif self.format_byte == 'd':
+            self.is_x_group = False
+            self.d_ref_idxline = self.fh.readline()
+            unpack_idxline(self.d_ref_idxline)
+            self.d_depth = int(self.fh.readline().strip())
+        elif self.format_byte == 'c':
+            self.is_x_group = False
+            chunk_count = int(self.fh.readline().strip())
+            self.c_chunk_idxlines = [self.fh.readline() for _ in range(chunk_count)]
+            for idxline in self.c_chunk_idxlines:
+                unpack_idxline(idxline)
+        elif self.format_byte in ('x', 'y'):
             self.is_x_group = True
+            self.is_y_group = self.format_byte == 'y'
             self.x_overall_sum = self.fh.readline().strip()
             embedded_idxline_count = int(self.fh.readline().strip())
             self.x_embedded_idxlines = []
             self.x_overall_len = 0
+            # The offset, length and crc32 of each y group segment's lzma stream
+            self.y_chunks = {}
+            self.y_chunk_list = []
+            chunk_offset = 0
             for _ in range(embedded_idxline_count):
                 idxline = self.fh.readline()
+                if self.is_y_group:
+                    idxline, chunk_len, chunk_crc = unpack_y_idxline(idxline)
+                    chunk = (chunk_offset, chunk_len, chunk_crc)
+                    self.y_chunks.setdefault(idxline, chunk)
+                    self.y_chunk_list.append(chunk)
+                    chunk_offset += chunk_len
                 self.x_embedded_idxlines.append(idxline)
                 xseglen, xsegsum = unpack_idxline(idxline)
                 self.x_overall_len += xseglen
@@ -44,10 +366,16 @@ class BlockFileRead(object):
             self.x_overall_idxline = pack_idxline(self.x_overall_len, self.x_overall_sum)
             if self.main_seg_sum != self.x_overall_sum:
                 self.extra_idxlines.add(self.x_overall_idxline)
+            self.y_data_start = self.fh.tell()
+            self.y_lock = threading.Lock()
         else:
             raise FormatError("invalid first byte of compressed block", (self.blk_file, format_byte))
 
     def x_unpack_segs(self, desired_idxline_set):
+        if self.is_y_group:
+            for idxline_seg in self._y_unpack_segs(desired_idxline_set):
+                yield idxline_seg
+            return
         xz_data = self.fh.read()
         unpacked_data = lzma.decompress(xz_data)
         if self.x_overall_idxline in desired_idxline_set:
@@ -61,42 +389,217 @@ class BlockFileRead(object):
         if offset != len(unpacked_data):
             raise FormatError("lzma data len not consistent with seg lens in x header", self.filename)
 
+    def _y_unpack_segs(self, desired_idxline_set):
+        if self.x_overall_idxline in desired_idxline_set:
+            yield (self.x_overall_idxline, self.y_unpack_seg(self.x_overall_idxline))
+        for idxline in self.x_embedded_idxlines:
+            if idxline in desired_idxline_set:
+                yield (idxline, self.y_unpack_seg(idxline))
+
+    def y_unpack_seg(self, idxline):
+        """ Decompress one segment of a y group, or the whole group
+
+            Only the segment's own lzma stream is read and decompressed.
+            Several threads may call this at once.
+        """
+        if idxline in self.y_chunks:
+            chunks = [self.y_chunks[idxline]]
+        elif idxline == self.x_overall_idxline:
+            chunks = self.y_chunk_list
+        else:
+            raise FormatError("segment not in y group", (self.filename, idxline))
+        segs = []
+        for offset, chunk_len, chunk_crc in chunks:
+            with self.y_lock:
+                self.fh.seek(self.y_data_start + offset)
+                chunk = self.fh.read(chunk_len)
+            if len(chunk) != chunk_len or _crc32(chunk) != chunk_crc:
+                raise FormatError("y group lzma stream fails crc check", (self.filename, offset))
+            segs.append(lzma.decompress(chunk))
+        seg = ''.join(segs)
+        seg_len, seg_sum = unpack_idxline(idxline)
+        if len(seg) != seg_len:
+            raise FormatError("lzma data len not consistent with seg len in y header", (self.filename, idxline))
+        return seg
+
     def z_unpack_seg(self):
+        """ Unpack the segment of a single segment block, z, r, d or c
+
+            The reference segment of a d block and the chunks of a c block
+            are unpacked from the same block directory.
+        """
+        if self.format_byte == 'r':
+            return self.fh.read()
+        elif self.format_byte == 'c':
+            chunks = []
+            for idxline in self.c_chunk_idxlines:
+                chunk_len, chunk_sum = unpack_idxline(idxline)
+                chunks.append(unpack_block_seg(sibling_block_filename(self.filename, chunk_sum), idxline))
+            return ''.join(chunks)
+        elif self.format_byte == 'd':
+            ref_seg_len, ref_seg_sum = unpack_idxline(self.d_ref_idxline)
+            ref = unpack_block_seg(sibling_block_filename(self.filename, ref_seg_sum), self.d_ref_idxline)
+            return apply_delta_ops(ref, zlib.decompress(self.fh.read()))
         return zlib.decompress(self.fh.read())
 
+_block_filename_re = re.compile(r'^[0-9a-f]{32}$')
+
 class BlockDirBase(object):
     def __init__(self, dirname):
         self.dirname = dirname
 
+    def writable_filename(self, seg_sum):
+        """ The filename for seg_sum's block, with its directory created """
+        return self.filename(seg_sum)
+
+    def _listing_of(self, dirname):
+        for name in os.listdir(dirname):
+            if _block_filename_re.match(name):
+                yield name, os.path.join(dirname, name)
+
 class FlatBlockDir(BlockDirBase):
     def filename(self, seg_sum):
         return os.path.join(self.dirname, seg_sum)
 
+    def listing(self):
+        return self._listing_of(self.dirname)
+
 class Nest1BlockDir(BlockDirBase):
     def filename(self, seg_sum):
         return os.path.join(self.dirname, os.path.join(seg_sum[0], seg_sum))
 
+    def listing(self):
+        for subdir in sorted(os.listdir(self.dirname)):
+            if len(subdir) == 1:
+                for name_path in self._listing_of(os.path.join(self.dirname, subdir)):
+                    yield name_path
+
+class FanoutBlockDir(BlockDirBase):
+    """
+    A block store shared by many dumps, in which blocks are spread over
+    levels of subdirectories named by successive width character slices
+    of their digests.  The levels and width are kept in a file named
+    fanout at the top of the store.
+    """
+    def __init__(self, dirname):
+        BlockDirBase.__init__(self, dirname)
+        path = os.path.join(dirname, 'fanout')
+        hit = re.match(r'^([0-9]+) ([0-9]+)\s*$', open(path).read())
+        if not hit:
+            raise FormatError("malformed fanout file", path)
+        self.levels, self.width = int(hit.group(1)), int(hit.group(2))
+
+    def _subdir(self, seg_sum):
+        parts = [seg_sum[i*self.width:(i+1)*self.width] for i in range(self.levels)]
+        return os.path.join(self.dirname, *parts)
+
+    def filename(self, seg_sum):
+        return os.path.join(self._subdir(seg_sum), seg_sum)
+
+    def writable_filename(self, seg_sum):
+        subdir = self._subdir(seg_sum)
+        if not os.path.isdir(subdir):
+            try:
+                os.makedirs(subdir)
+            except OSError:
+                if not os.path.isdir(subdir):
+                    raise
+        return os.path.join(subdir, seg_sum)
+
+    def listing(self):
+        return self._listing_below(self.dirname, self.levels)
+
+    def _listing_below(self, dirname, levels):
+        if levels == 0:
+            for name_path in self._listing_of(dirname):
+                yield name_path
+            return
+        for subdir in sorted(os.listdir(dirname)):
+            if len(subdir) == self.width:
+                for name_path in self._listing_below(os.path.join(dirname, subdir), levels - 1):
+                    yield name_path
+
+def create_fanout_blockdir(dirname, levels=2, width=2):
+    """ Create an empty shared block store """
+    if levels > MAX_FANOUT_LEVELS or levels * width > 32:
+        raise ValueError("fanout too deep for 32 character digests", (levels, width))
+    os.mkdir(dirname)
+    f = open(os.path.join(dirname, 'fanout'), 'w')
+    f.write("%d %d\n" % (levels, width))
+    f.close()
+
 def BlockDir(dirname):
-    if os.path.exists(os.path.join(dirname, "0")):
+    if os.path.exists(os.path.join(dirname, "fanout")):
+        return FanoutBlockDir(dirname)
+    elif os.path.exists(os.path.join(dirname, "0")):
         return Nest1BlockDir(dirname)
     else:
         return FlatBlockDir(dirname)
 
+def dump_blockdir(dumpdir):
+    """ The block directory of a dump: its own, or the shared store that
+        its store file names
+    """
+    path = os.path.join(dumpdir, 'store')
+    if os.path.exists(path):
+        return open(path).read().rstrip('\n')
+    return os.path.join(dumpdir, 'blocks')
+
+def write_store(dumpdir, store_dir):
+    f = open(os.path.join(dumpdir, 'store'), 'w')
+    f.write(os.path.abspath(store_dir) + "\n")
+    f.close()
+
 class BlockSearchPath(object):
-    def __init__(self, dirnames):
+    """ Find block files in a list of block directories
+
+        If a block_catalog.BlockCatalog is supplied, it's consulted before
+        any of the directories are searched.  A catalog hit is returned if
+        the file still exists.  With trust_catalog_misses set, a catalog
+        miss is taken as meaning that the block is not in any directory
+        that the catalog covers, so only the uncovered directories are
+        searched.  A stale catalog hit always leads to a full search.
+    """
+    def __init__(self, dirnames, catalog=None, trust_catalog_misses=False):
         self.block_dirs = [BlockDir(d) for d in dirnames]
+        self.catalog = catalog
+        if catalog is not None and trust_catalog_misses:
+            self.dirs_after_catalog_miss = [bd for bd in self.block_dirs if not catalog.covers(bd.dirname)]
+        else:
+            self.dirs_after_catalog_miss = self.block_dirs
 
     def find_block(self, seg_sum):
-        for bd in self.block_dirs:
+        search_dirs = self.block_dirs
+        if self.catalog is not None:
+            f = self.catalog.lookup(seg_sum)
+            if f is None:
+                search_dirs = self.dirs_after_catalog_miss
+            elif os.path.exists(f):
+                return f
+        for bd in search_dirs:
             f = bd.filename(seg_sum)
             if os.path.exists(f):
                 return f
         return None
 
-def compress_string_to_zfile(src_str, dest_file):
+def tmp_filename(filename):
+    """ A name to write a block file under before renaming it into place,
+        unique to the process and thread, since a shared store may have
+        several dumps being written to it at once
+    """
+    return "%s.%d.%d.tmp" % (filename, os.getpid(), threading.current_thread().ident)
+
+def compress_string_to_zfile(src_str, dest_file, level=9):
     f = open(dest_file, 'w')
     f.write('z')
-    f.write(zlib.compress(src_str, 9))
+    f.write(zlib.compress(src_str, level))
+    f.close()
+
+def store_string_to_rfile(src_str, dest_file):
+    """ Write a segment uncompressed, as an r block """
+    f = open(dest_file, 'w')
+    f.write('r')
+    f.write(src_str)
     f.close()
 
 def decompress_zfile_to_string(src_file):
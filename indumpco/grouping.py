@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import os
+import zlib
+import lzma
+from collections import defaultdict
+import file_format
+from delta import sketch, SKETCH_SIZE
+from pll_pipe import parallel_pipe
+
+# The most uncompressed bytes in a planned group
+DEFAULT_MAX_GROUP_BYTES = 16 << 20
+
+# The most bytes of each group compressed to estimate its gain
+DEFAULT_SAMPLE_BYTES = 1 << 20
+
+# Blocks used by at least this many of the reuse dumps are left as z blocks
+DEFAULT_HOT_USES = 2
+
+# The counts in the report of the dump's segments by what the planner found
+# them to be, and of the groups it considered
+SEGMENT_COUNTS = ('segments', 'bytes', 'not_z', 'hot', 'linked', 'reused', 'new', 'candidate_groups')
+
+class PlannedGroup(object):
+    """ A group of segments to repack together, with the estimate of what
+        that would gain
+    """
+    def __init__(self):
+        self.idxlines = []
+        self.seg_len = 0
+        self.z_bytes = 0
+        self.sketch_hashes = set()
+        self.estimated_bytes = None
+        # The number of runs of consecutive index positions that the
+        # group's segments make, each of which costs an x group decode
+        self.index_runs = 0
+
+    def add(self, idxline, seg_len, z_bytes, seg_sketch):
+        self.idxlines.append(idxline)
+        self.seg_len += seg_len
+        self.z_bytes += z_bytes
+        self.sketch_hashes.update(seg_sketch)
+
+    @property
+    def size_change(self):
+        return float(self.estimated_bytes) / max(self.z_bytes, 1)
+
+class GroupPlanner(object):
+    """
+    Plans the groups in which to repack the z blocks of a dump, by the
+    similarity of their contents rather than by position in the index.
+
+    A segment is only considered if its block is a z block that repacking
+    would free: a block that's hardlinked from another dump stays on disk
+    whatever this dump does with it.  Blocks used by hot_uses or more of
+    reuse_dumpdirs are left as z blocks, since they're the quickest to
+    decode and are likely to be used again.
+
+    Segments are clustered by their similarity sketches, taken from the
+    dump's sketches file where it has one and otherwise computed, joining
+    the open group with which each shares the most sketch hashes, or at
+    least min_shared of them.  Segments like no others are grouped with
+    their neighbours in the index.  The lzma gain of each group is then
+    estimated by compressing up to sample_bytes of it both ways, and only
+    groups estimated to shrink to less than max_size_change of their z
+    block size are kept.
+
+    Similar segments gain most as an x group, in which they share one
+    lzma stream.  In a y group each segment is compressed on its own, so
+    grouping only decides which segments are worth moving to lzma.
+    """
+    def __init__(self, dumpdir, reuse_dumpdirs=[], split_streams=False, hot_uses=DEFAULT_HOT_USES,
+                 max_group_bytes=DEFAULT_MAX_GROUP_BYTES, min_shared=SKETCH_SIZE // 4,
+                 sample_bytes=DEFAULT_SAMPLE_BYTES, max_size_change=0.9, thread_count=4):
+        self.dumpdir = dumpdir
+        self.reuse_dumpdirs = reuse_dumpdirs
+        self.split_streams = split_streams
+        self.hot_uses = hot_uses
+        self.max_group_bytes = max_group_bytes
+        self.min_shared = min_shared
+        self.sample_bytes = sample_bytes
+        self.max_size_change = max_size_change
+        self.thread_count = thread_count
+        self.block_dir = file_format.BlockDir(file_format.dump_blockdir(dumpdir))
+        self.counts = defaultdict(int)
+
+    def _reuse_counts(self):
+        # The number of reuse dumps using each digest
+        uses = defaultdict(int)
+        for dumpdir in self.reuse_dumpdirs:
+            seg_sums = set()
+            for idxline in open(os.path.join(dumpdir, 'index')):
+                seg_sums.add(file_format.unpack_idxline(idxline)[1])
+            for seg_sum in seg_sums:
+                uses[seg_sum] += 1
+        return uses
+
+    def _candidates(self):
+        # The index lines of the segments that could be repacked, in index
+        # order and without repeats, noting the index positions of each.
+        uses = self._reuse_counts()
+        self.positions = defaultdict(list)
+        candidates = []
+        for pos, idxline in enumerate(open(os.path.join(self.dumpdir, 'index'))):
+            seg_len, seg_sum = file_format.unpack_idxline(idxline)
+            self.positions[seg_sum].append(pos)
+            if len(self.positions[seg_sum]) > 1:
+                continue
+            self.counts['segments'] += 1
+            self.counts['bytes'] += seg_len
+            path = self.block_dir.filename(seg_sum)
+            if open(path).read(1) != 'z':
+                self.counts['not_z'] += 1
+            elif uses[seg_sum] >= self.hot_uses:
+                self.counts['hot'] += 1
+            elif os.lstat(path).st_nlink > 1:
+                self.counts['linked'] += 1
+            else:
+                self.counts['reused' if uses[seg_sum] else 'new'] += 1
+                candidates.append(idxline)
+        return candidates
+
+    def _sketched(self, candidates):
+        # Generate each candidate with its z block size and sketch.
+        known = dict(file_format.read_sketches(self.dumpdir) or [])
+        def worker(slot, idxline):
+            seg_len, seg_sum = file_format.unpack_idxline(idxline)
+            path = self.block_dir.filename(seg_sum)
+            seg_sketch = known.get(seg_sum)
+            if seg_sketch is None:
+                seg_sketch = sketch(file_format.decompress_zfile_to_string(path))
+            slot.put((idxline, seg_len, os.lstat(path).st_size, seg_sketch))
+        return parallel_pipe(candidates, worker, self.thread_count)
+
+    def _cluster(self, sketched):
+        groups = []
+        open_groups = {}
+        hash_group = {}
+        for idxline, seg_len, z_bytes, seg_sketch in sketched:
+            votes = defaultdict(int)
+            for h in seg_sketch:
+                group = hash_group.get(h)
+                if group is not None and id(group) in open_groups:
+                    votes[id(group)] += 1
+            best = None
+            if votes:
+                best_id, n = max(votes.iteritems(), key=lambda kv: kv[1])
+                if n >= self.min_shared:
+                    best = open_groups[best_id]
+            if best is None:
+                best = PlannedGroup()
+                groups.append(best)
+                open_groups[id(best)] = best
+            best.add(idxline, seg_len, z_bytes, seg_sketch)
+            for h in seg_sketch:
+                hash_group[h] = best
+            if best.seg_len >= self.max_group_bytes:
+                del open_groups[id(best)]
+        return self._merge_singles(groups)
+
+    def _merge_singles(self, groups):
+        # Group the segments that matched nothing with their neighbours.
+        merged = []
+        current = None
+        for group in groups:
+            if len(group.idxlines) > 1:
+                merged.append(group)
+                continue
+            if current is None or current.seg_len + group.seg_len > self.max_group_bytes:
+                current = PlannedGroup()
+                merged.append(current)
+            current.add(group.idxlines[0], group.seg_len, group.z_bytes, group.sketch_hashes)
+        return merged
+
+    def _sample(self, group):
+        # Up to sample_bytes of the group, as pieces from every so many
+        # of its segments
+        stride = max(group.seg_len // self.sample_bytes, 1)
+        per_seg = max(self.sample_bytes // max(len(group.idxlines) // stride, 1), 1)
+        pieces, total = [], 0
+        for idxline in group.idxlines[::stride]:
+            if total >= self.sample_bytes:
+                break
+            seg_sum = file_format.unpack_idxline(idxline)[1]
+            piece = file_format.decompress_zfile_to_string(self.block_dir.filename(seg_sum))[:per_seg]
+            pieces.append(piece)
+            total += len(piece)
+        return pieces
+
+    def _estimate(self, slot, group):
+        pieces = self._sample(group)
+        zlib_len = sum(len(zlib.compress(piece, 9)) for piece in pieces)
+        if self.split_streams:
+            lzma_len = sum(len(lzma.compress(piece)) for piece in pieces)
+        else:
+            lzma_len = len(lzma.compress(''.join(pieces)))
+        header_len = sum(len(idxline) + 18 for idxline in group.idxlines) + 40
+        group.estimated_bytes = int(group.z_bytes * lzma_len / float(max(zlib_len, 1))) + header_len
+        positions = sorted(pos for idxline in group.idxlines
+                           for pos in self.positions[file_format.unpack_idxline(idxline)[1]])
+        group.index_runs = len([i for i, pos in enumerate(positions) if i == 0 or positions[i-1] != pos - 1])
+        slot.put(group)
+
+    def plan(self):
+        """ The groups worth repacking, in the order of their first segments
+            in the index
+        """
+        self.counts.clear()
+        groups = self._cluster(self._sketched(self._candidates()))
+        self.counts['candidate_groups'] = len(groups)
+        estimated = parallel_pipe(groups, self._estimate, self.thread_count, queue_size=2)
+        return [group for group in estimated if group.size_change < self.max_size_change]
+
+    def report(self, groups):
+        """ A dict of what repacking groups is expected to save and how it
+            changes the cost of decoding their segments, suitable for JSON
+
+            Decode costs are in bytes decoded for a full extract.  A y group
+            decodes each segment on its own, as a z block does but with
+            lzma, while an x group is decoded whole each time the extract
+            comes to one of its runs of segments in the index.
+        """
+        z_bytes = sum(group.z_bytes for group in groups)
+        estimated_bytes = sum(group.estimated_bytes for group in groups)
+        zlib_decode = sum(file_format.unpack_idxline(idxline)[0] * len(self.positions[file_format.unpack_idxline(idxline)[1]])
+                          for group in groups for idxline in group.idxlines)
+        if self.split_streams:
+            lzma_decode = zlib_decode
+        else:
+            lzma_decode = sum(group.seg_len * group.index_runs for group in groups)
+        report = dict((name, self.counts[name]) for name in SEGMENT_COUNTS)
+        report.update({
+            'groups': len(groups),
+            'grouped_segments': sum(len(group.idxlines) for group in groups),
+            'z_bytes': z_bytes,
+            'estimated_bytes': estimated_bytes,
+            'estimated_savings': z_bytes - estimated_bytes,
+            'decode': {
+                'zlib_bytes_before': zlib_decode,
+                'lzma_bytes_after': lzma_decode,
+            },
+        })
+        return report
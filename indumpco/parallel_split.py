@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from pll_pipe import parallel_pipe
+
+# Seekable inputs are scanned in parallel in stripes of this size
+STRIPE_SIZE = 64 << 20
+
+def split_mapping_in_parallel(mapping, chunker, thread_count, stripe_size=STRIPE_SIZE):
+    """ Split an input held in memory into the same segments as fletcher_sum_split
+
+        The input is cut into stripes, which are scanned for candidate cut
+        points by thread_count threads in parallel, using a
+        chunkers.ChunkerBase.  Each stripe is scanned from a full window
+        in, so the rolling sums are the same as they would be in a
+        sequential scan, and the segments and their order come out exactly
+        as a sequential split would make them.  Segments are generated as
+        soon as the stripes they end in have been scanned, as read-only
+        buffers over mapping.
+    """
+    length = len(mapping)
+    scan_start, scan_end = chunker.scan_range(length)
+    stripes = [(start, min(start + stripe_size, scan_end)) for start in xrange(scan_start, scan_end, stripe_size)]
+
+    def _stripe_scanner(q, stripe):
+        q.put(chunker.find_candidates(mapping, stripe[0], stripe[1]))
+
+    candidate_lists = parallel_pipe(stripes, _stripe_scanner, thread_count, 1)
+    seg_start = 0
+    for cut in chunker.cuts(candidate_lists, length):
+        yield buffer(mapping, seg_start, cut - seg_start)
+        seg_start = cut
+    yield buffer(mapping, seg_start)
@@ -1,126 +1,317 @@
 
-import threading, Queue, sys
-import weakref
+import threading, sys, time, os, mmap, shutil, tempfile, traceback, Queue
+import multiprocessing
+from collections import deque
 
-_NO_MORE_INPUT = object()
+# The thread count above which indumpco-create uses a ProcessPool by default
+PROCESS_POOL_THRESHOLD = 4
+
+class _Slot(object):
+    """ Where a worker puts the result of one job, as if it were a queue
+
+        A slot can be handed on and put to later from any thread, see
+        qa_caching_q.QACacheQueue.put_answer_when_ready().
+    """
+    __slots__ = ('pipe_state', 'seq')
+
+    def __init__(self, pipe_state, seq):
+        self.pipe_state = pipe_state
+        self.seq = seq
+
+    def put(self, result, block=True, timeout=None):
+        self.pipe_state.deliver(self.seq, result)
+
+class ConcurrencyController(object):
+    """
+    Decides how many of a parallel_pipe()'s workers are active, between
+    min_workers and max_workers, starting at start_workers.
+
+    Every interval seconds, the rate at which results have been consumed
+    since the last decision is compared with the rate before it.  While a
+    change in the worker count pays by more than tolerance, the count
+    keeps moving the same way, and a change that loses by more than that
+    is backed out.  If it makes no difference either way, a grown count is
+    cut back again, so that workers aren't kept that don't help.  Workers
+    aren't added while none of them are short of jobs, since then the
+    source is holding things up.
+
+    Each decision is appended to the decisions attribute, as a dict of
+    the time since the pipe started, the worker counts before and after,
+    the rate, the number of jobs waiting for a worker and the reason for
+    the decision.  A parallel_pipe() given a stats.Stats also logs them
+    to it as controller_decisions.
+    """
+    def __init__(self, min_workers=1, max_workers=16, start_workers=None, interval=1.0, tolerance=0.05):
+        self.min_workers = max(min_workers, 1)
+        self.max_workers = max(max_workers, self.min_workers)
+        if start_workers is None:
+            start_workers = self.min_workers
+        self.active = min(max(start_workers, self.min_workers), self.max_workers)
+        self.interval = interval
+        self.tolerance = tolerance
+        self.decisions = []
+        self.start_time = None
+        self.last_time = None
+        self.last_done = 0
+        self.prev_rate = None
+        self.last_step = 0
+
+    def start(self, now):
+        self.start_time = self.last_time = now
+
+    def due(self, now):
+        return now - self.last_time >= self.interval
+
+    def decide(self, now, done, waiting):
+        """ The new worker count, given the amount of work done so far and
+            the number of jobs waiting for a worker
+        """
+        rate = (done - self.last_done) / max(now - self.last_time, 1e-6)
+        self.last_time, self.last_done = now, done
+        step, reason = 0, 'no change'
+        if self.prev_rate is None or self.last_step == 0:
+            step, reason = 1, 'probe'
+        elif rate > self.prev_rate * (1 + self.tolerance):
+            step, reason = self.last_step, 'gained'
+        elif rate < self.prev_rate * (1 - self.tolerance):
+            step, reason = -self.last_step, 'lost'
+        elif self.last_step > 0:
+            step, reason = -1, 'no gain'
+        if step > 0 and not waiting:
+            step, reason = 0, 'no jobs waiting'
+        before = self.active
+        self.active = min(max(self.active + step, self.min_workers), self.max_workers)
+        if step and self.active == before:
+            reason = 'at limit'
+        self.last_step = self.active - before
+        self.prev_rate = rate
+        self.decisions.append({'seconds': now - self.start_time, 'workers_before': before,
+                               'workers_after': self.active, 'rate': rate, 'waiting': waiting,
+                               'reason': reason})
+        return self.active
 
 class PipeState(object):
-    def __init__(self, queue_maxsize):
-        self.dest_queue = Queue.Queue(maxsize=queue_maxsize)
+    """
+    The jobs and results of a parallel_pipe(), under a single lock.
 
-        self.source_queue = Queue.Queue(maxsize=queue_maxsize)
-        self.source_queue_finished = False
-        self.source_queue_lock = threading.RLock()
+    Jobs are numbered as they're read from the source, and results are
+    held in a reorder buffer keyed by job number until their turn to be
+    yielded comes.  Reading ahead stops while the jobs read and not yet
+    yielded add up to more than limit, counting each job as job_size(job),
+    though a job is always read if there are no others outstanding.
 
-        self.transient_queues = weakref.WeakSet()
-        self.exception = None
-        self.state_lock = threading.RLock()
+    Only workers numbered below active take jobs, the rest wait on idle.
+    With a ConcurrencyController, active is changed as it decides.
 
-    def record_exception(self, exc):
-        with self.state_lock:
-            if self.exception is not None:
-                return
-            self.exception = exc
+    With a stats.Stats, the jobs waiting for a worker and the amount
+    outstanding are sampled as each job is read, and the active worker
+    count as it changes.  The controller's decisions are logged to it as
+    controller_decisions.
+    """
+    def __init__(self, limit, job_size, active, controller=None, stats=None):
+        self.limit = limit
+        self.job_size = job_size
+        self.active = active
+        self.controller = controller
+        self.stats = stats
+        self.done = 0
+        self.lock = threading.Lock()
+        self.work_ready = threading.Condition(self.lock)
+        self.result_ready = threading.Condition(self.lock)
+        self.space = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.jobs = deque()
+        self.results = {}
+        self.sizes = {}
+        self.outstanding = 0
+        self.read_count = 0
+        self.yield_seq = 0
+        self.source_finished = False
+        self.stopped = False
+        self.exception = None
 
-            # Help any blocked threads to exit
-            for q in list(self.transient_queues):
-                try:
-                    q.put(_NO_MORE_INPUT, block=False)
-                except Queue.Full:
-                    pass
-            q = Queue.Queue()
-            q.put(_NO_MORE_INPUT)
-            try:
-                self.dest_queue.put(q, block=False)
-            except Queue.Full:
-                pass
-            while True:
-                try:
-                    self.source_queue.get(block=False)
-                except Queue.Empty:
-                    break
-            self.source_queue.put(_NO_MORE_INPUT)
+    def _wake_all(self):
+        self.idle.notify_all()
+        self.work_ready.notify_all()
+        self.result_ready.notify_all()
+        self.space.notify_all()
 
-def _source_reader_thread(pipe_state, source_iterable):
-    # A thread to read from the input iterable into a queue.
-    try:
-        for job in source_iterable:
-            with pipe_state.state_lock:
-                if pipe_state.exception is not None:
-                    break
+    def record_exception(self, exc):
+        with self.lock:
+            if self.exception is None:
+                self.exception = exc
+            self.stopped = True
+            self._wake_all()
 
-            pipe_state.source_queue.put(job)
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self._wake_all()
 
-            with pipe_state.state_lock:
-                if pipe_state.exception is not None:
-                    break
-    except Exception:
-        pipe_state.record_exception(sys.exc_info())
+    def add_job(self, job):
+        size = self.job_size(job)
+        with self.lock:
+            while self.outstanding and self.outstanding + size > self.limit and not self.stopped:
+                self.space.wait()
+            if self.stopped:
+                return False
+            self.jobs.append((self.read_count, job))
+            self.sizes[self.read_count] = size
+            self.outstanding += size
+            self.read_count += 1
+            self.work_ready.notify()
+            waiting, outstanding = len(self.jobs), self.outstanding
+        if self.stats is not None:
+            self.stats.sample('pipe_waiting_jobs', waiting)
+            self.stats.sample('pipe_outstanding', outstanding)
+        return True
 
-    pipe_state.source_queue.put(_NO_MORE_INPUT)
+    def finish_source(self):
+        with self.lock:
+            self.source_finished = True
+            self._wake_all()
 
+    def next_job(self, worker_index):
+        """ The number and job of the next job to start, or None once there
+            are no more
+        """
+        with self.lock:
+            while not self.stopped:
+                if self.source_finished and not self.jobs:
+                    return None
+                if worker_index >= self.active:
+                    # Pass on any wakeup meant for an active worker.
+                    self.work_ready.notify()
+                    self.idle.wait()
+                elif self.jobs:
+                    return self.jobs.popleft()
+                else:
+                    self.work_ready.wait()
+            return None
 
-def _worker_thread(pipe_state, worker_func):
-    # A thread to process jobs from input queue to output queue.
-    try:
-        while True:
-            # There's a lock around the process of obtaining a job from the input queue
-            # and pushing a placeholder for the result onto the output queue. This ensures
-            # that job order is preserved when there are many worker threads.
-            # The placeholder takes the form of a reference to another queue, to which the
-            # result will be pushed when it's ready.
-            my_q = Queue.Queue()
-            pipe_state.transient_queues.add(my_q)
-            with pipe_state.source_queue_lock:
-                if pipe_state.source_queue_finished:
-                    return
+    def deliver(self, seq, result):
+        with self.lock:
+            self.results[seq] = result
+            if seq == self.yield_seq:
+                self.result_ready.notify()
 
-                job = pipe_state.source_queue.get()
+    def next_result(self):
+        """ The next result in job order, or _NO_MORE_RESULTS """
+        active_before = self.active
+        if self.controller is not None:
+            decisions_before = len(self.controller.decisions)
+        result = self._next_result()
+        if self.stats is not None:
+            if self.active != active_before:
+                self.stats.sample('pipe_active_workers', self.active)
+            if self.controller is not None:
+                for decision in self.controller.decisions[decisions_before:]:
+                    self.stats.log('controller_decisions', decision)
+        return result
 
-                if job is _NO_MORE_INPUT:
-                    pipe_state.source_queue_finished = True
-                    my_q.put(_NO_MORE_INPUT)
-                    pipe_state.dest_queue.put(my_q)
+    def _next_result(self):
+        with self.lock:
+            while self.yield_seq not in self.results and not self.stopped and \
+                    not (self.source_finished and self.yield_seq == self.read_count):
+                self.result_ready.wait()
+            if self.stopped or self.yield_seq not in self.results:
+                return _NO_MORE_RESULTS
+            result = self.results.pop(self.yield_seq)
+            size = self.sizes.pop(self.yield_seq)
+            self.outstanding -= size
+            self.done += size
+            self.yield_seq += 1
+            self.space.notify()
+            if self.controller is not None:
+                now = time.time()
+                if self.controller.due(now):
+                    self._set_active(self.controller.decide(now, self.done, len(self.jobs)))
+            return result
 
-                if pipe_state.source_queue_finished:
-                    return
+    def _set_active(self, active):
+        if active > self.active:
+            self.idle.notify_all()
+        self.active = active
 
-                pipe_state.dest_queue.put(my_q)
+_NO_MORE_RESULTS = object()
 
-            worker_func(my_q, job)
+def _source_reader_thread(pipe_state, source_iterable):
+    # A thread to read jobs from the input iterable into the pipe.
+    try:
+        for job in source_iterable:
+            if not pipe_state.add_job(job):
+                break
+    except Exception:
+        pipe_state.record_exception(sys.exc_info())
+    pipe_state.finish_source()
 
+def _worker_thread(pipe_state, worker_func, worker_index):
+    # A thread to run jobs, each putting its result to its own slot.
+    try:
+        while True:
+            seq_job = pipe_state.next_job(worker_index)
+            if seq_job is None:
+                return
+            seq, job = seq_job
+            worker_func(_Slot(pipe_state, seq), job)
     except Exception:
         pipe_state.record_exception(sys.exc_info())
 
-def _start_daemon_threads(target, args, count):
+def _start_daemon_threads(target, args, count, numbered=False):
     tlist = []
-    for _ in range(count):
-        t = threading.Thread(target=target, args=args)
+    for i in range(count):
+        t = threading.Thread(target=target, args=args + (i,) if numbered else args)
         t.daemon = True
         t.start()
         tlist.append(t)
     return tlist
 
-def parallel_pipe(source_iterable, worker_func, thread_count, queue_size=10):
-    state = PipeState(queue_maxsize = thread_count * queue_size)
+def _one_job(job):
+    return 1
+
+def parallel_pipe(source_iterable, worker_func, thread_count, queue_size=10, max_bytes=None, job_size=len,
+                  controller=None, stats=None):
+    """ Call worker_func on each job in thread_count threads, and generate
+        the results in job order
+
+        worker_func is called with an object to put() the job's result to
+        and the job.  It may return before the result is put, leaving some
+        other thread to put it.
+
+        No more than thread_count * queue_size jobs are read ahead of the
+        results being consumed, or if max_bytes is given, jobs adding up to
+        no more than max_bytes as measured by job_size.  The first
+        exception raised by the source or a worker is re-raised, and no
+        more jobs are started or results generated after it.
+
+        If a ConcurrencyController is given, it decides how many workers
+        are active as the pipe runs, and thread_count is only used for
+        the read ahead limit.
+
+        If stats is given, a stats.Stats, the pipe's occupancy is sampled
+        into it, see PipeState.
+    """
+    worker_count, active = thread_count, thread_count
+    if controller is not None:
+        worker_count, active = controller.max_workers, controller.active
+        controller.start(time.time())
+    if max_bytes is None:
+        state = PipeState(thread_count * queue_size, _one_job, active, controller, stats)
+    else:
+        state = PipeState(max_bytes, job_size, active, controller, stats)
 
     child_threads = _start_daemon_threads(_source_reader_thread, (state, source_iterable), 1) + \
-            _start_daemon_threads(_worker_thread, (state, worker_func), thread_count)
+            _start_daemon_threads(_worker_thread, (state, worker_func), worker_count, numbered=True)
 
-    while True:
-        result = state.dest_queue.get().get()
-        if result is _NO_MORE_INPUT:
-            break
-        else:
+    try:
+        while True:
+            result = state.next_result()
+            if result is _NO_MORE_RESULTS:
+                break
             yield result
-
-    # Drain the dest queue, in case we're exiting on an exception and
-    # something is blocked on put.
-    while True:
-        try:
-            state.dest_queue.get(block=False)
-        except Queue.Empty:
-            break
+    finally:
+        # Let the threads go if we're being abandoned part way.
+        state.stop()
 
     for t in child_threads:
         t.join()
@@ -128,3 +319,175 @@ def parallel_pipe(source_iterable, worker_func, thread_count, queue_size=10):
     e = state.exception
     if e is not None:
         raise e[0], e[1], e[2]
+
+def process_pipe(source_iterable, func, pool, args=(), queue_size=10, max_bytes=None, job_size=len, stats=None):
+    """ Call func on each job in the processes of a ProcessPool, and
+        generate each job along with its result, in job order
+
+        func is a module level function, called as func(job, *args) with a
+        copy of the job, which must be a string or a buffer.  Ordering,
+        read ahead limits and exceptions are as for parallel_pipe(), with
+        a thread to hand jobs to each of the pool's processes.
+    """
+    def _dispatcher(slot, job):
+        slot.put((job, pool.apply(func, job, *args)))
+    return parallel_pipe(source_iterable, _dispatcher, pool.size, queue_size, max_bytes, job_size, stats=stats)
+
+def _default_scratch_dir():
+    # Somewhere memory backed if there is one, so that scratch pages are
+    # never written out to disk
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+def _pool_process_main(conn, scratch_file):
+    # The loop run by each process of a ProcessPool.
+    f = open(scratch_file, 'r+b')
+    mapping = None
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if request is None:
+            return
+        func, data_len, args = request
+        try:
+            if mapping is None or len(mapping) < data_len:
+                if mapping is not None:
+                    mapping.close()
+                mapping = mmap.mmap(f.fileno(), os.fstat(f.fileno()).st_size)
+            reply = ('ok', func(mapping[:data_len], *args))
+        except Exception as e:
+            reply = ('error', e, traceback.format_exc())
+        try:
+            conn.send(reply)
+        except Exception:
+            # The result or exception couldn't be pickled.
+            conn.send(('error', RuntimeError("unpicklable reply from pool process", repr(reply[1])),
+                       traceback.format_exc()))
+
+class _PoolProcess(object):
+    def __init__(self, scratch_file):
+        self.scratch = open(scratch_file, 'w+b')
+        self.mapping = None
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_pool_process_main, args=(child_conn, scratch_file))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def call(self, func, data, args):
+        data_len = len(data)
+        if self.mapping is None or len(self.mapping) < data_len:
+            size = max(data_len, 1 << 20, 2 * len(self.mapping or ''))
+            if self.mapping is not None:
+                self.mapping.close()
+            self.scratch.truncate(size)
+            self.mapping = mmap.mmap(self.scratch.fileno(), size)
+        self.mapping.seek(0)
+        self.mapping.write(data)
+        self.conn.send((func, data_len, args))
+        reply = self.conn.recv()
+        if reply[0] == 'error':
+            raise reply[1]
+        return reply[1]
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except EnvironmentError:
+            pass
+        self.process.join()
+        self.conn.close()
+        if self.mapping is not None:
+            self.mapping.close()
+        self.scratch.close()
+
+class ProcessPool(object):
+    """
+    A pool of process_count forked processes that call module level
+    functions on segments, for work that holds the GIL for too much of
+    its time to share out between threads.
+
+    Each process has a scratch file that it and the parent both map into
+    memory, and a segment is handed over by copying it into the mapping
+    rather than by pickling it, so only the function, its other arguments
+    and its result go through a pipe.  The scratch files are in /dev/shm
+    where there is one, unless scratch_dir is given, and grow to fit the
+    largest segment.
+
+    apply() may be called from any number of threads, and waits while all
+    of the processes are busy.  Make the pool before starting any threads
+    that might hold locks the processes would need, and close() it when
+    done.
+    """
+    def __init__(self, process_count, scratch_dir=None):
+        if scratch_dir is None:
+            scratch_dir = _default_scratch_dir()
+        self.size = process_count
+        self.scratch_dir = tempfile.mkdtemp(dir=scratch_dir)
+        self.idle = Queue.Queue()
+        self.processes = []
+        try:
+            for i in range(process_count):
+                self.processes.append(_PoolProcess(os.path.join(self.scratch_dir, str(i))))
+        except:
+            self.close()
+            raise
+        for proc in self.processes:
+            self.idle.put(proc)
+
+    def apply(self, func, data, *args):
+        """ The result of func(data, *args) called in one of the processes
+
+            An exception raised by func is raised here.
+        """
+        proc = self.idle.get()
+        try:
+            return proc.call(func, data, args)
+        finally:
+            self.idle.put(proc)
+
+    def close(self):
+        for proc in self.processes:
+            proc.close()
+        self.processes = []
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+def parallel_unordered(source_iterable, worker_func, thread_count):
+    """ Call worker_func on each job in thread_count threads, in no set order
+
+        Unlike parallel_pipe(), workers never wait for each other to keep
+        results in order, so a slow job holds up only the thread running
+        it.  Returns when all jobs are done, and re-raises the first
+        exception from a worker, after which no more jobs are started.
+    """
+    source = iter(source_iterable)
+    lock = threading.Lock()
+    exceptions = []
+
+    def _runner():
+        while True:
+            with lock:
+                if exceptions:
+                    return
+                try:
+                    job = next(source)
+                except StopIteration:
+                    return
+                except Exception:
+                    exceptions.append(sys.exc_info())
+                    return
+            try:
+                worker_func(job)
+            except Exception:
+                with lock:
+                    exceptions.append(sys.exc_info())
+                return
+
+    for t in _start_daemon_threads(_runner, (), thread_count):
+        t.join()
+    if exceptions:
+        e = exceptions[0]
+        raise e[0], e[1], e[2]
@@ -3,7 +3,6 @@
 import Queue
 import threading
 from collections import defaultdict, deque
-from itertools import islice
 import sys
 
 class WorkflowError(Exception):
@@ -48,12 +47,37 @@ class QACacheQueue(object):
                 qacq.i_have_computed(...)
             else:
                 qacq.wait_for_answer(q) # or call put_answer_when_ready()
+
+    The answers held can be limited to max_bytes in total, as measured by
+    answer_size().  Over budget, the cached answer that will be wanted
+    furthest in the future is evicted, so that it will be recomputed when
+    it comes up, or written to spill_file if one is given and read back
+    from there.  The lookahead can be limited to lookahead_bytes of future
+    answers as well as to a number of questions, as measured by
+    question_size().  The hits, misses, evictions, spills and recomputes
+    attributes count what the cache has done.
     """
-    def __init__(self, src_iterable, lookahead=1000):
+    def __init__(self, src_iterable, lookahead=1000, max_bytes=None, answer_size=len,
+                 lookahead_bytes=None, question_size=None, spill_file=None):
         self.lookahead = lookahead
+        self.lookahead_bytes = lookahead_bytes
+        self.question_size = question_size
         self.laq = deque()
+        self.laq_bytes = 0
         self.refcnt = defaultdict(int)
+        # The stream positions at which each question in the lookahead queue comes up
+        self.positions = defaultdict(deque)
         self.answers = {}
+        self.max_bytes = max_bytes
+        self.answer_size = answer_size
+        self.answer_bytes = 0
+        # Answers that are pinned in memory, because a caller has been told
+        # that they're available.
+        self.pinned = defaultdict(int)
+        self.spill_file = spill_file
+        self.spilled = {}
+        self.evicted = set()
+        self.hits, self.misses, self.evictions, self.spills, self.recomputes = 0, 0, 0, 0, 0
         self.src_iterable = src_iterable
         self.lock = threading.RLock()
         self.in_progress_callback_queues = {}
@@ -64,7 +88,61 @@ class QACacheQueue(object):
             if self.refcnt[item] < 0:
                 raise WorkflowError("reference count went negative", item)
             self.refcnt.pop(item, None)
-            self.answers.pop(item, None)
+            self._drop_answer(item)
+            self.spilled.pop(item, None)
+            self.evicted.discard(item)
+
+    def _drop_answer(self, item):
+        a = self.answers.pop(item, NOT_IN_CACHE)
+        if a is not NOT_IN_CACHE:
+            self.answer_bytes -= self._size(a)
+        return a
+
+    def _size(self, a):
+        # Answers need not have a size if there's no budget.
+        if self.max_bytes is None:
+            return 0
+        return self.answer_size(a)
+
+    def _get_answer(self, item):
+        a = self.answers.get(item, NOT_IN_CACHE)
+        if a is NOT_IN_CACHE and item in self.spilled:
+            offset, length = self.spilled[item]
+            self.spill_file.seek(offset)
+            a = self.spill_file.read(length)
+        return a
+
+    def _store_answer(self, item, a):
+        self._drop_answer(item)
+        self.answers[item] = a
+        self.answer_bytes += self._size(a)
+        while self.max_bytes is not None and self.answer_bytes > self.max_bytes:
+            victim = self._furthest_unpinned_answer()
+            if victim is None:
+                break
+            a = self._drop_answer(victim)
+            if self.spill_file is not None:
+                self.spill_file.seek(0, 2)
+                self.spilled[victim] = (self.spill_file.tell(), len(a))
+                self.spill_file.write(a)
+                self.spills += 1
+            else:
+                self.evicted.add(victim)
+                self.evictions += 1
+
+    def _furthest_unpinned_answer(self):
+        # Questions that have come off the queue but not been consumed yet
+        # are wanted soonest of all.
+        furthest, furthest_pos = None, None
+        for item in self.answers:
+            if item not in self.pinned:
+                pos = self.positions[item][0] if self.positions.get(item) else -1
+                if furthest is None or pos > furthest_pos:
+                    furthest, furthest_pos = item, pos
+        return furthest
+
+    def _is_answered(self, item):
+        return item in self.answers or item in self.spilled
 
     def __iter__(self):
         if not hasattr(self, "src_iterable"):
@@ -72,33 +150,57 @@ class QACacheQueue(object):
         it = iter(self.src_iterable)
         del self.src_iterable
 
-        if self.lookahead > 0:
-            for item in islice(it, self.lookahead):
+        position = 0
+        for item in it:
+            with self.lock:
                 self.refcnt[item] += 1
+                self.positions[item].append(position)
                 self.laq.append(item)
-
-        for item in it:
-            self.refcnt[item] += 1
-            self.laq.append(item)
-            yield self.laq.popleft()
+                if self.question_size is not None:
+                    self.laq_bytes += self.question_size(item)
+            position += 1
+            while len(self.laq) > self.lookahead or (self.lookahead_bytes is not None and
+                                                     len(self.laq) > 1 and self.laq_bytes > self.lookahead_bytes):
+                yield self._pop_laq()
 
         while len(self.laq):
-            yield self.laq.popleft()
+            yield self._pop_laq()
+
+    def _pop_laq(self):
+        with self.lock:
+            item = self.laq.popleft()
+            positions = self.positions[item]
+            positions.popleft()
+            if not positions:
+                del self.positions[item]
+            if self.question_size is not None:
+                self.laq_bytes -= self.question_size(item)
+        return item
 
     def consume_cached_answer(self, q):
         with self.lock:
-            a = self.answers.get(q, NOT_IN_CACHE)
+            a = self._get_answer(q)
             if a is not NOT_IN_CACHE:
+                self.hits += 1
                 self._dec_refcnt(q)
+            else:
+                self.misses += 1
         return a
 
     def i_should_compute(self, main_question, byproduct_questions=[]):
         with self.lock:
-            if main_question in self.answers or main_question in self.in_progress_callback_queues:
+            if main_question in self.in_progress_callback_queues:
+                return False
+            elif self._is_answered(main_question):
+                # Keep the answer until put_answer_when_ready() collects it
+                self.pinned[main_question] += 1
                 return False
             else:
+                if main_question in self.evicted:
+                    self.evicted.discard(main_question)
+                    self.recomputes += 1
                 for q in [main_question] + list(byproduct_questions):
-                    if q in self.refcnt and q not in self.answers and q not in self.in_progress_callback_queues:
+                    if q in self.refcnt and not self._is_answered(q) and q not in self.in_progress_callback_queues:
                         self.in_progress_callback_queues[q] = []
                 return True
 
@@ -106,16 +208,20 @@ class QACacheQueue(object):
         with self.lock:
             self._dec_refcnt(main_q)
             for question, answer in [(main_q, main_a)] + byproduct_qa_list:
-                if question in self.refcnt:
-                    self.answers[question] = answer
                 for queue in self.in_progress_callback_queues.pop(question, []):
                     queue.put(answer)
                     self._dec_refcnt(question)
+                if question in self.refcnt and not self._is_answered(question):
+                    self.evicted.discard(question)
+                    self._store_answer(question, answer)
 
     def put_answer_when_ready(self, question, queue):
         with self.lock:
-            if question in self.answers:
-                queue.put(self.answers[question])
+            if self._is_answered(question):
+                queue.put(self._get_answer(question))
+                self.pinned[question] -= 1
+                if self.pinned[question] < 1:
+                    del self.pinned[question]
                 self._dec_refcnt(question)
             else:
                 self.in_progress_callback_queues[question].append(queue)
@@ -130,7 +236,7 @@ class QACacheQueue(object):
             raise WorkflowError("finished without flushing lookahead queue")
         elif self.refcnt != {}:
             raise WorkflowError("leaked references")
-        elif self.answers != {}:
+        elif self.answers != {} or self.spilled != {}:
             raise WorkflowError("leaked cached answers")
         elif self.in_progress_callback_queues != {}:
             raise WorkflowError("leaked callback queues")
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import file_format
+
+POSIX_FADV_WILLNEED = 3
+
+try:
+    import ctypes, ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _posix_fadvise = _libc.posix_fadvise
+    _posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+except (ImportError, OSError, AttributeError, TypeError):
+    _posix_fadvise = None
+
+# The default number of index positions that ReadAhead looks ahead
+DEFAULT_READAHEAD_WINDOW = 64
+
+def hint_willneed(filename):
+    """ Ask the kernel to start reading a file into the page cache
+
+        Where posix_fadvise() isn't available, the file is read through
+        instead, which has the same effect but doesn't return early.
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if _posix_fadvise is not None:
+            _posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+        else:
+            while os.read(fd, 1 << 20):
+                pass
+    finally:
+        os.close(fd)
+
+class ReadAhead(object):
+    """
+    Gets the block files of a dump read in ahead of extract, for block
+    directories on disks where reads are seek bound.
+
+    A thread walks the index up to window positions ahead of the furthest
+    index position passed to advance(), finds each block file along with any that
+    it refers to, and hints that each file will be needed.  The walk is
+    made half a window at a time, and if reorder is true the files of each
+    half window are hinted in inode order, which on most filesystems is
+    close to the order of their data on disk.  A file is hinted only once
+    however many segments map to it, so an x or y group is read in once
+    for all of its segments.
+
+    open_block() shares a file_format.BlockFileRead of each y group between
+    the threads that unpack its segments, until the extract has passed the
+    last segment seen to map to it.  The segments of an x group are already
+    unpacked together, by whichever thread gets to the group first.
+    """
+    def __init__(self, search_path, seg_sums, window=DEFAULT_READAHEAD_WINDOW, reorder=False):
+        self.search_path = search_path
+        self.window = max(window, 2)
+        self.reorder = reorder
+        self.cond = threading.Condition()
+        # The number of index positions walked so far
+        self.walked = 0
+        self.asked_pos = -1
+        self.closed = False
+        # The open group readers, and the last index position seen to use
+        # each group file
+        self.readers = {}
+        self.last_use = {}
+        self.thread = threading.Thread(target=self._walker, args=(seg_sums,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _walker(self, seg_sums):
+        hinted = set()
+        batch = []
+        for pos, seg_sum in enumerate(seg_sums):
+            with self.cond:
+                self.walked = pos + 1
+                if pos > self.asked_pos + self.window:
+                    self._hint_batch(batch, hinted)
+                    batch = []
+                    while pos > self.asked_pos + self.window // 2 and not self.closed:
+                        self.cond.wait()
+                if self.closed:
+                    return
+            batch.append((pos, seg_sum))
+        with self.cond:
+            self._hint_batch(batch, hinted)
+
+    def _hint_batch(self, batch, hinted):
+        # Called with self.cond held, releasing it while hinting.
+        self.cond.release()
+        try:
+            files = []
+            for pos, seg_sum in batch:
+                todo = [(self.search_path.find_block(seg_sum), seg_sum)]
+                while todo:
+                    filename, seg_sum = todo.pop()
+                    if filename is None:
+                        continue
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        continue
+                    key = (st.st_dev, st.st_ino)
+                    with self.cond:
+                        self.last_use[key] = max(self.last_use.get(key, pos), pos)
+                    if key in hinted:
+                        continue
+                    hinted.add(key)
+                    files.append((key, filename))
+                    for ref_sum in file_format.block_refs(filename):
+                        todo.append((file_format.sibling_block_filename(filename, ref_sum), ref_sum))
+            if self.reorder:
+                files.sort()
+            for key, filename in files:
+                hint_willneed(filename)
+        finally:
+            self.cond.acquire()
+
+    def advance(self, pos):
+        """ Note that the extract has reached index position pos
+
+            Workers may call this out of index order, so the read ahead
+            only ever moves on to the furthest position seen.
+        """
+        with self.cond:
+            if pos > self.asked_pos:
+                self.asked_pos = pos
+                self.cond.notify_all()
+            for key in [k for k, last in self.last_use.iteritems() if last < self.asked_pos]:
+                del self.last_use[key]
+                self.readers.pop(key, None)
+
+    def open_block(self, seg_sum, filename):
+        """ A file_format.BlockFileRead for a block file, shared if it's a
+            y group, in which case only y_unpack_seg() may be used
+        """
+        st = os.stat(filename)
+        key = (st.st_dev, st.st_ino)
+        with self.cond:
+            reader = self.readers.get(key)
+        if reader is not None:
+            return reader
+        reader = file_format.BlockFileRead(seg_sum, filename)
+        if reader.is_y_group:
+            with self.cond:
+                if key in self.last_use:
+                    self.readers[key] = reader
+        return reader
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.readers.clear()
+            self.cond.notify_all()
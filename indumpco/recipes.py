@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import threading
+import file_format
+from chunkers import get_chunker
+from delta import link_block_chain
+
+# The default log base 2 of the minimum chunk size, for a mean of about 32K
+DEFAULT_SUB_SEG_BITS = 13
+
+class RecipeWriter(object):
+    """
+    Writes new segments as c blocks, recipes of smaller content defined
+    chunks, so that a change to a segment costs only the chunks it touches.
+
+    Each segment is split again with the same chunking engine, at about
+    2**sub_seg_bits times 4 bytes per chunk on average.  A chunk that's
+    already in a reuse dump is hardlinked from there, and only novel chunks
+    are compressed, as compression_policy decides.  Every chunk is a block
+    of its own in the new dump, so the chunks are there to be reused by
+    later dumps.  Since zlib's window is only 32K, the chunks compress
+    nearly as well as the segment would as a whole.
+    """
+    def __init__(self, engine, sub_seg_bits, search_path, block_dir, compression_policy, catalog=None):
+        self.chunker = get_chunker(engine, sub_seg_bits, 16 << sub_seg_bits)
+        self.search_path = search_path
+        self.block_dir = block_dir
+        self.compression_policy = compression_policy
+        self.catalog = catalog
+        self.lock = threading.Lock()
+        self.new_chunks, self.reused_chunks = 0, 0
+
+    def write_recipe(self, segment, dest_file):
+        chunks = list(self.chunker.split(segment))
+        if len(chunks) < 2:
+            # The one chunk would be the segment itself.
+            self.compression_policy.compress_to_file(segment, dest_file)
+            return
+        chunk_idxlines = []
+        new_chunks, reused_chunks = 0, 0
+        for chunk in chunks:
+            chunk_sum = hashlib.md5(chunk).hexdigest()
+            chunk_idxlines.append(file_format.pack_idxline(len(chunk), chunk_sum))
+            chunk_path = self.block_dir.filename(chunk_sum)
+            if os.path.exists(chunk_path):
+                continue
+            reuse_path = self.search_path.find_block(chunk_sum)
+            if reuse_path is not None:
+                link_block_chain(reuse_path, chunk_sum, self.block_dir, self.catalog)
+                reused_chunks += 1
+            else:
+                chunk_path = self.block_dir.writable_filename(chunk_sum)
+                tmp_path = file_format.tmp_filename(chunk_path)
+                self.compression_policy.compress_to_file(chunk, tmp_path)
+                os.rename(tmp_path, chunk_path)
+                if self.catalog is not None:
+                    self.catalog.add(chunk_sum, chunk_path)
+                new_chunks += 1
+        file_format.write_cfile(chunk_idxlines, dest_file)
+        with self.lock:
+            self.new_chunks += new_chunks
+            self.reused_chunks += reused_chunks
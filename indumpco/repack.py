@@ -2,8 +2,11 @@
 
 import hashlib
 import os
-import lzma
 import file_format
+from block_catalog import BlockCatalog
+from stats import NULL_STATS
+from pll_pipe import parallel_pipe
+from grouping import GroupPlanner
 
 def split_index_into_groups(index_fh):
     misses_since_last_hit = 0
@@ -23,53 +26,146 @@ def split_index_into_groups(index_fh):
     if len(group):
         yield group
 
-def repack_blocks(index_file, block_dir):
+def _unshared_groups(groups, skipped):
+    # Pass on the groups that share no blocks with any group before them,
+    # noting the others in skipped.  Repacking a group replaces its block
+    # files, so a group sharing a block with one being repacked in another
+    # thread could find that block changing under it.
+    seen = set()
+    for idxline_group in groups:
+        seg_sums = set([file_format.unpack_idxline(i)[1] for i in idxline_group])
+        if seg_sums & seen:
+            skipped.append(idxline_group)
+        else:
+            yield idxline_group
+        seen.update(seg_sums)
+
+def repack_blocks(index_file, block_dir, catalog_file=None, split_streams=False, stats=None, thread_count=1,
+                  groups=None):
+    """ Repack the groups of z blocks in a dump's index as x group blocks,
+        or as y group blocks with split_streams, thread_count groups at a
+        time, generating the digest of each group's index lines and the
+        ratio of its packed size to its size before, in index order
+
+        The groups are lists of index lines, split_index_into_groups() of
+        the index unless given.  A group that shares a block with a group
+        before it is skipped.
+    """
+    if stats is None:
+        stats = NULL_STATS
     bd = file_format.BlockDir(block_dir)
-    for idxline_group in split_index_into_groups(open(index_file)):
-        size_change = repack_idxgroup(bd, idxline_group)
-        if size_change is not None:
+    catalog = None
+    if catalog_file is not None:
+        catalog = BlockCatalog(catalog_file)
+    skipped = []
+    if groups is None:
+        groups = split_index_into_groups(open(index_file))
+    groups = _unshared_groups(groups, skipped)
+    def worker(slot, idxline_group):
+        slot.put((idxline_group, repack_idxgroup(bd, idxline_group, catalog, split_streams, stats)))
+    for idxline_group, size_change in parallel_pipe(groups, worker, thread_count, queue_size=2):
+        if size_change is None:
+            stats.count('groups_skipped')
+        else:
+            stats.count('groups_repacked' if size_change < 0.9 else 'groups_kept')
             group_digest = hashlib.md5(''.join(idxline_group)).hexdigest()
             yield (group_digest, size_change)
+    stats.count('groups_skipped', len(skipped))
+    if catalog is not None:
+        catalog.commit()
+        catalog.close()
+
+def repack_idxgroup(bd, idxline_group, catalog=None, split_streams=False, stats=NULL_STATS):
+    """ Repack a group of z blocks as one group block, if that makes them
+        smaller by at least a tenth
 
-def repack_idxgroup(bd, idxline_group):
+        The group is streamed from the z blocks into the group file, so
+        only a piece of it is held in memory at once whatever its size.
+        Returns the ratio of the group block's size to the z blocks' size,
+        or None if the blocks aren't all z blocks.
+    """
     len_sum = [file_format.unpack_idxline(i) for i in idxline_group]
     len_sum_file = [(ls[0], ls[1], bd.filename(ls[1])) for ls in len_sum] 
     for seg_len, seg_sum, seg_file in len_sum_file:
-        if seg_file is None:
-            file_format.FormatError('index references missing block file', (index_file, seg_sum))
         if open(seg_file).read(1) != 'z':
             # cannot a repack a group unless it's all z-blocks
             return None
     
-    # Unpack all the zlib blocks and repack as one big lzma block
-    unpacked_data = ''.join((file_format.decompress_zfile_to_string(lsf[2]) for lsf in len_sum_file))
-    overall_sum = hashlib.md5(unpacked_data).hexdigest()
-    overall_len = len(unpacked_data)
-    packed_data = lzma.compress(unpacked_data)
-    del unpacked_data
+    # Stream the zlib blocks into an lzma group block, with a separate
+    # lzma stream for each segment if split_streams is set.  The compress
+    # time includes the decompress time.
+    group_len = sum([ls[0] for ls in len_sum])
+    group_digest = hashlib.md5(''.join(idxline_group)).hexdigest()
+    tmp = file_format.tmp_filename(bd.writable_filename(group_digest))
+    seg_pieces = (stats.timed_iter('decompress', file_format.iter_zfile_pieces(lsf[2])) for lsf in len_sum_file)
+    try:
+        with stats.timer('compress', group_len):
+            overall_sum, idxlines, packed_len = file_format.write_group_file(
+                tmp, [ls[1] for ls in len_sum], seg_pieces, split_streams)
+        if [file_format.unpack_idxline(i) for i in idxlines] != len_sum:
+            raise file_format.FormatError("block lengths don't match the index", idxline_group)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
 
     orig_compressed_size = sum([os.lstat(lsf[2]).st_size for lsf in len_sum_file])
-    size_change = float(len(packed_data)) / float(orig_compressed_size)
+    size_change = float(packed_len) / float(orig_compressed_size)
 
     if size_change < 0.9:
         # Some compression improvement, we'll replace the files
-    
-        overall_file = bd.filename(overall_sum)
-        tmp = overall_file + ".tmp"
-        f = open(tmp, 'w')
-        f.write('x%s\n%d\n%s' % (overall_sum, len(idxline_group), ''.join(idxline_group)))
-        f.write(packed_data)
-        f.close()
-        os.rename(tmp, overall_file)
-
-        # Replace all the zfiles now in this x block with hardlinks to the x block
-        for _, _, filename in len_sum_file:
-            tmp = filename + 'tmp'
-            os.link(overall_file, tmp)
-            os.rename(tmp, filename)
+        with stats.timer('write', packed_len):
+            overall_file = bd.writable_filename(overall_sum)
+            os.rename(tmp, overall_file)
+            if catalog is not None:
+                catalog.add(overall_sum, overall_file)
+
+            # Replace all the zfiles now in this x block with hardlinks to the x block
+            for _, _, filename in len_sum_file:
+                tmp = file_format.tmp_filename(filename)
+                os.link(overall_file, tmp)
+                os.rename(tmp, filename)
+    else:
+        os.unlink(tmp)
 
     return size_change
 
+def repack_dump(dumpdir, reuse_dumpdirs=[], catalog_file=None, split_streams=False, stats=None, thread_count=1,
+                dry_run=False, **planner_kwargs):
+    """ Repack the z blocks of a dump in the groups planned for it by a
+        grouping.GroupPlanner, returning the planner's report
+
+        With dry_run, nothing is changed, and the report gives only what
+        the repack is expected to do.  Otherwise the report also gives the
+        number of groups repacked and the bytes the dump's block files
+        took before and after.
+    """
+    planner = GroupPlanner(dumpdir, reuse_dumpdirs, split_streams, thread_count=thread_count, **planner_kwargs)
+    groups = planner.plan()
+    report = planner.report(groups)
+    if dry_run:
+        return report
+    bytes_before = _dump_block_bytes(dumpdir)
+    changes = list(repack_blocks(os.path.join(dumpdir, 'index'), file_format.dump_blockdir(dumpdir), catalog_file,
+                                 split_streams, stats, thread_count, [group.idxlines for group in groups]))
+    report['repacked_groups'] = len([size_change for _, size_change in changes if size_change < 0.9])
+    report['bytes_before'] = bytes_before
+    report['bytes_after'] = _dump_block_bytes(dumpdir)
+    return report
+
+def _dump_block_bytes(dumpdir):
+    # The bytes in the block files that a dump's index names, counting
+    # each file once however many names it has
+    bd = file_format.BlockDir(file_format.dump_blockdir(dumpdir))
+    seen = set()
+    total = 0
+    for idxline in open(os.path.join(dumpdir, 'index')):
+        st = os.lstat(bd.filename(file_format.unpack_idxline(idxline)[1]))
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_size
+    return total
+
 def rewrite_index(index_file, block_dir):
     bd = file_format.BlockDir(block_dir)
     for idxline_group in split_index_into_groups(open(index_file)):
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+# Header lines longer than this are not recognised
+MAX_LINE = 1 << 16
+
+_name = r'(?:"[^"\n]*"|[^\s."]+)'
+_qualified_name = r'(%s(?:\.%s)*)' % (_name, _name)
+_marker_re = re.compile(r'^(?:(COPY) %s .*FROM stdin;|(CREATE TABLE) %s .*|(\\\.)|\).*;)\n' % (_qualified_name, _qualified_name), re.M)
+
+def _marker(hit, offset):
+    if hit.group(1):
+        kind, name = 'copy', hit.group(2)
+    elif hit.group(3):
+        kind, name = 'table', hit.group(4)
+    elif hit.group(5):
+        kind, name = 'copy_end', None
+    else:
+        kind, name = 'table_end', None
+    return offset + hit.start(), offset + hit.end(), kind, name
+
+def scan_segment(segment):
+    """ Find the section markers in one segment of a pg_dump
+
+        This is the expensive part of section mapping, and can be run on
+        segments in parallel.  The result is passed to
+        SectionMapper.add_segment() in segment order.  Lines that start in
+        earlier segments are left to SectionMapper.
+    """
+    data = str(segment)
+    first_nl = data.find('\n')
+    if first_nl < 0:
+        return [], data[:MAX_LINE + 1], None, None
+    last_nl = data.rfind('\n')
+    markers = [_marker(hit, 0) for hit in _marker_re.finditer(data, first_nl + 1)]
+    return markers, data[:first_nl + 1], last_nl + 1, data[last_nl + 1:last_nl + 2 + MAX_LINE]
+
+class SectionMapper(object):
+    """
+    Builds a map of the sections of a plain format pg_dump as it's split
+    into segments, so that a single table's definition or data can be
+    extracted later without restoring the whole dump.
+
+    A section starts at a "CREATE TABLE" or "COPY ... FROM stdin;" line.
+    A CREATE TABLE section ends after the line that closes the statement,
+    and a COPY section after its "\\." line.  A section that is never
+    closed ends at the start of the next one.
+    """
+    def __init__(self):
+        self.sections = []
+        self.open_section = None
+        self.offset = 0
+        self.carry = ''
+        self.carry_start = 0
+
+    def add_segment(self, seg_len, scan):
+        """ Add the next segment, given its length and scan_segment() result """
+        markers, head, tail_start, tail = scan
+        self.carry = (self.carry + head)[:MAX_LINE + 1]
+        if tail_start is not None:
+            # The line that started before this segment is complete.
+            hit = _marker_re.match(self.carry)
+            if hit:
+                self._add_marker(*_marker(hit, self.carry_start))
+            for start, end, kind, name in markers:
+                self._add_marker(self.offset + start, self.offset + end, kind, name)
+            self.carry = tail
+            self.carry_start = self.offset + tail_start
+        self.offset += seg_len
+
+    def _add_marker(self, start, end, kind, name):
+        if kind in ('copy', 'table'):
+            self._close(start)
+            self.open_section = (start, kind, name)
+        elif self.open_section is not None and kind == self.open_section[1] + '_end':
+            self._close(end)
+
+    def _close(self, end):
+        if self.open_section is not None:
+            start, kind, name = self.open_section
+            self.sections.append((start, end, kind, name))
+            self.open_section = None
+
+    def finish(self):
+        """ Close any open section at the end of the dump and return the map """
+        self._close(self.offset)
+        return self.sections
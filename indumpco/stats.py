@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class NullStats(object):
+    """ Stats that record nothing, for when instrumentation is off
+
+        Every method does nothing, and timer() returns the same context
+        manager each time, so instrumented code costs a method call or two
+        per segment.
+    """
+    enabled = False
+
+    def timer(self, stage, nbytes=0):
+        return _NULL_TIMER
+
+    def add_time(self, stage, seconds, nbytes=0):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def sample(self, name, value):
+        pass
+
+    def log(self, name, entry):
+        pass
+
+    def timed_iter(self, stage, iterable, size=len):
+        return iterable
+
+NULL_STATS = NullStats()
+
+class _Timer(object):
+    __slots__ = ('stats', 'stage', 'nbytes', 'start')
+
+    def __init__(self, stats, stage, nbytes):
+        self.stats = stats
+        self.stage = stage
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stats.add_time(self.stage, time.time() - self.start, self.nbytes)
+        return False
+
+class Stats(NullStats):
+    """
+    Cumulative time and bytes for each stage of work, and counters, that
+    can be shared between threads.
+
+    Stage times are summed over all the threads doing that stage, so with
+    several workers they can add up to more than the wall clock time.
+    sample() records the count, mean and maximum of a quantity that's
+    looked at from time to time, such as a queue depth.  log() keeps every
+    entry given it, in order, for events such as decisions.
+
+    If callback is given, it's called for every update, outside the lock,
+    with the kind of update ('time', 'count', 'sample' or 'log'), the
+    stage, counter or log name, and the value, for passing on to a metrics
+    exporter.  Timings are passed as a (seconds, bytes) tuple.
+    """
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.samples = {}
+        self.logs = defaultdict(list)
+
+    def timer(self, stage, nbytes=0):
+        """ A context manager that adds the time spent in it to stage """
+        return _Timer(self, stage, nbytes)
+
+    def add_time(self, stage, seconds, nbytes=0):
+        with self.lock:
+            self.times[stage] += seconds
+            self.calls[stage] += 1
+            self.bytes[stage] += nbytes
+        if self.callback is not None:
+            self.callback('time', stage, (seconds, nbytes))
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+        if self.callback is not None:
+            self.callback('count', name, n)
+
+    def sample(self, name, value):
+        with self.lock:
+            count, total, most = self.samples.get(name, (0, 0, value))
+            self.samples[name] = (count + 1, total + value, max(most, value))
+        if self.callback is not None:
+            self.callback('sample', name, value)
+
+    def log(self, name, entry):
+        """ Append entry, which should be suitable for JSON, to the log
+            called name
+        """
+        with self.lock:
+            self.logs[name].append(entry)
+        if self.callback is not None:
+            self.callback('log', name, entry)
+
+    def timed_iter(self, stage, iterable, size=len):
+        """ Generate the items of iterable, adding the time spent getting
+            each one, and its size, to stage
+        """
+        it = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            self.add_time(stage, time.time() - start, size(item))
+            yield item
+
+    def summary(self):
+        """ A dict of everything recorded, suitable for JSON """
+        with self.lock:
+            stages = {}
+            for stage, seconds in self.times.iteritems():
+                stages[stage] = {'seconds': seconds, 'calls': self.calls[stage], 'bytes': self.bytes[stage]}
+                if seconds > 0 and self.bytes[stage]:
+                    stages[stage]['mb_per_sec'] = self.bytes[stage] / float(1 << 20) / seconds
+            samples = dict((name, {'count': count, 'mean': total / float(count), 'max': most})
+                           for name, (count, total, most) in self.samples.iteritems())
+            return {
+                'wall_seconds': time.time() - self.start_time,
+                'stages': stages,
+                'counters': dict(self.counters),
+                'samples': samples,
+                'logs': dict((name, list(entries)) for name, entries in self.logs.iteritems()),
+            }
+
+    def write_json(self, filename):
+        """ Write the summary as JSON to filename, or to stderr if it's '-' """
+        if filename == '-':
+            f = sys.stderr
+        else:
+            f = open(filename, 'w')
+        json.dump(self.summary(), f, indent=2, sort_keys=True)
+        f.write('\n')
+        if f is not sys.stderr:
+            f.close()
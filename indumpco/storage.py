@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import Queue
+import httplib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import file_format
+from pll_pipe import parallel_pipe
+
+class StorageError(Exception):
+    pass
+
+_block_name_re = re.compile(r'^[0-9a-f]{32}$')
+
+class StorageBase(object):
+    """
+    Somewhere to keep block files other than the local block directories,
+    addressed by digest.
+
+    put() and put_file() may return before the block is stored, flush()
+    waits until every block put so far is stored and raises the first
+    error if any failed.
+    """
+    def put(self, seg_sum, data):
+        raise NotImplementedError
+
+    def put_file(self, seg_sum, path):
+        """ Put a block file, unless a block is stored already under its
+            digest
+        """
+        if not self.exists_many([seg_sum]):
+            self.put(seg_sum, open(path).read())
+
+    def get(self, seg_sum):
+        """ The contents of a block file, or None if it isn't stored """
+        raise NotImplementedError
+
+    def exists_many(self, seg_sums):
+        """ The subset of seg_sums that are stored """
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+class LocalStorage(StorageBase):
+    """ Storage in a local block directory, of any layout """
+    def __init__(self, dirname):
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+        self.block_dir = file_format.BlockDir(dirname)
+
+    def put(self, seg_sum, data):
+        path = self.block_dir.writable_filename(seg_sum)
+        tmp = file_format.tmp_filename(path)
+        f = open(tmp, 'w')
+        f.write(data)
+        f.close()
+        os.rename(tmp, path)
+
+    def get(self, seg_sum):
+        try:
+            f = open(self.block_dir.filename(seg_sum))
+        except IOError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def exists_many(self, seg_sums):
+        return set([s for s in seg_sums if os.path.exists(self.block_dir.filename(s))])
+
+class HTTPStorage(StorageBase):
+    """
+    Storage on an HTTP object store, with a block at the URL made of the
+    base URL and the block's digest.  Blocks are uploaded with PUT,
+    fetched with GET and checked for with HEAD.
+
+    Requests go over a pool of up to connections persistent connections.
+    Uploads are made by a pool of upload threads, with no more than
+    max_in_flight blocks put and not yet stored, so that put() blocks
+    while the uploads are that far behind.  The upload threads also make
+    the existence checks for put_file(), so that its caller doesn't wait
+    on them, and exists_many() makes its checks over all the connections
+    at once.
+    """
+    def __init__(self, url, connections=4, max_in_flight=8):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme != 'http':
+            raise StorageError("unsupported storage URL", url)
+        self.host, self.port = parsed.hostname, parsed.port or 80
+        self.path = parsed.path.rstrip('/') + '/'
+        self.connections = connections
+        self.pool = Queue.Queue()
+        for _ in range(connections):
+            self.pool.put(None)
+        self.uploads = Queue.Queue(maxsize=max_in_flight)
+        self.lock = threading.Lock()
+        self.errors = []
+        self.uploaders = []
+        for _ in range(connections):
+            t = threading.Thread(target=self._uploader)
+            t.daemon = True
+            t.start()
+            self.uploaders.append(t)
+
+    def _request(self, method, seg_sum, body=None):
+        # Make a request over a pooled connection, retrying once on a fresh
+        # connection if a kept alive one has gone away.
+        conn = self.pool.get()
+        try:
+            for attempt in (0, 1):
+                if conn is None:
+                    conn = httplib.HTTPConnection(self.host, self.port, timeout=600)
+                try:
+                    conn.request(method, self.path + seg_sum, body)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                    return resp.status, data
+                except (httplib.HTTPException, EnvironmentError):
+                    conn.close()
+                    conn = None
+                    if attempt:
+                        raise
+        finally:
+            self.pool.put(conn)
+
+    def _uploader(self):
+        while True:
+            job = self.uploads.get()
+            try:
+                if job is None:
+                    return
+                seg_sum, data, path = job
+                if path is not None:
+                    if self._exists(seg_sum):
+                        continue
+                    data = open(path).read()
+                status, _ = self._request('PUT', seg_sum, data)
+                if status not in (200, 201, 204):
+                    raise StorageError("upload failed", (seg_sum, status))
+            except Exception:
+                with self.lock:
+                    self.errors.append(sys.exc_info())
+            finally:
+                self.uploads.task_done()
+
+    def put(self, seg_sum, data):
+        self.uploads.put((seg_sum, data, None))
+
+    def put_file(self, seg_sum, path):
+        self.uploads.put((seg_sum, None, path))
+
+    def get(self, seg_sum):
+        status, data = self._request('GET', seg_sum)
+        if status == 404:
+            return None
+        if status != 200:
+            raise StorageError("download failed", (seg_sum, status))
+        return data
+
+    def _exists(self, seg_sum):
+        status, _ = self._request('HEAD', seg_sum)
+        if status not in (200, 404):
+            raise StorageError("existence check failed", (seg_sum, status))
+        return status == 200
+
+    def exists_many(self, seg_sums):
+        def worker(slot, seg_sum):
+            slot.put((seg_sum, self._exists(seg_sum)))
+        checked = parallel_pipe(seg_sums, worker, self.connections)
+        return set([seg_sum for seg_sum, present in checked if present])
+
+    def flush(self):
+        self.uploads.join()
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            e = errors[0]
+            raise e[0], e[1], e[2]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for _ in self.uploaders:
+                self.uploads.put(None)
+            while not self.pool.empty():
+                conn = self.pool.get()
+                if conn is not None:
+                    conn.close()
+
+def open_storage(spec):
+    """ Storage named by an http:// URL or a local directory name """
+    if spec.startswith('http://'):
+        return HTTPStorage(spec)
+    return LocalStorage(spec)
+
+def upload_block_tree(storage, path, seg_sum, done, lock):
+    """ Put a block file and any blocks that it refers to, directly or
+        indirectly, skipping any in the set done, and add them to it
+    """
+    todo = {}
+    stack = [(path, seg_sum)]
+    while stack:
+        path, seg_sum = stack.pop()
+        with lock:
+            if seg_sum in done or seg_sum in todo:
+                continue
+        todo[seg_sum] = path
+        for ref_sum in file_format.block_refs(path):
+            stack.append((file_format.sibling_block_filename(path, ref_sum), ref_sum))
+    with lock:
+        done.update(todo)
+    for seg_sum, path in todo.iteritems():
+        storage.put_file(seg_sum, path)
+
+class Prefetcher(object):
+    """
+    Fetches the blocks of a dump that aren't in a local block directory
+    from storage into fetch_dir, in index order and up to window index
+    positions ahead of the furthest block asked for with find_block(),
+    using thread_count threads.  Blocks that d and c blocks refer to are
+    fetched along with them.
+    """
+    def __init__(self, storage, seg_sums, local_search_path, fetch_dir, window=16, thread_count=4):
+        self.storage = storage
+        self.local_search_path = local_search_path
+        self.fetch_dir = fetch_dir
+        self.window = window
+        self.cond = threading.Condition()
+        # The first index position of each digest, and the state of each
+        # digest's fetch: None while under way, then a path or an exception
+        self.positions = {}
+        self.fetches = {}
+        self.asked_pos = -1
+        self.closed = False
+        self.queue = Queue.Queue(maxsize=thread_count)
+        self.threads = []
+        self.threads.append(threading.Thread(target=self._feeder, args=(seg_sums,)))
+        for _ in range(thread_count):
+            self.threads.append(threading.Thread(target=self._fetcher))
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def _feeder(self, seg_sums):
+        try:
+            for pos, seg_sum in enumerate(seg_sums):
+                with self.cond:
+                    self.positions.setdefault(seg_sum, pos)
+                    while pos > self.asked_pos + self.window and not self.closed:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                if self.local_search_path.find_block(seg_sum) is None:
+                    self.queue.put(seg_sum)
+        finally:
+            for _ in self.threads[1:]:
+                self.queue.put(None)
+
+    def _fetcher(self):
+        while True:
+            seg_sum = self.queue.get()
+            if seg_sum is None:
+                return
+            try:
+                self._fetch(seg_sum)
+            except Exception:
+                # Recorded for find_block() to raise.
+                pass
+
+    def _fetch(self, seg_sum):
+        # Fetch a block and its references, unless some thread already has
+        # or is doing so, and return its path.
+        with self.cond:
+            while seg_sum in self.fetches and self.fetches[seg_sum] is None:
+                self.cond.wait()
+            if seg_sum in self.fetches:
+                result = self.fetches[seg_sum]
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            self.fetches[seg_sum] = None
+        try:
+            data = self.storage.get(seg_sum)
+            if data is None:
+                raise StorageError("block not in storage", seg_sum)
+            path = os.path.join(self.fetch_dir, seg_sum)
+            tmp = file_format.tmp_filename(path)
+            f = open(tmp, 'w')
+            f.write(data)
+            f.close()
+            os.rename(tmp, path)
+            for ref_sum in file_format.block_refs(path):
+                self._fetch(ref_sum)
+            result = path
+        except Exception as e:
+            result = e
+        with self.cond:
+            self.fetches[seg_sum] = result
+            self.cond.notify_all()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def find_block(self, seg_sum):
+        """ The path of a block fetched from storage, fetching it now if
+            the prefetch hasn't
+        """
+        with self.cond:
+            pos = self.positions.get(seg_sum)
+            if pos is not None and pos > self.asked_pos:
+                self.asked_pos = pos
+                self.cond.notify_all()
+        return self._fetch(seg_sum)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class _StorageRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _seg_sum(self):
+        seg_sum = self.path.rstrip('/').split('/')[-1]
+        if not _block_name_re.match(seg_sum):
+            self._reply(400)
+            return None
+        return seg_sum
+
+    def _reply(self, status, data='', send_body=True):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(data)
+
+    def do_GET(self, send_body=True):
+        seg_sum = self._seg_sum()
+        if seg_sum is not None:
+            data = self.server.storage.get(seg_sum)
+            if data is None:
+                self._reply(404, send_body=send_body)
+            else:
+                self._reply(200, data, send_body=send_body)
+
+    def do_HEAD(self):
+        self.do_GET(send_body=False)
+
+    def do_PUT(self):
+        seg_sum = self._seg_sum()
+        if seg_sum is not None:
+            data = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            self.server.storage.put(seg_sum, data)
+            self._reply(201)
+
+    def log_message(self, format, *args):
+        pass
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def storage_server(dirname, host='127.0.0.1', port=0):
+    """ A minimal HTTP object store keeping blocks in a local directory
+
+        A stand-in for a real object store, for testing HTTPStorage.  Call
+        serve_forever() on the result, server_address gives the port.
+    """
+    server = _ThreadingHTTPServer((host, port), _StorageRequestHandler)
+    server.storage = LocalStorage(dirname)
+    return server
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import zlib
+import lzma
+import hashlib
+import sqlite3
+import threading
+import file_format
+from pll_pipe import parallel_unordered
+
+class RateLimiter(object):
+    """
+    Paces a number of threads so that between them they read no more than
+    bytes_per_sec, by making each caller of acquire() sleep until its share
+    of the budget comes up.
+    """
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = float(bytes_per_sec)
+        self.lock = threading.Lock()
+        self.next_free = time.time()
+
+    def acquire(self, nbytes):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.bytes_per_sec
+        if start > now:
+            time.sleep(start - now)
+
+class VerifiedBlocks(object):
+    """
+    A persistent record of the block files that have been verified, stored
+    in an sqlite database.
+
+    Blocks are keyed by device and inode, so that a block hardlinked into
+    many dumps is verified once, and an entry is only trusted while the
+    file's size and mtime are unchanged.  The idxlines of the segments that
+    a block was found to hold are recorded with it.
+    """
+    def __init__(self, filename):
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(filename, timeout=600, check_same_thread=False)
+        self.conn.text_factory = str
+        with self.lock:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS verified (dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, '
+                              'idxlines TEXT NOT NULL, PRIMARY KEY (dev, ino))')
+            self.conn.commit()
+
+    def lookup(self, st):
+        """ The idxlines verified for the file with stat result st, or None """
+        with self.lock:
+            row = self.conn.execute('SELECT size, mtime, idxlines FROM verified WHERE dev = ? AND ino = ?',
+                                    (st.st_dev, st.st_ino)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return set(row[2].splitlines(True))
+
+    def add(self, st, idxlines):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO verified (dev, ino, size, mtime, idxlines) VALUES (?, ?, ?, ?, ?)',
+                              (st.st_dev, st.st_ino, st.st_size, st.st_mtime, ''.join(sorted(idxlines))))
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def block_idxlines(filename, seg_sum):
+    """ Decompress a block file and check its contents against its digests
+
+        Returns the set of idxlines for the segments that the block holds.
+        Raises file_format.FormatError if any segment doesn't match its
+        digest or length.
+    """
+    reader = file_format.BlockFileRead(seg_sum, filename)
+    if not reader.is_x_group:
+        seg = reader.z_unpack_seg()
+        return set([file_format.pack_idxline(len(seg), hashlib.md5(seg).hexdigest())])
+    overall = hashlib.md5()
+    overall_len = 0
+    embedded = set(reader.x_embedded_idxlines)
+    for idxline, seg in reader.x_unpack_segs(embedded):
+        seg_len, seg_sum = file_format.unpack_idxline(idxline)
+        if len(seg) != seg_len or hashlib.md5(seg).hexdigest() != seg_sum:
+            raise file_format.FormatError("x group segment doesn't match its idxline", (filename, idxline))
+        overall.update(seg)
+        overall_len += len(seg)
+    if overall.hexdigest() != reader.x_overall_sum or overall_len != reader.x_overall_len:
+        raise file_format.FormatError("x group contents don't match the group digest", (filename, reader.x_overall_sum))
+    return embedded | set([reader.x_overall_idxline])
+
+class DumpSetVerifier(object):
+    """
+    Checks a set of dumps: every block file in their block directories is
+    decompressed and hashed against its name and any idxlines embedded in
+    it, and every line of every index must resolve to a block holding that
+    segment.
+
+    With a state_file, blocks that have been verified before and haven't
+    changed since are not read again.  With max_bytes_per_sec, block file
+    reads are paced to that rate across all threads.  The checked and
+    skipped attributes count the blocks read and the blocks passed over.
+    """
+    def __init__(self, dumpdirs, extra_block_dirs=[], state_file=None, max_bytes_per_sec=None):
+        self.dumpdirs = dumpdirs
+        self.extra_block_dirs = extra_block_dirs
+        self.verified = None
+        if state_file is not None:
+            self.verified = VerifiedBlocks(state_file)
+        self.rate_limiter = None
+        if max_bytes_per_sec is not None:
+            self.rate_limiter = RateLimiter(max_bytes_per_sec)
+        self.lock = threading.Lock()
+        self.checked, self.skipped = 0, 0
+        self.problems = []
+
+    def _problem(self, where, what):
+        with self.lock:
+            self.problems.append((where, what))
+
+    def run(self, thread_count=4):
+        """ Verify the dump set, returning a list of (path, problem) pairs """
+        # The names under which each block file is found, by (dev, ino)
+        names = {}
+        stats = {}
+        # The idxlines that each block file must hold
+        needed = {}
+        listed = set()
+        for dumpdir in self.dumpdirs:
+            blockdir = file_format.dump_blockdir(dumpdir)
+            # Dumps in a shared store have the one block directory.
+            if blockdir not in listed:
+                listed.add(blockdir)
+                for seg_sum, path in file_format.BlockDir(blockdir).listing():
+                    st = os.stat(path)
+                    key = (st.st_dev, st.st_ino)
+                    stats[key] = (path, st)
+                    names.setdefault(key, set()).add(seg_sum)
+            search_path = file_format.BlockSearchPath([blockdir] + self.extra_block_dirs)
+            index = os.path.join(dumpdir, 'index')
+            for idxline in open(index):
+                seg_len, seg_sum = file_format.unpack_idxline(idxline)
+                path = search_path.find_block(seg_sum)
+                if path is None:
+                    self._problem(index, "block not found for %s" % idxline.strip())
+                    continue
+                st = os.stat(path)
+                key = (st.st_dev, st.st_ino)
+                stats.setdefault(key, (path, st))
+                names.setdefault(key, set()).add(seg_sum)
+                needed.setdefault(key, set()).add(idxline)
+
+        found = {}
+        to_check = []
+        for key, (path, st) in stats.iteritems():
+            idxlines = None
+            if self.verified is not None:
+                idxlines = self.verified.lookup(st)
+            if idxlines is None:
+                to_check.append(key)
+            else:
+                found[key] = idxlines
+                self.skipped += 1
+
+        def _check(key):
+            path, st = stats[key]
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(st.st_size)
+            try:
+                idxlines = block_idxlines(path, os.path.basename(path))
+            except (file_format.FormatError, EnvironmentError, zlib.error, lzma.error) as e:
+                self._problem(path, "bad block: %s" % (e,))
+                return
+            with self.lock:
+                found[key] = idxlines
+                self.checked += 1
+
+        parallel_unordered(to_check, _check, thread_count)
+
+        for key, idxlines in found.iteritems():
+            path, st = stats[key]
+            digests = set([file_format.unpack_idxline(i)[1] for i in idxlines])
+            if names[key] - digests:
+                self._problem(path, "block doesn't hold %s" % ' '.join(sorted(names[key] - digests)))
+            elif needed.get(key, set()) - idxlines:
+                self._problem(path, "block doesn't match %s" % ''.join(sorted(needed[key] - idxlines)).strip())
+            elif self.verified is not None:
+                self.verified.add(st, idxlines)
+
+        if self.verified is not None:
+            self.verified.commit()
+            self.verified.close()
+        return self.problems
+
+def verify_dumps(dumpdirs, extra_block_dirs=[], thread_count=4, state_file=None, max_bytes_per_sec=None):
+    """ Verify a set of dumps, returning a list of (path, problem) pairs
+
+        See DumpSetVerifier.
+    """
+    return DumpSetVerifier(dumpdirs, extra_block_dirs, state_file, max_bytes_per_sec).run(thread_count)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+import random
+import struct
+import hashlib
+from array import array
+from itertools import izip
+
+# Words that row text is made of, so that it compresses about as well as
+# real table data
+WORDS = ('alpha bravo charlie delta echo foxtrot golf hotel india juliet kilo lima mike november oscar papa '
+         'quebec romeo sierra tango uniform victor whiskey xray yankee zulu red orange yellow green blue '
+         'indigo violet black white grey north south east west spring summer autumn winter monday tuesday '
+         'wednesday thursday friday saturday sunday pending shipped cancelled refunded active inactive '
+         'london paris berlin madrid rome vienna prague warsaw dublin lisbon oslo helsinki').split()
+
+_amount = struct.Struct('>I')
+
+def row_text(table_id, row_id, version):
+    """ The text of a row in COPY format, a function of its table, id and
+        version only
+    """
+    h = hashlib.md5('%d.%d.%d' % (table_id, row_id, version)).digest()
+    note_len = ord(h[15]) % 8
+    note = ' '.join([WORDS[ord(c) % len(WORDS)] for c in h[7:7+note_len]])
+    return '%d\t%s %s\t%d.%02d\t2020-%02d-%02d\t%s\n' % (
+        row_id, WORDS[ord(h[0]) % len(WORDS)], WORDS[ord(h[1]) % len(WORDS)],
+        _amount.unpack(h[2:6])[0] % 100000, ord(h[6]) % 100,
+        1 + ord(h[5]) % 12, 1 + ord(h[4]) % 28, note or '\\N')
+
+class _Table(object):
+    def __init__(self, table_id, row_count):
+        self.table_id = table_id
+        self.row_ids = array('L', xrange(row_count))
+        self.versions = array('L', [0]) * row_count
+        self.next_id = row_count
+
+class PgDumpWorkload(object):
+    """
+    A seeded generator of a plain format pg_dump of a database that changes
+    from day to day, for benchmarking.
+
+    The first day's dump has table_count tables of about total_bytes in
+    all, with table sizes skewed so that a few tables hold most of the
+    rows, as in most real databases.  Each call to advance() moves on a
+    day: in each table that changes, which a table does with probability
+    table_change_rate, about delete_rate of the rows are deleted,
+    update_rate are updated in place and insert_rate are added at the
+    end, and on average new_tables_per_day tables are created.  Of the
+    rows deleted and updated, about hot_share are among the newest
+    hot_rows of the table, since most changes to real tables are to
+    recent rows, and the rest are anywhere.
+
+    Rows are kept as ids and versions only, and their text is made as the
+    dump is written, so days of several GB need only a small fraction of
+    that in memory.  The same seed and rates always give the same dumps.
+    """
+    def __init__(self, seed=0, total_bytes=64 << 20, table_count=20, insert_rate=0.01, delete_rate=0.005,
+                 update_rate=0.01, new_tables_per_day=0.2, hot_rows=0.05, hot_share=0.9,
+                 table_change_rate=0.5):
+        self.seed = seed
+        self.insert_rate = insert_rate
+        self.delete_rate = delete_rate
+        self.update_rate = update_rate
+        self.new_tables_per_day = new_tables_per_day
+        self.hot_rows = hot_rows
+        self.hot_share = hot_share
+        self.table_change_rate = table_change_rate
+        self.day = 0
+        rng = random.Random(seed)
+        sample = [row_text(0, i, 0) for i in xrange(1000)]
+        self.mean_row_len = sum(map(len, sample)) / float(len(sample))
+        self.total_rows = max(int(total_bytes / self.mean_row_len), table_count)
+        weights = [rng.paretovariate(1.2) for _ in range(table_count)]
+        self.tables = []
+        for weight in weights:
+            self._add_table(max(int(self.total_rows * weight / sum(weights)), 1))
+
+    def _add_table(self, row_count):
+        self.tables.append(_Table(len(self.tables), row_count))
+
+    def _positions(self, rng, n, rate):
+        # Distinct row positions to change, mostly among the newest rows
+        count = min(int(round(n * rate)), n)
+        hot_n = max(int(n * self.hot_rows), 1)
+        hot_count = min(int(round(count * self.hot_share)), hot_n)
+        positions = set(rng.sample(xrange(n - hot_n, n), hot_count))
+        while len(positions) < count:
+            positions.add(rng.randrange(n))
+        return positions
+
+    def advance(self):
+        """ Move on to the next day's data """
+        self.day += 1
+        rng = random.Random(self.seed * 1000003 + self.day)
+        for table in self.tables:
+            if rng.random() >= self.table_change_rate:
+                continue
+            n = len(table.row_ids)
+            deleted = self._positions(rng, n, self.delete_rate)
+            for pos in sorted(self._positions(rng, n, self.update_rate)):
+                table.versions[pos] += 1
+            if deleted:
+                kept = [(row_id, version) for pos, (row_id, version) in enumerate(izip(table.row_ids, table.versions))
+                        if pos not in deleted]
+                table.row_ids = array('L', (row_id for row_id, _ in kept))
+                table.versions = array('L', (version for _, version in kept))
+            inserts = int(round(n * self.insert_rate))
+            table.row_ids.extend(xrange(table.next_id, table.next_id + inserts))
+            table.versions.extend([0] * inserts)
+            table.next_id += inserts
+        new_tables = int(self.new_tables_per_day)
+        if rng.random() < self.new_tables_per_day - new_tables:
+            new_tables += 1
+        for _ in range(new_tables):
+            self._add_table(max(int(self.total_rows * rng.uniform(0.001, 0.02)), 1))
+
+    def generate(self):
+        """ Generate the current day's dump, in pieces of up to a few hundred KB """
+        yield ('--\n-- PostgreSQL database dump\n--\n\n'
+               'SET statement_timeout = 0;\nSET client_encoding = \'UTF8\';\n\n')
+        for table in self.tables:
+            name = 'public.table_%d' % table.table_id
+            yield ('CREATE TABLE %s (\n    id bigint NOT NULL,\n    name text,\n    amount numeric(12,2),\n'
+                   '    created date,\n    note text\n);\n\n' % name)
+        for table in self.tables:
+            yield 'COPY public.table_%d (id, name, amount, created, note) FROM stdin;\n' % table.table_id
+            rows = []
+            for row_id, version in izip(table.row_ids, table.versions):
+                rows.append(row_text(table.table_id, row_id, version))
+                if len(rows) >= 4096:
+                    yield ''.join(rows)
+                    rows = []
+            rows.append('\\.\n\n\n')
+            yield ''.join(rows)
+        yield '--\n-- PostgreSQL database dump complete\n--\n\n'
+
+    def write(self, fh):
+        """ Write the current day's dump to fh, returning its length and md5 """
+        md5 = hashlib.md5()
+        length = 0
+        for piece in self.generate():
+            fh.write(piece)
+            md5.update(piece)
+            length += len(piece)
+        return length, md5.hexdigest()
@@ -3,7 +3,7 @@ setup(
     name = "InDumpCo",
     version = "0.100",
     packages = ['indumpco'],
-    scripts = ['bin/indumpco-create', 'bin/indumpco-extract', 'bin/indumpco-repack'],
+    scripts = ['bin/indumpco-create', 'bin/indumpco-extract', 'bin/indumpco-repack', 'bin/indumpco-verify', 'bin/indumpco-migrate', 'bin/indumpco-digest-set', 'bin/indumpco-storage-server', 'bin/indumpco-bench', 'bin/indumpco-repack-dump'],
     ext_modules = [Extension("indumpco.fletcher_sum_split", sources=["fletcher_sum_split.c"])],
     test_suite = 'nose.collector',
 
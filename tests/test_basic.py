@@ -2,7 +2,7 @@ import tempfile, shutil, os, sys
 from nose.tools import assert_equals, assert_true
 import indumpco
 
-from tutil import IndumpcoUnderTest, check_indumpco_restores_input
+from tutil import IndumpcoUnderTest, check_indumpco_restores_input, beer
 
 def test_short_strings():
     for s in ('\r', '\n', '', 'x', '\0', '\\', 'foo', '0'):
@@ -21,6 +21,15 @@ def test_stepped_blockdir():
 asldf aslfjas lfdslad lkjsadflkasf lsaflasdfjsldfj sladfjlaldsfjlsajfsadf
 asdlf lasdfsad flsadladsdfj2 fsfsljflsfjs lasdfj    234028340f sadfjasflsl''', mangler)
 
+def test_process_pool_create():
+    input_str = beer(100000)
+    threads = IndumpcoUnderTest(input_str, min_seg_bits=12, section_map=True)
+    processes = IndumpcoUnderTest(input_str, min_seg_bits=12, section_map=True, process_count=3)
+    assert_equals(processes.restore_to_string(), input_str)
+    assert_equals(open(os.path.join(processes.dumpdir, 'index')).read(),
+                  open(os.path.join(threads.dumpdir, 'index')).read())
+    assert_equals(processes.set_of_digests, threads.set_of_digests)
+
 def test_long_string():
     input_str = ''.join(('%d bottles of beer on the wall, %d bottles of beer.\nIf one of those bottles should happen to fall, ' % (b,b) for b in xrange(500000, 1, -1)))
     orig = IndumpcoUnderTest(input_str)
@@ -41,3 +50,54 @@ def test_long_string():
     assert_true(delbytes2.new_segs == delbytes.new_segs, msg='same number of new segments')
     assert_true(delbytes2.reused_segs == 0, msg='no segs reused from existing blockdirs')
     assert_equals(delbytes2.absent_segs, delbytes.reused_segs, msg='%d reused segs become absent segs' % delbytes.reused_segs)
+
+def test_max_seg_size():
+    # No content defined segment ends in a long run of one byte value
+    input_str = 'x' * 5000000 + '%d bottles of beer\n' * 1000
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=16, max_seg_size=1000000)
+    assert_equals(idc.restore_to_string(), input_str)
+    assert_true(max(idc.seg_lens) <= 1000000)
+    assert_equals(idc.seg_lens[:5], [1000000] * 5)
+    chunking = indumpco.file_format.read_chunking(idc.dumpdir)
+    assert_equals(chunking, {'engine': 'fletcher', 'min_seg_bits': 16, 'max_seg_size': 1000000})
+
+def test_gear_engine():
+    input_str = ''.join(('line %d of a gear chunked dump\n' % (i % 5000) for i in xrange(100000)))
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=14, engine='gear')
+    assert_equals(idc.restore_to_string(), input_str)
+    assert_equals(indumpco.file_format.read_chunking(idc.dumpdir)['engine'], 'gear')
+    assert_true(len(idc.seg_lens) > 10)
+    again = IndumpcoUnderTest(input_str, reuse_dumpdirs=[idc.dumpdir], min_seg_bits=14, engine='gear')
+    assert_equals(again.new_segs, 0)
+    fletcher = IndumpcoUnderTest(input_str, reuse_dumpdirs=[idc.dumpdir], min_seg_bits=14)
+    assert_equals(fletcher.reused_segs, 0)
+    assert_equals(fletcher.restore_to_string(), input_str)
+
+def test_extract_to_file():
+    input_str = ''.join(('%d bottles of beer on the wall\n' % (b % 30000) for b in xrange(100000, 1, -1)))
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    assert_true(len(set(sums)) < len(sums), msg='some segments repeat')
+    indumpco.repack_blocks(idc.blockdir, sums[3:9])
+    out_path = os.path.join(idc.basedir, 'restored')
+    open(out_path, 'w').write('stale contents' * 1000000)
+    for thread_count in (1, 4):
+        indumpco.extract_dump_to_file(idc.dumpdir, out_path, thread_count=thread_count)
+        assert_equals(open(out_path).read(), input_str)
+
+def test_extract_with_small_cache():
+    input_str = ''.join(('%d bottles of beer on the wall\n' % (b % 30000) for b in xrange(100000, 1, -1)))
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    indumpco.repack_blocks(idc.blockdir, sums[3:30])
+    for spill_dir in (None, idc.tmpdir):
+        restored = indumpco.extract_dump(idc.dumpdir, cache_bytes=20000, spill_dir=spill_dir)
+        assert_equals(''.join(restored), input_str)
+
+def test_incompatible_chunking_not_reused():
+    input_str = beer(200000)
+    orig = IndumpcoUnderTest(input_str, min_seg_bits=16)
+    same = IndumpcoUnderTest(input_str, reuse_dumpdirs=[orig.dumpdir], min_seg_bits=16)
+    assert_equals(same.new_segs, 0)
+    other = IndumpcoUnderTest(input_str, reuse_dumpdirs=[orig.dumpdir], min_seg_bits=17)
+    assert_equals(other.reused_segs, 0)
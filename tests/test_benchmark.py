@@ -0,0 +1,66 @@
+import os, tempfile, shutil
+from nose.tools import assert_equals, assert_true, assert_false, assert_not_equal
+from indumpco.workload import PgDumpWorkload
+from indumpco.benchmark import run_benchmark, compare_results
+from indumpco.sections import SectionMapper, scan_segment
+
+def dump_string(workload):
+    return ''.join(workload.generate())
+
+def test_workload_is_reproducible():
+    a = PgDumpWorkload(seed=3, total_bytes=200000)
+    b = PgDumpWorkload(seed=3, total_bytes=200000)
+    assert_equals(dump_string(a), dump_string(b))
+    for _ in range(3):
+        a.advance()
+        b.advance()
+    assert_equals(dump_string(a), dump_string(b))
+    c = PgDumpWorkload(seed=4, total_bytes=200000)
+    assert_not_equal(dump_string(a), dump_string(c))
+
+def test_workload_mutation():
+    w = PgDumpWorkload(seed=1, total_bytes=500000, table_count=5, new_tables_per_day=1, table_change_rate=1)
+    first = dump_string(w)
+    assert_true(400000 < len(first) < 600000)
+    first_lines = set(first.splitlines())
+    w.advance()
+    second = dump_string(w)
+    second_lines = set(second.splitlines())
+    assert_equals(len(w.tables), 6)
+    changed = len(first_lines ^ second_lines)
+    assert_true(0 < changed < 0.1 * len(first_lines))
+    assert_true('COPY public.table_5 (id, name, amount, created, note) FROM stdin;' in second_lines)
+
+def test_workload_sections():
+    w = PgDumpWorkload(seed=2, total_bytes=100000, table_count=3)
+    data = dump_string(w)
+    mapper = SectionMapper()
+    mapper.add_segment(len(data), scan_segment(data))
+    sections = mapper.finish()
+    for kind in ('table', 'copy'):
+        assert_equals(sorted(name for _, _, k, name in sections if k == kind),
+                      ['public.table_0', 'public.table_1', 'public.table_2'])
+    for start, end, kind, name in sections:
+        if kind == 'copy':
+            assert_true(data[start:end].endswith('\\.\n'))
+
+def test_run_benchmark():
+    basedir = tempfile.mkdtemp()
+    try:
+        results = run_benchmark(os.path.join(basedir, 'bench'), days=3, thread_count=2,
+                                create_kwargs={'min_seg_bits': 12}, seed=5, total_bytes=300000,
+                                table_change_rate=0.3)
+        assert_false(os.path.exists(os.path.join(basedir, 'bench')))
+    finally:
+        shutil.rmtree(basedir)
+    assert_equals(len(results['days']), 3)
+    for day in results['days']:
+        assert_true(day['stored_bytes'] > 0)
+        assert_equals(sorted(day['mb_per_sec']), ['create', 'extract', 'repack'])
+        assert_true(day['segments']['min'] <= day['segments']['p50'] <= day['segments']['max'])
+    assert_equals(results['days'][0]['reused_segments'], 0)
+    assert_true(results['days'][1]['reused_segments'] > 0)
+    assert_true(results['dedup_ratio'] > results['days'][0]['dedup_ratio'])
+    assert_equals(compare_results(results, results), [])
+    slower = dict(results, mb_per_sec=dict(results['mb_per_sec'], create=results['mb_per_sec']['create'] / 2))
+    assert_equals([w[0] for w in compare_results(results, slower)], ['create MB/s'])
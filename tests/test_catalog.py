@@ -0,0 +1,66 @@
+import tempfile, shutil, os
+from nose.tools import assert_equals, assert_true
+from tutil import IndumpcoUnderTest, verses
+from indumpco.block_catalog import BlockCatalog
+from indumpco import file_format
+
+class TestCatalog(object):
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.catalog_file = os.path.join(self.tmpdir, 'catalog')
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reuse_via_catalog(self):
+        input_str = verses(300000)
+        orig = IndumpcoUnderTest(input_str, catalog_file=self.catalog_file)
+
+        catalog = BlockCatalog(self.catalog_file)
+        assert_true(catalog.covers(orig.blockdir))
+        for segsum in orig.set_of_digests:
+            assert_equals(catalog.lookup(segsum), os.path.join(orig.blockdir, segsum))
+        catalog.close()
+
+        input_str = input_str[:4321] + input_str[4325:]
+        redump = IndumpcoUnderTest(input_str, reuse_dumpdirs=[orig.dumpdir], catalog_file=self.catalog_file)
+        assert_equals(redump.restore_to_string(catalog_file=self.catalog_file), input_str)
+        assert_true(redump.new_segs <= 2)
+        assert_true(redump.reused_segs > redump.new_segs)
+
+    def test_uncovered_reuse_dir_is_imported(self):
+        input_str = verses(300000)
+        orig = IndumpcoUnderTest(input_str)
+        redump = IndumpcoUnderTest(input_str, reuse_dumpdirs=[orig.dumpdir], catalog_file=self.catalog_file)
+        assert_equals(redump.new_segs, 0)
+
+        catalog = BlockCatalog(self.catalog_file)
+        assert_true(catalog.covers(orig.blockdir))
+        assert_true(catalog.covers(redump.blockdir))
+        catalog.close()
+
+    def test_stale_catalog_falls_back_to_scan(self):
+        input_str = verses(300000)
+        orig = IndumpcoUnderTest(input_str, catalog_file=self.catalog_file)
+
+        # Move the blocks somewhere the catalog doesn't know about
+        extra_blkdir = os.path.join(self.tmpdir, 'moved-blocks')
+        os.rename(orig.blockdir, extra_blkdir)
+        os.mkdir(orig.blockdir)
+        assert_equals(orig.restore_to_string(extra_blkdirs=[extra_blkdir], catalog_file=self.catalog_file), input_str)
+
+    def test_search_path_trusts_misses_only_when_asked(self):
+        blkdir = os.path.join(self.tmpdir, 'blocks')
+        os.mkdir(blkdir)
+        catalog = BlockCatalog(self.catalog_file)
+        catalog.add_blockdir(file_format.BlockDir(blkdir))
+
+        # A block that arrives after the directory was catalogued
+        segsum = 'f' * 32
+        open(os.path.join(blkdir, segsum), 'w').close()
+
+        trusting = file_format.BlockSearchPath([blkdir], catalog, trust_catalog_misses=True)
+        assert_equals(trusting.find_block(segsum), None)
+        cautious = file_format.BlockSearchPath([blkdir], catalog)
+        assert_equals(cautious.find_block(segsum), os.path.join(blkdir, segsum))
+        catalog.close()
@@ -0,0 +1,53 @@
+import os, random
+from nose.tools import assert_equals, assert_true
+from indumpco.compression import AdaptivePolicy, FixedPolicy, RAW
+import indumpco
+
+from tutil import IndumpcoUnderTest, beer
+
+def random_bytes(n, seed=0):
+    r = random.Random(seed)
+    return ''.join((chr(r.randint(0, 255)) for _ in xrange(n)))
+
+def test_incompressible_stored_raw():
+    assert_equals(AdaptivePolicy().choose(random_bytes(200000)), RAW)
+    assert_true(AdaptivePolicy().choose(beer(20000)) != RAW)
+
+def test_ratio_slack():
+    seg = beer(20000)
+    assert_equals(AdaptivePolicy(ratio_slack=100).choose(seg), 1)
+    assert_true(AdaptivePolicy(ratio_slack=1.0).choose(seg) > 1)
+
+def test_single_sample():
+    seg = beer(20000)
+    for sample_count in (0, 1):
+        policy = AdaptivePolicy(sample_size=1000, sample_count=sample_count)
+        assert_equals(policy._sample(seg), seg[:1000])
+        assert_true(policy.choose(seg) != RAW)
+
+def test_target_rate_cuts_levels():
+    policy = AdaptivePolicy(ratio_slack=0.5, target_rate=1 << 40)
+    seg = beer(2000)
+    levels = []
+    for _ in range(4):
+        level = policy.choose(seg)
+        levels.append(level)
+        policy._done(len(seg))
+    assert_equals(levels, [9, 6, 3, 1])
+
+def test_mixed_dump_restores():
+    input_str = beer(30000) + random_bytes(300000) + beer(30000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=14)
+    formats = set([open(os.path.join(idc.blockdir, s)).read(1) for s in idc.set_of_digests])
+    assert_equals(formats, set(['r', 'z']))
+    assert_equals(idc.restore_to_string(), input_str)
+    f = indumpco.open_dump(idc.dumpdir)
+    f.seek(500000)
+    assert_equals(f.read(100), input_str[500000:500100])
+
+def test_fixed_policy():
+    input_str = beer(30000)
+    policy = FixedPolicy(RAW)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=14, compression_policy=policy)
+    assert_equals(dict(policy.chosen), {RAW: len(idc.set_of_digests)})
+    assert_equals(idc.restore_to_string(), input_str)
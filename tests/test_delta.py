@@ -0,0 +1,37 @@
+import os
+from nose.tools import assert_equals, assert_true
+from indumpco.delta import make_delta_ops, sketch
+from indumpco import file_format
+
+from tutil import IndumpcoUnderTest, rows
+
+def test_delta_ops_round_trip():
+    ref = rows(2000, 0)
+    for target in (rows(2000, 0, 5), rows(2000, 0), rows(300, 0) + 'new\n' + ref, '', 'no newline', ref[:-1]):
+        ops, inserted_len = make_delta_ops(ref, target)
+        assert_equals(file_format.apply_delta_ops(ref, file_format.pack_delta_ops(ops)), target)
+    ops, inserted_len = make_delta_ops(ref, rows(2000, 0, 5))
+    assert_true(inserted_len < 200)
+
+def test_sketch_similarity():
+    a, b, c = sketch(rows(5000, 0)), sketch(rows(5000, 0, 5)), sketch(rows(5000, 7))
+    assert_true(len(set(a) & set(b)) >= 12)
+    assert_true(len(set(a) & set(c)) < 4)
+
+def test_delta_dumps():
+    inputs = [rows(20000, 0, day * 3) for day in range(7)]
+    dumps = []
+    for input_str in inputs:
+        idc = IndumpcoUnderTest(input_str, [d.dumpdir for d in dumps[-1:]], min_seg_bits=14,
+                                delta_blocks=True, max_delta_depth=3)
+        dumps.append(idc)
+        assert_equals(idc.restore_to_string(), input_str)
+    formats = [open(os.path.join(dumps[-1].blockdir, s)).read(1) for s in dumps[-1].set_of_digests]
+    assert_true('d' in formats)
+    for idc in dumps[1:]:
+        for s in idc.set_of_digests:
+            assert_true(file_format.delta_depth(os.path.join(idc.blockdir, s)) <= 3)
+    # Each dump holds the blocks that its deltas refer to
+    for idc in dumps[:-1]:
+        idc.delete_data()
+    assert_equals(dumps[-1].restore_to_string(), inputs[-1])
@@ -0,0 +1,62 @@
+import os, hashlib, tempfile, shutil
+from nose.tools import assert_equals, assert_true, assert_false
+from indumpco.digest_set import DigestSet, merge_digest_lists, load_digest_set
+
+import indumpco
+
+from tutil import IndumpcoUnderTest, beer
+
+def digests(start, end):
+    return [hashlib.md5(str(i)).hexdigest() for i in xrange(start, end)]
+
+def write_list(path, hex_digests):
+    f = open(path, 'w')
+    for d in hex_digests:
+        f.write(d + '\n')
+    f.close()
+
+def test_merge_and_probe():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        out = os.path.join(tmpdir, 'remote.dset')
+        write_list(os.path.join(tmpdir, 'a'), digests(0, 5000))
+        merge_digest_lists(out, [os.path.join(tmpdir, 'a')], run_size=700)
+        write_list(os.path.join(tmpdir, 'b'), digests(4000, 9000) + digests(0, 10))
+        merge_digest_lists(out, [os.path.join(tmpdir, 'b'), out], run_size=700)
+        ds = DigestSet(out)
+        assert_equals(len(ds), 9000)
+        assert_equals(list(ds), sorted(d.decode('hex') for d in digests(0, 9000)))
+        for d in digests(0, 9000)[::7]:
+            assert_true(d in ds)
+        for d in digests(9000, 9500) + ['', 'zz', '0' * 31, '0' * 34]:
+            assert_false(d in ds)
+        assert_true(isinstance(load_digest_set(out), DigestSet))
+        assert_equals(load_digest_set(os.path.join(tmpdir, 'a')), set(digests(0, 5000)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_empty_set():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        out = os.path.join(tmpdir, 'remote.dset')
+        merge_digest_lists(out, [])
+        ds = DigestSet(out)
+        assert_equals(len(ds), 0)
+        assert_false(digests(0, 1)[0] in ds)
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_remotesegs_digest_set():
+    input_str = beer(50000)
+    orig = IndumpcoUnderTest(input_str + 'more', min_seg_bits=12)
+    listing = os.path.join(orig.tmpdir, 'remote')
+    write_list(listing, orig.set_of_digests)
+    dset = os.path.join(orig.tmpdir, 'remote.dset')
+    merge_digest_lists(dset, [listing])
+    src = os.path.join(orig.tmpdir, 'input')
+    open(src, 'w').write(input_str)
+    dumpdir = os.path.join(orig.basedir, 'd2')
+    indumpco.create_dump(open(src), dumpdir, remote_seg_list_file=dset, min_seg_bits=12)
+    assert_equals(len(os.listdir(os.path.join(dumpdir, 'blocks'))), 1)
+    restored = indumpco.extract_dump(dumpdir, [orig.blockdir])
+    assert_equals(''.join(restored), input_str)
@@ -0,0 +1,74 @@
+import os, random, tarfile, io
+from nose.tools import assert_equals, assert_true
+import indumpco
+
+from tutil import IndumpcoUnderTest, beer
+
+def test_random_reads():
+    input_str = beer(100000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    f = indumpco.open_dump(idc.dumpdir, cache_bytes=20000)
+    r = random.Random(0)
+    for _ in range(200):
+        pos = r.randint(0, len(input_str) + 10)
+        n = r.choice([0, 1, r.randint(0, 20000)])
+        assert_equals(f.seek(pos), pos)
+        assert_equals(f.read(n), input_str[pos:pos+n])
+        assert_equals(f.tell(), min(pos + n, max(pos, len(input_str))))
+    f.seek(-100, os.SEEK_END)
+    assert_equals(f.read(), input_str[-100:])
+    f.seek(10)
+    f.seek(5, os.SEEK_CUR)
+    buf = bytearray(30)
+    assert_equals(f.readinto(buf), 30)
+    assert_equals(str(buf), input_str[15:45])
+    assert_true(f.cache.size <= 20000 or len(f.cache.segs) == 1)
+
+def test_buffered_lines():
+    input_str = beer(20000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=10)
+    f = io.BufferedReader(indumpco.open_dump(idc.dumpdir))
+    assert_equals(list(f), input_str.splitlines(True))
+
+def test_tarfile():
+    tar_data = io.BytesIO()
+    tf = tarfile.open(fileobj=tar_data, mode='w')
+    members = {}
+    for i in range(20):
+        content = beer(i * 500)
+        info = tarfile.TarInfo('f%d' % i)
+        info.size = len(content)
+        tf.addfile(info, io.BytesIO(content))
+        members[info.name] = content
+    tf.close()
+    idc = IndumpcoUnderTest(tar_data.getvalue(), min_seg_bits=12)
+    tf = tarfile.open(fileobj=indumpco.open_dump(idc.dumpdir), mode='r')
+    assert_equals(tf.extractfile('f13').read(), members['f13'])
+    assert_equals(sorted(tf.getnames()), sorted(members))
+
+def test_x_group_decompressed_once():
+    input_str = beer(100000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    indumpco.repack_blocks(idc.blockdir, sums[2:8], split_streams=False)
+    f = indumpco.open_dump(idc.dumpdir)
+    offset = sum(idc.seg_lens[:2])
+    f.seek(offset)
+    f.read(1)
+    # Every segment of the group was cached by the first read.
+    assert_equals(len(f.cache.segs), 6)
+    f.seek(0)
+    assert_equals(f.read(), input_str)
+
+def test_y_group_segment_decompressed_alone():
+    input_str = beer(100000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    indumpco.repack_blocks(idc.blockdir, sums[2:8], split_streams=True)
+    f = indumpco.open_dump(idc.dumpdir)
+    offset = sum(idc.seg_lens[:4])
+    f.seek(offset)
+    assert_equals(f.read(10), input_str[offset:offset+10])
+    assert_equals(len(f.cache.segs), 1)
+    f.seek(0)
+    assert_equals(f.read(), input_str)
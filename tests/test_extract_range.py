@@ -0,0 +1,68 @@
+import os, random
+from nose.tools import assert_equals, assert_true, raises
+import indumpco
+from indumpco.sections import SectionMapper, scan_segment
+
+from tutil import IndumpcoUnderTest, beer
+
+def fake_pg_dump(tables, rows):
+    r = random.Random(tables)
+    out = ['--\n-- PostgreSQL database dump\n--\n\nSET statement_timeout = 0;\n\n']
+    for t in range(tables):
+        out.append('CREATE TABLE public.t%d (\n    id integer NOT NULL,\n    val text\n);\n\n' % t)
+        out.append('ALTER TABLE public.t%d OWNER TO postgres;\n\n' % t)
+    for t in range(tables):
+        out.append('COPY public.t%d (id, val) FROM stdin;\n' % t)
+        for i in range(r.randint(0, rows)):
+            out.append('%d\trow %d of table %d %s\n' % (i, i, t, 'x' * r.randint(0, 200)))
+        out.append('\\.\n\n\n')
+    out.append('CREATE INDEX t0_idx ON public.t0 USING btree (val);\n')
+    return ''.join(out)
+
+def expected_section(dump, header, end_line):
+    start = dump.index(header)
+    return dump[start:dump.index(end_line, start) + len(end_line)]
+
+def test_ranges():
+    input_str = beer(100000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    assert_true(len(idc.seg_lens) > 50)
+    r = random.Random(0)
+    for _ in range(30):
+        offset = r.randint(0, len(input_str) + 10)
+        length = r.choice([0, 1, r.randint(0, 50000), len(input_str)])
+        got = ''.join(indumpco.extract_range(idc.dumpdir, offset, length))
+        assert_equals(got, input_str[offset:offset+length])
+    assert_equals(''.join(indumpco.extract_range(idc.dumpdir, 12345)), input_str[12345:])
+
+def test_only_overlapping_segments_read():
+    input_str = beer(100000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    first, second = idc.seg_lens[:2]
+    for line in list(open(os.path.join(idc.dumpdir, 'index')))[3:]:
+        os.unlink(os.path.join(idc.blockdir, line.split()[1]))
+    got = ''.join(indumpco.extract_range(idc.dumpdir, first - 10, second + 20))
+    assert_equals(got, input_str[first-10:first+second+10])
+
+def test_section_map_matches_unsplit_scan():
+    dump = fake_pg_dump(20, 300)
+    idc = IndumpcoUnderTest(dump, min_seg_bits=8, section_map=True)
+    whole = SectionMapper()
+    whole.add_segment(len(dump), scan_segment(dump))
+    sections = indumpco.file_format.read_sections(idc.dumpdir)
+    assert_equals(sections, whole.finish())
+    assert_equals(len(sections), 40)
+
+def test_extract_table():
+    dump = fake_pg_dump(20, 300)
+    idc = IndumpcoUnderTest(dump, min_seg_bits=10, section_map=True)
+    for t in (0, 7, 19):
+        got = ''.join(indumpco.extract_table(idc.dumpdir, 'public.t%d' % t))
+        create = expected_section(dump, 'CREATE TABLE public.t%d ' % t, '\n);\n')
+        copy = expected_section(dump, 'COPY public.t%d ' % t, '\n\\.\n')
+        assert_equals(got, create + copy)
+
+@raises(indumpco.Error)
+def test_extract_table_without_section_map():
+    idc = IndumpcoUnderTest(fake_pg_dump(2, 10))
+    list(indumpco.extract_table(idc.dumpdir, 'public.t0'))
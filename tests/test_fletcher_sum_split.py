@@ -0,0 +1,200 @@
+import tempfile, random, os, threading
+from nose.tools import assert_equals, assert_true, raises
+from indumpco import fletcher_sum_split
+from indumpco.parallel_split import split_mapping_in_parallel
+from indumpco.chunkers import get_chunker
+
+PRIMES = {8: 257, 9: 509, 10: 1031, 11: 2053, 12: 4093}
+
+def reference_split(data, min_seg_bits, max_seg_size=0):
+    # A slow but straightforward implementation of the segmentation rules.
+    min_seg_size = 1 << min_seg_bits
+    window = min_seg_size >> 1
+    prime = PRIMES[min_seg_bits]
+    b = [ord(c) for c in data]
+    cuts = []
+    seg_start = 0
+    scan_end = 0
+    if len(b) >= window:
+        char_sum = sum(b[:window])
+        fletch_sum = sum(((window - i) * b[i] for i in range(window))) % prime
+        hit_limit = min_seg_size + (window if fletch_sum == 0 else 0)
+        last_cut = -1
+        scan_end = (len(b) // window) * window
+        for pos in range(window, scan_end):
+            char_sum += b[pos] - b[pos-window]
+            fletch_sum = (fletch_sum + char_sum - window * b[pos-window]) % prime
+            if fletch_sum == 0:
+                if pos > hit_limit:
+                    cuts.append(pos + 1)
+                    seg_start = last_cut = pos + 1
+                    hit_limit = pos + min_seg_size + 1
+                    continue
+                same_block = last_cut > 0 and (last_cut - 1) // window == pos // window
+                hit_limit = pos + min_seg_size + (1 if same_block else 0)
+            if max_seg_size and pos + 1 - seg_start == max_seg_size:
+                cuts.append(pos + 1)
+                seg_start = pos + 1
+    while max_seg_size and seg_start + max_seg_size <= len(b):
+        seg_start += max_seg_size
+        cuts.append(seg_start)
+    return [data[s:e] for s, e in zip([0] + cuts, cuts + [len(data)])]
+
+def gear_table():
+    # splitmix64, as in fletcher_sum_split.c
+    mask = (1 << 64) - 1
+    x = 0x696e64756d70636f
+    table = []
+    for i in range(256):
+        x = (x + 0x9e3779b97f4a7c15) & mask
+        z = x
+        z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & mask
+        z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & mask
+        table.append(z ^ (z >> 31))
+    return table
+
+GEAR_TABLE = gear_table()
+
+def reference_gear_split(data, min_seg_bits, max_seg_size=0):
+    min_seg_size = 1 << min_seg_bits
+    top_bits_shift = 64 - (min_seg_bits + 1)
+    cuts = []
+    seg_start = 0
+    h = 0
+    for pos in range(len(data)):
+        h = ((h << 1) + GEAR_TABLE[ord(data[pos])]) & ((1 << 64) - 1)
+        seg_len = pos + 1 - seg_start
+        if (seg_len >= min_seg_size and h >> top_bits_shift == 0) or seg_len == max_seg_size:
+            cuts.append(pos + 1)
+            seg_start = pos + 1
+    return [data[s:e] for s, e in zip([0] + cuts, cuts + [len(data)])]
+
+def read_all_segments(fss):
+    segs = []
+    while True:
+        seg = fletcher_sum_split.readsegment(fss)
+        if seg is None:
+            return segs
+        segs.append(str(seg))
+
+def c_split(data, *args):
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.seek(0)
+    return read_all_segments(fletcher_sum_split.new(f.fileno(), *args))
+
+def random_data(seed, length, alphabet):
+    r = random.Random(seed)
+    return ''.join((r.choice(alphabet) for _ in xrange(length)))
+
+def test_matches_reference():
+    for seed in range(8):
+        for alphabet in ('ab', 'abcdefghij\n', ''.join(map(chr, range(256)))):
+            data = random_data(seed, random.Random(seed).randint(0, 30000), alphabet)
+            for min_seg_bits in (8, 10):
+                for max_seg_size in (0, 1 << min_seg_bits, 1000, 3000):
+                    if max_seg_size and max_seg_size < 1 << min_seg_bits:
+                        continue
+                    segs = c_split(data, min_seg_bits, max_seg_size)
+                    assert_equals(segs, reference_split(data, min_seg_bits, max_seg_size))
+                    from_buffer = read_all_segments(fletcher_sum_split.new(data, min_seg_bits, max_seg_size))
+                    assert_equals(from_buffer, segs)
+                    if max_seg_size:
+                        assert_true(max(map(len, segs)) <= max_seg_size)
+
+def test_gear_matches_reference():
+    for seed in range(4):
+        for alphabet in ('ab', 'abcdefghij\n', ''.join(map(chr, range(256)))):
+            data = random_data(seed, random.Random(seed).randint(0, 30000), alphabet)
+            for min_seg_bits in (8, 10):
+                for max_seg_size in (0, 1 << min_seg_bits, 3000):
+                    expect = reference_gear_split(data, min_seg_bits, max_seg_size)
+                    assert_equals(c_split(data, min_seg_bits, max_seg_size, 'gear'), expect)
+                    from_buffer = read_all_segments(fletcher_sum_split.new(data, min_seg_bits, max_seg_size, 'gear'))
+                    assert_equals(from_buffer, expect)
+
+def test_short_inputs():
+    for data in ('', 'x', 'x' * 127, 'x' * 128, 'x' * 129):
+        assert_equals(c_split(data, 8), reference_split(data, 8))
+
+def test_pipe_input():
+    # Reads from a pipe come back short, the read-ahead must fill blocks.
+    data = random_data(99, 50000, 'abcdefghij\n')
+    rfd, wfd = os.pipe()
+    def writer():
+        for i in xrange(0, len(data), 777):
+            os.write(wfd, data[i:i+777])
+        os.close(wfd)
+    t = threading.Thread(target=writer)
+    t.start()
+    fss = fletcher_sum_split.new(rfd, 10, 3000)
+    os.close(rfd)
+    segs = read_all_segments(fss)
+    t.join()
+    assert_equals(segs, reference_split(data, 10, 3000))
+
+def test_arena_reuse():
+    # Segments share arenas, and an arena is only reused once all of the
+    # segment buffers in it have gone.
+    data = random_data(7, 200000, 'abcdefghij\n')
+    f = tempfile.TemporaryFile()
+    f.write(data)
+    f.seek(0)
+    fss = fletcher_sum_split.new(f.fileno(), 8, 2048)
+    kept = []
+    pos = 0
+    while True:
+        seg = fletcher_sum_split.readsegment(fss)
+        if seg is None:
+            break
+        assert_equals(str(seg), data[pos:pos+len(seg)])
+        pos += len(seg)
+        if len(kept) < 100:
+            kept.append((seg, str(seg)))
+    assert_equals(pos, len(data))
+    for seg, copy in kept:
+        assert_equals(str(seg), copy)
+
+def test_segment_bigger_than_arena():
+    data = random_data(3, 50000, 'ab') + 'x' * 100000 + random_data(4, 50000, 'ab')
+    segs = c_split(data, 8)
+    assert_equals(segs, reference_split(data, 8))
+
+def test_abandoned_reader():
+    f = tempfile.TemporaryFile()
+    f.write(random_data(1, 100000, 'ab'))
+    f.seek(0)
+    fss = fletcher_sum_split.new(f.fileno(), 8)
+    fletcher_sum_split.readsegment(fss)
+    del fss
+
+@raises(ValueError)
+def test_max_below_min():
+    c_split('foo', 10, 1000)
+
+@raises(ValueError)
+def test_unknown_engine():
+    c_split('foo', 10, 0, 'nosuch')
+
+@raises(ValueError)
+def test_bad_min_seg_bits():
+    c_split('foo', 40)
+
+def test_parallel_split_matches_sequential():
+    for seed in range(6):
+        data = random_data(seed, 40000, 'abcdefghij\n')
+        for engine in ('fletcher', 'gear'):
+            for max_seg_size in (0, 1000):
+                chunker = get_chunker(engine, 8, max_seg_size)
+                sequential = c_split(data, 8, max_seg_size, engine)
+                for stripe_size in (97, 127, 128, 5000, 100000):
+                    for thread_count in (1, 3):
+                        segs = split_mapping_in_parallel(data, chunker, thread_count, stripe_size)
+                        assert_equals([str(s) for s in segs], sequential)
+
+def test_parallel_split_short_inputs():
+    for data in ('x', 'x' * 127, 'x' * 128, 'x' * 129, 'x' * 1000):
+        segs = split_mapping_in_parallel(data, get_chunker('fletcher', 8, 256), 2, 10)
+        assert_equals([str(s) for s in segs], reference_split(data, 8, 256))
+        segs = split_mapping_in_parallel(data, get_chunker('gear', 8, 256), 2, 10)
+        assert_equals([str(s) for s in segs], reference_gear_split(data, 8, 256))
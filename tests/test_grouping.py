@@ -0,0 +1,49 @@
+import os
+from nose.tools import assert_true, assert_equals
+from tutil import IndumpcoUnderTest, beer
+from indumpco.grouping import GroupPlanner
+from indumpco.repack import repack_dump
+from indumpco import file_format
+
+def block_formats(idc):
+    return [open(os.path.join(idc.blockdir, s)).read(1) for s in sorted(idc.set_of_digests)]
+
+def test_dry_run_changes_nothing():
+    input_str = beer(100000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    report = repack_dump(idc.dumpdir, dry_run=True)
+    assert_true(report['groups'] > 0)
+    assert_true(report['estimated_savings'] > 0)
+    assert_equals(report['new'], report['segments'])
+    assert_equals(report['decode']['zlib_bytes_before'], len(input_str))
+    assert_equals(set(block_formats(idc)), set(['z']))
+
+def test_repack_dump():
+    input_str = beer(100000)
+    for split_streams in (True, False):
+        idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+        report = repack_dump(idc.dumpdir, split_streams=split_streams, thread_count=4)
+        assert_true(report['repacked_groups'] > 0)
+        assert_true(report['bytes_after'] < report['bytes_before'])
+        assert_equals(idc.restore_to_string(), input_str)
+
+def test_hot_blocks_left_as_z():
+    first = IndumpcoUnderTest(beer(60000), min_seg_bits=12)
+    second = IndumpcoUnderTest(beer(60000) + beer(30000, 'wine'), [first.dumpdir], min_seg_bits=12)
+    reused = [s for s in second.set_of_digests if s in first.set_of_digests]
+    assert_true(reused)
+    report = repack_dump(second.dumpdir, [first.dumpdir], hot_uses=1)
+    assert_equals(report['hot'], len(reused))
+    assert_equals(report['linked'], 0)
+    for seg_sum in reused:
+        assert_equals(open(os.path.join(second.blockdir, seg_sum)).read(1), 'z')
+    assert_equals(second.restore_to_string(), beer(60000) + beer(30000, 'wine'))
+
+def test_cluster_by_sketch():
+    idc = IndumpcoUnderTest(beer(1000))
+    planner = GroupPlanner(idc.dumpdir)
+    a, b = range(16), range(100, 116)
+    sketched = [('%d %032x\n' % (10, i), 10, 5, sk) for i, sk in enumerate([a, b, a[:12] + [50], range(200, 216), b])]
+    groups = planner._cluster(sketched)
+    assert_equals([[int(file_format.unpack_idxline(i)[1], 16) for i in g.idxlines] for g in groups],
+                  [[0, 2], [1, 4], [3]])
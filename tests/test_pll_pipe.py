@@ -1,6 +1,8 @@
-import sys, os, time, threading
-from nose.tools import assert_equals, raises
-from indumpco.pll_pipe import parallel_pipe
+import sys, os, time, threading, Queue
+from nose.tools import assert_equals, assert_true, raises
+import hashlib
+from indumpco.pll_pipe import parallel_pipe, parallel_unordered, ConcurrencyController, ProcessPool, process_pipe
+from indumpco.stats import Stats
 
 class FaultyWorkerError(StandardError):
     pass
@@ -29,6 +31,29 @@ def test_job_order():
         results = list(parallel_pipe(jobs, worker_function, thread_count))
         assert_equals(results, jobs)
 
+def test_max_bytes():
+    state = {'read': 0, 'most_ahead': 0}
+    def _source():
+        for i in range(50):
+            state['read'] += 1
+            yield 'x' * (5 + i % 10)
+    consumed = 0
+    for result in parallel_pipe(_source(), lambda q, job: q.put(job), 4, max_bytes=40):
+        consumed += 1
+        state['most_ahead'] = max(state['most_ahead'], state['read'] - consumed)
+    assert_equals(consumed, 50)
+    # 40 bytes is at most 8 jobs, plus one held by the source reader
+    assert_true(state['most_ahead'] <= 9)
+
+def test_oversized_job():
+    jobs = ['x' * 100, 'y', 'z' * 200]
+    assert_equals(list(parallel_pipe(jobs, lambda q, job: q.put(job), 2, max_bytes=10)), jobs)
+
+def test_abandoned_pipe():
+    pipe = parallel_pipe(xrange(1000000), lambda q, job: q.put(job), 4)
+    assert_equals(next(pipe), 0)
+    pipe.close()
+
 @raises(FaultyWorkerError)
 def test_exception_in_worker_1thread():
     return list(parallel_pipe([1,"die_worker_die",3], worker_function, 1))
@@ -49,6 +74,29 @@ def test_exception_in_source_iterator_1thread():
 def test_exception_in_source_iterator_2threads():
     return list(parallel_pipe(faulty_job_generator(), worker_function, 2))
 
+def test_unordered_runs_every_job():
+    for thread_count in 1, 2, 4, 8:
+        done = []
+        parallel_unordered(range(1, 50), done.append, thread_count)
+        assert_equals(sorted(done), range(1, 50))
+
+def test_unordered_slow_job_does_not_block_others():
+    done = []
+    def _job(job):
+        if job == 'slow':
+            time.sleep(0.5)
+        done.append(job)
+    parallel_unordered(['slow'] + range(20), _job, 2)
+    assert_equals(done[-1], 'slow')
+
+@raises(FaultyWorkerError)
+def test_unordered_exception_in_worker():
+    parallel_unordered([1, "die_worker_die", 3], lambda job: worker_function(Queue.Queue(), job), 2)
+
+@raises(TypeError)
+def test_unordered_exception_in_source_iterator():
+    parallel_unordered(faulty_job_generator(), lambda job: None, 2)
+
 ###########################################################################
 
 # Allow only one thread at a time to do actual work, other worker
@@ -117,3 +165,87 @@ def test_delegation_death_4():
 def test_delegation_death_8():
     dg_state.reset()
     return list(parallel_pipe([3,15,1,9,"die",8,5,3,4,7], dg_worker, 8))
+
+###########################################################################
+
+def test_controller_bounds_and_decisions():
+    controller = ConcurrencyController(1, 6, 2, interval=0.01)
+    active_seen = set()
+    lock = threading.Lock()
+    running = [0]
+    def _worker(q, job):
+        with lock:
+            running[0] += 1
+            active_seen.add(running[0])
+        time.sleep(0.002)
+        with lock:
+            running[0] -= 1
+        q.put(job)
+    jobs = range(400)
+    stats = Stats()
+    assert_equals(list(parallel_pipe(jobs, _worker, 2, controller=controller, stats=stats)), jobs)
+    assert_true(controller.decisions)
+    assert_true(max(active_seen) <= 6)
+    for decision in controller.decisions:
+        assert_true(1 <= decision['workers_after'] <= 6)
+        assert_true(abs(decision['workers_after'] - decision['workers_before']) <= 1)
+    # Sleeping workers don't contend, so more of them get through faster.
+    assert_true(max(decision['workers_after'] for decision in controller.decisions) > 2)
+    assert_equals(stats.summary()['logs']['controller_decisions'], controller.decisions)
+
+def test_controller_decide():
+    c = ConcurrencyController(1, 4, 2, interval=1)
+    c.start(0)
+    assert_equals(c.decide(1, 100, 5), 3)
+    # More throughput, keep going
+    assert_equals(c.decide(2, 300, 5), 4)
+    # At the bound
+    assert_equals(c.decide(3, 600, 5), 4)
+    assert_equals([d['reason'] for d in c.decisions], ['probe', 'gained', 'at limit'])
+    c = ConcurrencyController(1, 4, 2, interval=1)
+    c.start(0)
+    assert_equals(c.decide(1, 100, 5), 3)
+    # Less throughput, back out
+    assert_equals(c.decide(2, 150, 5), 2)
+    # No jobs waiting, don't grow
+    c = ConcurrencyController(1, 4, 2, interval=1)
+    c.start(0)
+    assert_equals(c.decide(1, 100, 0), 2)
+    assert_equals(c.decisions[-1]['reason'], 'no jobs waiting')
+
+def pool_md5(data, suffix=''):
+    if data == 'die_worker_die':
+        raise FaultyWorkerError("worker died")
+    return hashlib.md5(data).hexdigest() + suffix
+
+def test_process_pool_apply():
+    pool = ProcessPool(2)
+    try:
+        for data in ('', 'foo', 'x' * (3 << 20), buffer('bar' * 1000, 3), 'y' * 100):
+            assert_equals(pool.apply(pool_md5, data, '!'), hashlib.md5(data).hexdigest() + '!')
+        try:
+            pool.apply(pool_md5, 'die_worker_die')
+        except FaultyWorkerError:
+            pass
+        else:
+            raise AssertionError("exception not raised")
+        assert_equals(pool.apply(pool_md5, 'foo'), hashlib.md5('foo').hexdigest())
+    finally:
+        pool.close()
+
+def test_process_pipe_order():
+    jobs = [str(i) * (i * 1000) for i in range(40)]
+    pool = ProcessPool(3)
+    try:
+        results = list(process_pipe(jobs, pool_md5, pool, ('.',), max_bytes=100000))
+    finally:
+        pool.close()
+    assert_equals(results, [(job, hashlib.md5(job).hexdigest() + '.') for job in jobs])
+
+@raises(FaultyWorkerError)
+def test_process_pipe_exception():
+    pool = ProcessPool(2)
+    try:
+        list(process_pipe(['a', 'b', 'die_worker_die', 'c'], pool_md5, pool))
+    finally:
+        pool.close()
@@ -1,5 +1,5 @@
-import sys, os, time, threading, Queue
-from nose.tools import assert_equals
+import sys, os, time, threading, Queue, tempfile
+from nose.tools import assert_equals, assert_true
 from functools import wraps
 from indumpco.qa_caching_q import QACacheQueue, NOT_IN_CACHE
 from indumpco.pll_pipe import parallel_pipe
@@ -114,3 +114,79 @@ def test_all():
                 trun(testcase, byproduct_map, qlen)
             for popsleep in 0, 0.1:
                 trun_pll_pipe(testcase, byproduct_map, popsleep)
+
+def budget_run(questions, byproduct_map, **kwargs):
+    qacq = QACacheQueue(iter(questions), **kwargs)
+    computed = []
+    answers = []
+    for q in qacq:
+        a = qacq.consume_cached_answer(q)
+        if a is NOT_IN_CACHE:
+            byproduct_q = byproduct_map.get(q, [])
+            if qacq.i_should_compute(q, byproduct_q):
+                computed.append(q)
+                a = 'a%09d' % q
+                qacq.i_have_computed(q, a, [(x, 'a%09d' % x) for x in byproduct_q])
+            else:
+                a = qacq.wait_for_answer(q)
+        answers.append(a)
+        assert_true(qacq.max_bytes is None or qacq.answer_bytes <= qacq.max_bytes)
+    assert_equals(answers, ['a%09d' % q for q in questions])
+    qacq.finished()
+    return qacq, computed
+
+def test_byte_budget():
+    questions = [1, 2, 3, 4, 1, 2, 3, 4, 5, 1, 5, 6, 7, 8, 9, 1]
+    byproducts = {1: [9, 8], 5: [6]}
+    unlimited, computed = budget_run(questions, byproducts)
+    assert_equals(unlimited.recomputes, 0)
+    assert_equals(sorted(computed), [1, 2, 3, 4, 5, 7])
+    # Room for two 10 byte answers
+    limited, computed = budget_run(questions, byproducts, max_bytes=25)
+    # 1 and 2 are wanted again sooner than 3 and 4, so they're kept, and
+    # the byproducts are evicted since they're wanted last.
+    assert_equals(computed, [1, 2, 3, 4, 3, 4, 5, 6, 7, 8, 9])
+    assert_equals(limited.recomputes, 5)
+    assert_equals(limited.evictions, 5)
+    assert_equals(limited.hits, 5)
+
+def test_spill():
+    questions = [1, 2, 3, 4, 1, 2, 3, 4, 5, 1, 5, 6, 7, 8, 9, 1]
+    spilling, computed = budget_run(questions, {1: [9, 8]}, max_bytes=25, spill_file=tempfile.TemporaryFile())
+    assert_true(spilling.spills > 0)
+    assert_equals(spilling.evictions, 0)
+    assert_equals(spilling.recomputes, 0)
+    assert_equals(len(computed), len(set(computed)))
+
+def test_lookahead_bytes():
+    # With the lookahead limited to one question's worth of bytes, answers
+    # can't be kept for reuse.
+    questions = [1, 2, 1, 2]
+    qacq, computed = budget_run(questions, {}, lookahead_bytes=10, question_size=lambda q: 10)
+    assert_equals(computed, questions)
+    qacq, computed = budget_run(questions, {}, lookahead_bytes=40, question_size=lambda q: 10)
+    assert_equals(computed, [1, 2])
+
+def test_byte_budget_pll_pipe():
+    questions = [1, 2, 7, 14, 2, 4, 3, 6, 2, 4, 1, 1, 1, 7, 7, 3, 2] * 5
+    byproducts = {4: [3, 5], 1: [2, 14]}
+    for spill_file in (None, tempfile.TemporaryFile()):
+        qacq = QACacheQueue(iter(questions), max_bytes=25, spill_file=spill_file)
+
+        def _worker(outq, q):
+            a = qacq.consume_cached_answer(q)
+            time.sleep(0.001)
+            if a is NOT_IN_CACHE:
+                byproduct_q = byproducts.get(q, [])
+                if qacq.i_should_compute(q, byproduct_q):
+                    a = 'a%09d' % q
+                    qacq.i_have_computed(q, a, [(x, 'a%09d' % x) for x in byproduct_q])
+                    outq.put(a)
+                else:
+                    qacq.put_answer_when_ready(q, outq)
+            else:
+                outq.put(a)
+
+        answers = list(parallel_pipe(qacq, _worker, 6, 5))
+        assert_equals(answers, ['a%09d' % q for q in questions])
+        qacq.finished()
@@ -0,0 +1,72 @@
+import os, time
+from nose.tools import assert_true, assert_equals
+from tutil import IndumpcoUnderTest, beer
+from indumpco import file_format
+from indumpco.readahead import ReadAhead, hint_willneed
+import indumpco
+
+def test_restore_with_readahead():
+    input_str = beer(50000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    indumpco.repack_blocks(idc.blockdir, sums[1:7], split_streams=True)
+    indumpco.repack_blocks(idc.blockdir, sums[9:12], split_streams=False)
+    for reorder in (False, True):
+        for window in (2, 5, 1000):
+            got = ''.join(indumpco.extract_dump(idc.dumpdir, readahead=window, reorder_reads=reorder))
+            assert_equals(got, input_str)
+
+def test_readahead_window_and_sharing():
+    input_str = beer(50000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    assert_true(len(sums) > 20)
+    indumpco.repack_blocks(idc.blockdir, sums[1:7], split_streams=True)
+    search_path = file_format.BlockSearchPath([idc.blockdir])
+
+    def walked():
+        with ra.cond:
+            return ra.walked
+
+    ra = ReadAhead(search_path, sums, window=8)
+    time.sleep(0.2)
+    assert_equals(walked(), 9)
+    ra.advance(0)
+    ra.advance(1)
+    first = ra.open_block(sums[1], search_path.find_block(sums[1]))
+    assert_true(first.is_y_group)
+    assert_true(ra.open_block(sums[2], search_path.find_block(sums[2])) is first)
+    for pos in range(2, 8):
+        ra.advance(pos)
+    assert_true(ra.open_block(sums[1], search_path.find_block(sums[1])) is not first)
+    time.sleep(0.2)
+    assert_true(walked() > 9)
+    ra.close()
+
+def test_readahead_advance_out_of_order():
+    input_str = beer(50000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    assert_true(len(sums) > 40)
+    # A digest repeated at positions 4 and 10, and again at 30
+    sums[10] = sums[30] = sums[4]
+    search_path = file_format.BlockSearchPath([idc.blockdir])
+    ra = ReadAhead(search_path, sums, window=8)
+    ra.advance(6)
+    ra.advance(4)
+    ra.advance(5)
+    assert_equals(ra.asked_pos, 6)
+    time.sleep(0.2)
+    with ra.cond:
+        # The walker stops on the first position past the window
+        assert_true(ra.walked <= 6 + 8 + 2)
+    ra.advance(10)
+    ra.advance(4)
+    assert_equals(ra.asked_pos, 10)
+    ra.close()
+
+def test_hint_willneed():
+    idc = IndumpcoUnderTest(beer(1000))
+    for seg_sum in idc.set_of_digests:
+        hint_willneed(os.path.join(idc.blockdir, seg_sum))
+    hint_willneed(os.path.join(idc.blockdir, 'missing'))
@@ -0,0 +1,38 @@
+import os
+from nose.tools import assert_equals, assert_true
+import indumpco
+
+from tutil import IndumpcoUnderTest, rows
+
+def new_block_bytes(idc):
+    total = 0
+    for name in os.listdir(idc.blockdir):
+        st = os.lstat(os.path.join(idc.blockdir, name))
+        if st.st_nlink == 1:
+            total += st.st_size
+    return total
+
+def test_recipe_dumps():
+    first_str = rows(40000, 0)
+    first = IndumpcoUnderTest(first_str, min_seg_bits=18, sub_seg_bits=10)
+    assert_equals(first.restore_to_string(), first_str)
+    formats = set([open(os.path.join(first.blockdir, s)).read(1) for s in first.set_of_digests])
+    assert_true('c' in formats)
+
+    second_str = rows(40000, 0, 3)
+    second = IndumpcoUnderTest(second_str, [first.dumpdir], min_seg_bits=18, sub_seg_bits=10)
+    plain = IndumpcoUnderTest(second_str, [first.dumpdir], min_seg_bits=18)
+    assert_equals(second.new_segs, plain.new_segs)
+    assert_true(new_block_bytes(second) * 4 < new_block_bytes(plain))
+    first.delete_data()
+    assert_equals(second.restore_to_string(), second_str)
+    f = indumpco.open_dump(second.dumpdir)
+    f.seek(123456)
+    assert_equals(f.read(5000), second_str[123456:128456])
+
+def test_small_segments_not_split():
+    input_str = 'a short dump\n'
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12, sub_seg_bits=10)
+    assert_equals(idc.restore_to_string(), input_str)
+    (seg_sum,) = idc.set_of_digests
+    assert_true(open(os.path.join(idc.blockdir, seg_sum)).read(1) != 'c')
@@ -1,15 +1,82 @@
 import os
-from nose.tools import assert_true, assert_equals
-from tutil import IndumpcoUnderTest
+from nose.tools import assert_true, assert_equals, raises
+from tutil import IndumpcoUnderTest, beer
 from indumpco.repack import repack_blocks
+from indumpco import file_format
+import indumpco
 
 def do_repack_t(input_str):
-    idc = IndumpcoUnderTest(input_str)
-    repack_blocks(os.path.join(idc.basedir, 'index'), idc.blockdir)
-    assert_true(idc.restore_to_string() == input_str, msg="repack failed to preserve data")
+    for split_streams in (True, False):
+        idc = IndumpcoUnderTest(input_str)
+        list(repack_blocks(os.path.join(idc.dumpdir, 'index'), idc.blockdir, split_streams=split_streams))
+        assert_true(idc.restore_to_string() == input_str, msg="repack failed to preserve data")
 
 def test_repack_short():
     do_repack_t('asd-0f98a-sdf9a-sf9a-sfd9as-df9a-sdf9-as9f-asdf9as-df')
 
 def test_repack_long():
     do_repack_t(''.join(('%d bottles of beer on the wall, %d bottles of beer.\nIf one of those bottles should happen to fall, ' % (b,b) for b in xrange(500000, 1, -1))))
+
+def make_y_group(input_str):
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    indumpco.repack_blocks(idc.blockdir, sums[1:7], split_streams=True)
+    return idc, sums
+
+def test_y_group_unpack_segs():
+    input_str = beer(50000)
+    idc, sums = make_y_group(input_str)
+    reader = file_format.BlockFileRead(sums[3], os.path.join(idc.blockdir, sums[3]))
+    assert_true(reader.is_y_group)
+    seg_start = sum(idc.seg_lens[:3])
+    wanted = reader.x_embedded_idxlines[2]
+    assert_equals(reader.y_unpack_seg(wanted), input_str[seg_start:seg_start+idc.seg_lens[3]])
+    group_start, group_end = sum(idc.seg_lens[:1]), sum(idc.seg_lens[:7])
+    got = dict(reader.x_unpack_segs(set([wanted, reader.x_overall_idxline])))
+    assert_equals(got[reader.x_overall_idxline], input_str[group_start:group_end])
+    assert_equals(len(got), 2)
+    assert_equals(idc.restore_to_string(), input_str)
+
+@raises(file_format.FormatError)
+def test_y_group_crc_check():
+    input_str = beer(50000)
+    idc, sums = make_y_group(input_str)
+    path = os.path.join(idc.blockdir, sums[1])
+    data = open(path).read()
+    open(path, 'w').write(data[:-20] + chr(ord(data[-20]) ^ 1) + data[-19:])
+    reader = file_format.BlockFileRead(sums[6], path)
+    reader.y_unpack_seg(reader.x_embedded_idxlines[-1])
+
+def test_repack_parallel():
+    input_str = beer(200000)
+    for split_streams in (True, False):
+        idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+        index_file = os.path.join(idc.dumpdir, 'index')
+        changes = list(repack_blocks(index_file, idc.blockdir, split_streams=split_streams, thread_count=4))
+        assert_true(len(changes) > 1)
+        assert_true(any(size_change < 0.9 for _, size_change in changes))
+        assert_equals(idc.restore_to_string(), input_str)
+
+def test_write_group_file_pieces():
+    input_str = beer(50000)
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    for split_streams in (True, False):
+        dest = os.path.join(idc.blockdir, 'group.tmp')
+        seg_pieces = (file_format.iter_zfile_pieces(os.path.join(idc.blockdir, s), 1000) for s in sums[:5])
+        overall_sum, idxlines, file_len = file_format.write_group_file(dest, sums[:5], seg_pieces, split_streams)
+        assert_equals(idxlines, [file_format.pack_idxline(l, s) for l, s in zip(idc.seg_lens[:5], sums[:5])])
+        assert_equals(file_len, os.path.getsize(dest))
+        reader = file_format.BlockFileRead(overall_sum, dest)
+        got = dict(reader.x_unpack_segs(set([reader.x_overall_idxline])))
+        assert_equals(got[reader.x_overall_idxline], input_str[:sum(idc.seg_lens[:5])])
+        os.unlink(dest)
+
+def test_iter_zfile_pieces():
+    input_str = beer(50000)
+    idc = IndumpcoUnderTest(input_str)
+    seg_sum = open(os.path.join(idc.dumpdir, 'index')).readline().split()[1]
+    pieces = list(file_format.iter_zfile_pieces(os.path.join(idc.blockdir, seg_sum), 4096))
+    assert_true(len(pieces) > 1)
+    assert_true(max(map(len, pieces)) <= 4096)
+    assert_equals(''.join(pieces), input_str[:idc.seg_lens[0]])
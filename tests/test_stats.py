@@ -0,0 +1,63 @@
+import os, json
+from nose.tools import assert_equals, assert_true
+from tutil import IndumpcoUnderTest, beer
+from indumpco.stats import Stats, NULL_STATS
+from indumpco.repack import repack_blocks
+import indumpco
+
+def test_stats_recording():
+    events = []
+    stats = Stats(callback=lambda kind, name, value: events.append((kind, name)))
+    with stats.timer('work', 100):
+        pass
+    stats.add_time('work', 0.5, 50)
+    stats.count('things', 3)
+    stats.sample('depth', 2)
+    stats.sample('depth', 6)
+    stats.log('moves', {'to': 3})
+    assert_equals(list(stats.timed_iter('gen', ['ab', 'cde'])), ['ab', 'cde'])
+    summary = stats.summary()
+    assert_equals(summary['stages']['work']['calls'], 2)
+    assert_equals(summary['stages']['work']['bytes'], 150)
+    assert_true(summary['stages']['work']['seconds'] >= 0.5)
+    assert_equals(summary['stages']['gen']['bytes'], 5)
+    assert_equals(summary['counters'], {'things': 3})
+    assert_equals(summary['samples']['depth'], {'count': 2, 'mean': 4.0, 'max': 6})
+    assert_equals(summary['logs'], {'moves': [{'to': 3}]})
+    assert_equals(events[:4], [('time', 'work'), ('time', 'work'), ('count', 'things'), ('sample', 'depth')])
+
+def test_null_stats():
+    with NULL_STATS.timer('work', 100):
+        NULL_STATS.count('things')
+    items = [1, 2]
+    assert_true(NULL_STATS.timed_iter('gen', items) is items)
+
+def test_create_extract_repack_stats():
+    input_str = beer(50000)
+    create_stats = Stats()
+    idc = IndumpcoUnderTest(input_str, min_seg_bits=12, stats=create_stats)
+    summary = create_stats.summary()
+    segments = len(idc.seg_lens)
+    assert_equals(summary['counters'].get('new_segments', 0) + summary['counters'].get('repeated_segments', 0), segments)
+    for stage in ('split', 'md5', 'compress', 'index_write'):
+        assert_true(stage in summary['stages'], stage)
+    assert_equals(summary['stages']['md5']['bytes'], len(input_str))
+    assert_true('pipe_waiting_jobs' in summary['samples'])
+
+    second_stats = Stats()
+    IndumpcoUnderTest(input_str, [idc.dumpdir], min_seg_bits=12, stats=second_stats)
+    assert_equals(second_stats.summary()['counters'].get('reused_segments'), len(set(idc.set_of_digests)))
+
+    repack_stats = Stats()
+    list(repack_blocks(os.path.join(idc.dumpdir, 'index'), idc.blockdir, stats=repack_stats))
+    summary = repack_stats.summary()
+    assert_true(summary['counters'].get('groups_repacked', 0) > 0)
+    assert_true(summary['stages']['compress']['bytes'] > 0)
+
+    extract_stats = Stats()
+    got = ''.join(indumpco.extract_dump(idc.dumpdir, stats=extract_stats))
+    assert_equals(got, input_str)
+    summary = json.loads(json.dumps(extract_stats.summary()))
+    assert_equals(summary['counters']['output_bytes'], len(input_str))
+    assert_equals(summary['counters']['cache_hits'] + summary['counters']['cache_misses'], segments)
+    assert_true(summary['stages']['unpack']['bytes'] >= len(input_str) / 2)
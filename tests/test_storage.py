@@ -0,0 +1,99 @@
+import os, tempfile, shutil, threading
+from nose.tools import assert_equals, assert_true, assert_raises
+from indumpco import file_format
+from indumpco.storage import HTTPStorage, LocalStorage, StorageError, storage_server
+import indumpco
+
+from tutil import IndumpcoUnderTest, rows
+
+class StandInServer(object):
+    def __init__(self):
+        self.basedir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.basedir, 'objects')
+        self.server = storage_server(self.dirname)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/blocks' % self.server.server_address[1]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.basedir)
+
+def with_server(check):
+    server = StandInServer()
+    try:
+        check(server)
+    finally:
+        server.close()
+
+def test_http_put_get():
+    with_server(check_http_put_get)
+
+def check_http_put_get(server):
+    storage = HTTPStorage(server.url, connections=2, max_in_flight=2)
+    blocks = dict(('%032x' % i, 'z' + os.urandom(i * 100)) for i in range(20))
+    for seg_sum, data in blocks.iteritems():
+        storage.put(seg_sum, data)
+    storage.flush()
+    assert_equals(storage.exists_many(list(blocks) + ['f' * 32]), set(blocks))
+    for seg_sum, data in blocks.iteritems():
+        assert_equals(storage.get(seg_sum), data)
+    assert_equals(storage.get('f' * 32), None)
+    storage.put('notadigest', 'z')
+    assert_raises(StorageError, storage.flush)
+    storage.close()
+
+def test_http_put_file():
+    with_server(check_http_put_file)
+
+def check_http_put_file(server):
+    storage = HTTPStorage(server.url, connections=2, max_in_flight=2)
+    path = os.path.join(server.basedir, 'block')
+    open(path, 'w').write('z new')
+    storage.put('a' * 32, 'z stored')
+    storage.flush()
+    storage.put_file('a' * 32, path)
+    storage.put_file('b' * 32, path)
+    storage.flush()
+    assert_equals(storage.get('a' * 32), 'z stored')
+    assert_equals(storage.get('b' * 32), 'z new')
+    storage.put_file('notadigest', path)
+    assert_raises(StorageError, storage.flush)
+    storage.close()
+
+def test_create_and_extract_via_http():
+    with_server(check_create_and_extract_via_http)
+
+def check_create_and_extract_via_http(server):
+    first_str = rows(20000, 0)
+    storage = HTTPStorage(server.url)
+    first = IndumpcoUnderTest(first_str, min_seg_bits=12, storage=storage)
+    assert_equals(set(dict(file_format.BlockDir(server.dirname).listing())), first.set_of_digests)
+
+    second_str = rows(20000, 0, 5)
+    second = IndumpcoUnderTest(second_str, [first.dumpdir], min_seg_bits=12, storage=storage,
+                               delta_blocks=True, sub_seg_bits=10)
+    listing = dict(file_format.BlockDir(second.blockdir).listing())
+    assert_true(set(listing) <= set(dict(file_format.BlockDir(server.dirname).listing())))
+
+    # Restore with no local blocks at all, and with some of them.
+    shutil.rmtree(second.blockdir)
+    os.mkdir(second.blockdir)
+    got = ''.join(indumpco.extract_dump(second.dumpdir, storage=storage))
+    assert_equals(got, second_str)
+    got = ''.join(indumpco.extract_dump(second.dumpdir, [first.blockdir], storage=storage))
+    assert_equals(got, second_str)
+    storage.close()
+
+def test_extract_missing_block():
+    basedir = tempfile.mkdtemp()
+    try:
+        storage = LocalStorage(os.path.join(basedir, 'empty'))
+        d = IndumpcoUnderTest(rows(2000, 0), min_seg_bits=12)
+        shutil.rmtree(d.blockdir)
+        os.mkdir(d.blockdir)
+        assert_raises(StorageError, lambda: list(indumpco.extract_dump(d.dumpdir, storage=storage)))
+    finally:
+        shutil.rmtree(basedir)
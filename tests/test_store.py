@@ -0,0 +1,74 @@
+import os, tempfile, shutil
+from nose.tools import assert_equals, assert_true, assert_false
+from indumpco import file_format
+from indumpco.repack import repack_blocks
+from indumpco.verify import verify_dumps
+import indumpco
+
+from tutil import IndumpcoUnderTest, rows
+
+def store_listing(store):
+    return dict(file_format.BlockDir(store).listing())
+
+def test_store_dumps():
+    basedir = tempfile.mkdtemp()
+    try:
+        check_store_dumps(os.path.join(basedir, 'store'))
+    finally:
+        shutil.rmtree(basedir)
+
+def check_store_dumps(store):
+    first_str = rows(20000, 0)
+    file_format.create_fanout_blockdir(store, levels=2, width=1)
+    first = IndumpcoUnderTest(first_str, min_seg_bits=12, store=store)
+    assert_false(os.path.exists(first.blockdir))
+    assert_equals(first.restore_to_string(), first_str)
+    listing = store_listing(store)
+    assert_equals(set(listing), first.set_of_digests)
+    for seg_sum, path in listing.iteritems():
+        assert_equals(path, os.path.join(store, seg_sum[0], seg_sum[1], seg_sum))
+        assert_equals(os.lstat(path).st_nlink, 1)
+
+    second_str = rows(20000, 0, 5)
+    second = IndumpcoUnderTest(second_str, [first.dumpdir], min_seg_bits=12, store=store,
+                               delta_blocks=True, sub_seg_bits=10)
+    assert_equals(second.restore_to_string(), second_str)
+    for path in store_listing(store).itervalues():
+        assert_equals(os.lstat(path).st_nlink, 1)
+    assert_equals(verify_dumps([first.dumpdir, second.dumpdir]), [])
+
+    list(repack_blocks(os.path.join(second.dumpdir, 'index'), store))
+    assert_equals(second.restore_to_string(), second_str)
+    assert_equals(first.restore_to_string(), first_str)
+    f = indumpco.open_dump(second.dumpdir)
+    assert_equals(f.read(), second_str)
+
+def test_migrate():
+    first_str = rows(20000, 0)
+    second_str = rows(20000, 0, 5)
+    first = IndumpcoUnderTest(first_str, min_seg_bits=12)
+    second = IndumpcoUnderTest(second_str, [first.dumpdir], min_seg_bits=12)
+    store = os.path.join(first.basedir, 'store')
+    file_format.create_fanout_blockdir(store)
+    for idc in (first, second):
+        indumpco.migrate_to_store(idc.dumpdir, store)
+        assert_false(os.path.exists(idc.blockdir))
+    assert_equals(set(store_listing(store)), first.set_of_digests | second.set_of_digests)
+    assert_equals(first.restore_to_string(), first_str)
+    assert_equals(second.restore_to_string(), second_str)
+    assert_equals(verify_dumps([first.dumpdir, second.dumpdir]), [])
+    third = IndumpcoUnderTest(second_str, min_seg_bits=12, store=store)
+    assert_equals(len(store_listing(store)), len(first.set_of_digests | second.set_of_digests))
+
+def test_tmp_filename_unique_to_process():
+    parent_name = file_format.tmp_filename('/store/ab/abcd')
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_fd, file_format.tmp_filename('/store/ab/abcd'))
+        os._exit(0)
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    child_name = os.read(read_fd, 1000)
+    os.close(read_fd)
+    assert_true(child_name != parent_name)
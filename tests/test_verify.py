@@ -0,0 +1,56 @@
+import os, time
+from nose.tools import assert_equals, assert_true
+import indumpco
+from indumpco.verify import verify_dumps, DumpSetVerifier, RateLimiter
+
+from tutil import IndumpcoUnderTest, beer
+
+def make_dump():
+    idc = IndumpcoUnderTest(beer(50000), min_seg_bits=12)
+    sums = [line.split()[1] for line in open(os.path.join(idc.dumpdir, 'index'))]
+    indumpco.repack_blocks(idc.blockdir, sums[2:5], split_streams=True)
+    indumpco.repack_blocks(idc.blockdir, sums[6:9], split_streams=False)
+    return idc, sums
+
+def test_good_dumps():
+    idc, sums = make_dump()
+    again = IndumpcoUnderTest(beer(50000) + 'more\n', reuse_dumpdirs=[idc.dumpdir], min_seg_bits=12)
+    assert_equals(verify_dumps([idc.dumpdir, again.dumpdir]), [])
+
+def test_corrupt_block():
+    idc, sums = make_dump()
+    path = os.path.join(idc.blockdir, sums[-1])
+    data = open(path).read()
+    open(path, 'w').write(data[:-5] + 'xxxxx')
+    problems = verify_dumps([idc.dumpdir])
+    assert_equals([where for where, what in problems], [path])
+
+def test_misnamed_block():
+    idc, sums = make_dump()
+    os.rename(os.path.join(idc.blockdir, sums[0]), os.path.join(idc.blockdir, '0' * 32))
+    problems = verify_dumps([idc.dumpdir])
+    assert_equals(sorted([what.split()[0] for where, what in problems]), ['block', 'block'])
+    assert_true(sums[0] in ''.join([what for where, what in problems]))
+
+def test_incremental():
+    idc, sums = make_dump()
+    state_file = os.path.join(idc.tmpdir, 'verified')
+    v = DumpSetVerifier([idc.dumpdir], state_file=state_file)
+    assert_equals(v.run(), [])
+    assert_equals(v.skipped, 0)
+    first_checked = v.checked
+    v = DumpSetVerifier([idc.dumpdir], state_file=state_file)
+    assert_equals(v.run(), [])
+    assert_equals((v.checked, v.skipped), (0, first_checked))
+    path = os.path.join(idc.blockdir, sums[0])
+    os.utime(path, (0, 0))
+    v = DumpSetVerifier([idc.dumpdir], state_file=state_file)
+    assert_equals(v.run(), [])
+    assert_equals(v.checked, 1)
+
+def test_rate_limit():
+    limiter = RateLimiter(100000)
+    start = time.time()
+    for _ in range(5):
+        limiter.acquire(10000)
+    assert_true(time.time() - start >= 0.35)
@@ -1,10 +1,10 @@
-import tempfile, shutil, os, sys
+import tempfile, shutil, os, sys, random
 from nose.tools import assert_equals
 
 import indumpco
 
 class IndumpcoUnderTest(object):
-    def __init__(self, input_data, reuse_dumpdirs=[], remote_segs=None):
+    def __init__(self, input_data, reuse_dumpdirs=[], remote_segs=None, catalog_file=None, **create_kwargs):
         self.basedir = tempfile.mkdtemp()
         self.tmpdir = os.path.join(self.basedir, 'tmp')
         os.mkdir(self.tmpdir)
@@ -27,7 +27,7 @@ class IndumpcoUnderTest(object):
         f.close()
         f = open(tmp)
 
-        indumpco.create_dump(src_fh=f, outdir=self.dumpdir, dumpdirs_for_reuse=reuse_dumpdirs, remote_seg_list_file=remseg_file)
+        indumpco.create_dump(src_fh=f, outdir=self.dumpdir, dumpdirs_for_reuse=reuse_dumpdirs, remote_seg_list_file=remseg_file, catalog_file=catalog_file, **create_kwargs)
         os.unlink(tmp)
         if remseg_file is not None:
             os.unlink(remseg_file)
@@ -41,8 +41,10 @@ class IndumpcoUnderTest(object):
         idxpath = os.path.join(self.dumpdir, 'index')
         self.new_segs, self.reused_segs, self.absent_segs = 0, 0, 0
         self.set_of_digests = set()
+        self.seg_lens = []
         for line in open(idxpath):
-            segsum = line.strip().split()[1]
+            seglen, segsum = line.strip().split()
+            self.seg_lens.append(int(seglen))
             self.set_of_digests.add(segsum)
             path = os.path.join(self.blockdir, segsum)
             if os.path.exists(path):
@@ -63,12 +65,34 @@ class IndumpcoUnderTest(object):
     def __del__(self):
         self.delete_data()
 
-    def restore_to_string(self, extra_blkdirs=[]):
+    def restore_to_string(self, extra_blkdirs=[], catalog_file=None):
         if not os.path.exists(self.basedir):
             raise RuntimeError('restore attempt after data deleted', (self, self.basedir))
-        return ''.join((seg for seg in indumpco.extract_dump(self.dumpdir, extra_blkdirs)))
+        return ''.join((seg for seg in indumpco.extract_dump(self.dumpdir, extra_blkdirs, catalog_file=catalog_file)))
 
 
+def beer(n, drink='beer'):
+    """ Test input of n-1 short, numbered lines """
+    return ''.join(('%d bottles of %s on the wall\n' % (b, drink) for b in xrange(n, 1, -1)))
+
+def verses(n):
+    """ Test input of n-1 long, numbered verses without line breaks
+        between them
+    """
+    return ''.join(('%d bottles of beer on the wall, %d bottles of beer.\nIf one of those bottles should happen to fall, ' % (b,b) for b in xrange(n, 1, -1)))
+
+def rows(n, seed, changes=0):
+    """ Test input of n table rows with random payloads, with some of
+        them changed if changes is given
+    """
+    r = random.Random(seed)
+    lines = ['%d\trow %d with some payload %s\n' % (i, i, 'x' * r.randint(0, 80)) for i in xrange(n)]
+    r = random.Random(seed + 1)
+    for _ in range(changes):
+        i = r.randint(0, n - 1)
+        lines[i] = '%d\tchanged row %d\n' % (i, r.randint(0, 10 ** 9))
+    return ''.join(lines)
+
 def check_indumpco_restores_input(input_str, mangler_callback=None):
     idc = IndumpcoUnderTest(input_str)
     if mangler_callback is not None: